@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+answer_cache.py
+
+Semantic answer cache for rag_query. Each entry stores the question embedding, the ids
+of the chunks retrieved for it, the generated answer, the generation model and the
+embedding model and dimension the question vector came from; only entries of the same
+models and dimension are compared. A new
+question reuses an answer when its embedding is within ANSWER_CACHE_THRESHOLD cosine
+similarity of a cached one AND retrieval returned exactly the same chunks, so answers
+never outlive the context they were generated from.
+
+Entries live in SQLite under data/cache/ and are scanned as a NumPy matrix. Eviction is
+by age (ANSWER_CACHE_TTL seconds) and size (ANSWER_CACHE_MAX entries, least recently
+used first). Disable with ANSWER_CACHE=0.
+"""
+import os, sys, json, time, sqlite3, threading
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_PATH = Path(__file__).resolve().parent.parent / "data" / "cache" / "answers.sqlite"
+CACHE_PATH   = Path(os.getenv("ANSWER_CACHE_PATH", str(DEFAULT_PATH)))
+THRESHOLD    = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+TTL          = float(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 3600)))
+MAX_ENTRIES  = int(os.getenv("ANSWER_CACHE_MAX", "10000"))
+ENABLED      = os.getenv("ANSWER_CACHE", "1") != "0"
+
+class AnswerCache:
+    def __init__(self, path: Path = CACHE_PATH, threshold: float = THRESHOLD, ttl: float = TTL,
+                 max_entries: int = MAX_ENTRIES):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.threshold, self.ttl, self.max_entries = threshold, ttl, max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS answers (
+            id INTEGER PRIMARY KEY, model TEXT NOT NULL, vec BLOB NOT NULL, chunk_ids TEXT NOT NULL,
+            question TEXT, answer TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0)""")
+        columns = {r[1] for r in self.db.execute("PRAGMA table_info(answers)")}
+        # Older caches lack these; their rows match no lookup and age out through TTL/LRU eviction
+        if "embed_model" not in columns:
+            self.db.execute("ALTER TABLE answers ADD COLUMN embed_model TEXT")
+        if "dim" not in columns:
+            self.db.execute("ALTER TABLE answers ADD COLUMN dim INTEGER")
+        self.db.execute("CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.db.commit()
+        self.hits = self.misses = 0
+        self._views = {}               # (model, embed_model, dim) → (table version, ids, chunk_ids, created, matrix)
+
+    def _view(self, model: str, embed_model: str, dim: int):
+        """Normalized embedding matrix for one model pair and dimension, rebuilt when the table changed
+        (possibly in another process)."""
+        version = self.db.execute("SELECT MAX(id), COUNT(*) FROM answers").fetchone()
+        key = (model, embed_model, dim)
+        view = self._views.get(key)
+        if view is None or view[0] != version:
+            rows = self.db.execute("SELECT id, vec, chunk_ids, created FROM answers WHERE model=? AND embed_model=? AND dim=?",
+                                   (model, embed_model, dim)).fetchall()
+            # dim is checked again on the blob itself, so a stray row can't break the stack
+            rows = [r for r in rows if len(r[1]) == dim * 4]
+            matrix = (np.vstack([np.frombuffer(r[1], dtype=np.float32) for r in rows])
+                      if rows else np.zeros((0, dim), dtype=np.float32))
+            view = (version, [r[0] for r in rows], [r[2] for r in rows],
+                    np.array([r[3] for r in rows], dtype=np.float64), matrix)
+            self._views[key] = view
+        return view[1:]
+
+    @staticmethod
+    def _unit(vec):
+        v = np.asarray(vec, dtype=np.float32)
+        n = float(np.linalg.norm(v))
+        return v / n if n else v
+
+    def _count(self, key: str):
+        self.db.execute("INSERT INTO stats(key, value) VALUES (?, 1) ON CONFLICT(key) DO UPDATE SET value = value + 1", (key,))
+
+    def lookup(self, model: str, embed_model: str, vec, chunk_ids):
+        """Cached answer for a semantically equivalent question over the same chunks, or None.
+
+        Only entries whose question was embedded by embed_model at the same dimension count.
+        """
+        key = json.dumps(list(chunk_ids))
+        with self.lock:
+            ids, chunks, created, matrix = self._view(model, embed_model, len(vec))
+            found = None
+            if ids:
+                sims = matrix @ self._unit(vec)
+                ok = (sims >= self.threshold) & (created >= time.time() - self.ttl)
+                for i in np.flatnonzero(ok)[np.argsort(-sims[ok])]:
+                    if chunks[i] == key:
+                        found = (ids[i], float(sims[i]))
+                        break
+            if found is None:
+                self.misses += 1
+                self._count("misses")
+                self.db.commit()
+                return None
+            row_id, sim = found
+            self.hits += 1
+            self._count("hits")
+            self.db.execute("UPDATE answers SET last_used=?, hits=hits+1 WHERE id=?", (time.time(), row_id))
+            self.db.commit()
+            row = self.db.execute("SELECT answer FROM answers WHERE id=?", (row_id,)).fetchone()
+        return {"answer": row[0], "similarity": round(sim, 4)} if row else None
+
+    def store(self, model: str, embed_model: str, vec, chunk_ids, question: str, answer: str):
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT INTO answers(model, embed_model, dim, vec, chunk_ids, question, answer, created, last_used) "
+                            "VALUES (?,?,?,?,?,?,?,?,?)",
+                            (model, embed_model, len(vec), self._unit(vec).tobytes(), json.dumps(list(chunk_ids)),
+                             question, answer, now, now))
+            self.db.execute("DELETE FROM answers WHERE created < ?", (now - self.ttl,))
+            n = self.db.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            if n > self.max_entries:
+                self.db.execute("DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_used LIMIT ?)",
+                                (n - self.max_entries,))
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            totals = dict(self.db.execute("SELECT key, value FROM stats").fetchall())
+            entries = self.db.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        lookups = totals.get("hits", 0) + totals.get("misses", 0)
+        return {"session_hits": self.hits, "session_misses": self.misses,
+                "hits": totals.get("hits", 0), "misses": totals.get("misses", 0),
+                "hit_rate": round(totals.get("hits", 0) / lookups, 4) if lookups else None,
+                "entries": entries, "threshold": self.threshold}
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM answers")
+            self.db.execute("DELETE FROM stats")
+            self.db.commit()
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """Process-wide cache instance, or None when disabled or the store can't be opened."""
+    global _cache, ENABLED
+    if not ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            try:
+                _cache = AnswerCache()
+            except (OSError, sqlite3.Error) as e:
+                print(json.dumps({"answer_cache_disabled": str(e)}), file=sys.stderr)
+                ENABLED = False
+        return _cache
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(description="Inspect or clear the semantic answer cache")
+    ap.add_argument("action", choices=["stats", "clear"])
+    args = ap.parse_args()
+    cache = AnswerCache()
+    if args.action == "clear":
+        cache.clear()
+    print(json.dumps({"path": str(cache.path), **cache.stats(), "ttl_s": cache.ttl, "max_entries": cache.max_entries}))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+bench.py
+
+Offline benchmark suite. Starts the stand-in servers from standins.py, builds synthetic
+corpora of increasing size and runs, each in a fresh process so peak RSS is per case:
+
+  estimate     estimate_chunks over the corpus directory
+  ingest_file  ingest_one.ingest_file on one file of the given size
+  ingest_dir   ingest_batch.ingest_dir over the same bytes split into --files files
+  retrieve     rag_query.retrieve for --queries synthetic questions (after ingest_dir)
+
+Each result records chunks/sec, requests issued to the stand-ins (per endpoint), bytes
+sent, peak RSS and, for retrieve, latency percentiles. Results go to a JSON file
+(default data/bench/bench-<timestamp>.json); --compare prints ratios against an earlier one.
+Caches are disabled so every run does the same work.
+"""
+import os, sys, json, time, random, resource, subprocess, tempfile, requests
+from dataclasses import asdict
+from pathlib import Path
+
+from split_file import human_size_to_bytes
+from standins import StandIn, StandInConfig
+
+HERE = Path(__file__).resolve().parent
+BENCH_DIR = HERE.parent / "data" / "bench"
+CASES = ("estimate", "ingest_file", "ingest_dir", "retrieve")
+
+def synthetic_text(n_bytes: int, seed: int = 0) -> str:
+    """Deterministic prose-like text of about n_bytes (ASCII) from a fixed pseudo-word vocabulary."""
+    rng = random.Random(seed)
+    letters = "etaoinshrdlucmfwypvbgkqjxz"
+    vocab = ["".join(rng.choice(letters[:12 + i % 14]) for _ in range(rng.randint(2, 10))) for i in range(5000)]
+    out, size = [], 0
+    while size < n_bytes:
+        sentence = " ".join(rng.choice(vocab) for _ in range(rng.randint(6, 20))).capitalize() + "."
+        sentence += "\n\n" if rng.random() < 0.15 else " "
+        out.append(sentence)
+        size += len(sentence)
+    return "".join(out)[:n_bytes]
+
+def build_corpus(root: Path, n_bytes: int, files: int):
+    """root/single.txt plus root/dir/part-NNN.txt holding the same text split across files."""
+    text = synthetic_text(n_bytes)
+    root.mkdir(parents=True, exist_ok=True)
+    (root / "single.txt").write_text(text)
+    d = root / "dir"
+    d.mkdir(exist_ok=True)
+    step = -(-len(text) // files)
+    for i in range(files):
+        (d / f"part-{i:03d}.txt").write_text(text[i * step:(i + 1) * step])
+    return root / "single.txt", d
+
+def peak_rss_mb():
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is bytes on macOS, KiB on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return round(own / 2**20, 1), round(children / 2**20, 1)
+
+def run_case(case: str, args) -> dict:
+    """Child-process side: run one case against OLLAMA_URL/WEAVIATE_URL and return its measurements."""
+    t0 = time.perf_counter()
+    out = {}
+    if case == "estimate":
+        import estimate_chunks as est
+        files = sorted(str(p) for p in Path(args.path).rglob("*") if p.is_file())
+        results = [est.estimate_file(fp) for fp in files]
+        out["chunks"] = sum(r["chunks"] for r in results)
+    elif case == "ingest_file":
+        import ingest_one as one
+        errors = []
+        out["chunks"] = one.ingest_file(Path(args.path), args.batch_size, errors)
+        out["errors"] = len(errors)
+    elif case == "ingest_dir":
+        import ingest_batch
+        errors = []
+        out["chunks"] = ingest_batch.ingest_dir(Path(args.path), quiet=True, batch_size=args.batch_size, errors=errors,
+                                                workers=args.workers)[0]
+        out["errors"] = len(errors)
+    elif case == "retrieve":
+        import rag_query as rq
+        from rag_batch import percentiles
+        words = Path(args.path).read_text().split()
+        rng = random.Random(1)
+        lat = []
+        for _ in range(args.queries):
+            q = " ".join(rng.choice(words) for _ in range(8))
+            t = time.perf_counter()
+            rq.retrieve(q, rq.TOP_K)
+            lat.append(time.perf_counter() - t)
+        out["queries"] = args.queries
+        out["latency_s"] = percentiles(lat)
+    seconds = time.perf_counter() - t0
+    out["seconds"] = round(seconds, 3)
+    if "chunks" in out:
+        out["chunks_per_sec"] = round(out["chunks"] / seconds, 2) if seconds > 0 else None
+    out["peak_rss_mb"], out["children_peak_rss_mb"] = peak_rss_mb()
+    return out
+
+def child(case: str, path: Path, url: str, args, tmp: Path) -> dict:
+    env = {**os.environ, "OLLAMA_URL": url, "WEAVIATE_URL": url, "EMBED_CACHE": "0", "ANSWER_CACHE": "0",
+           "INGEST_MANIFEST": str(tmp / "manifest.json"), "INGEST_STATS": str(tmp / "ingest_stats.json"),
+           "RETRIEVE_BACKEND": "weaviate"}
+    cmd = [sys.executable, str(Path(__file__).resolve()), "--run-case", case, "--path", str(path),
+           "--batch-size", str(args.batch_size), "--workers", str(args.workers), "--queries", str(args.queries)]
+    r = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    if r.returncode != 0:
+        return {"error": (r.stderr or r.stdout).strip().splitlines()[-1:] or [f"exit {r.returncode}"]}
+    return json.loads(r.stdout.strip().splitlines()[-1])
+
+def run_suite(args) -> dict:
+    cfg = StandInConfig(dim=args.dim, embed_ms=args.embed_ms, embed_item_ms=args.embed_item_ms,
+                        batch_ms=args.batch_ms, search_ms=args.search_ms)
+    srv = StandIn(cfg).start()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="rag-bench-") as tmp:
+            tmp = Path(tmp)
+            for size in args.sizes.split(","):
+                n_bytes = human_size_to_bytes(size)
+                single, directory = build_corpus(tmp / size, n_bytes, args.files)
+                for case in args.cases.split(","):
+                    # retrieve searches what ingest_dir wrote; every other case starts from an empty store
+                    requests.post(f"{srv.url}/_reset", json={"objects": case != "retrieve"}).raise_for_status()
+                    if case == "retrieve" and not srv.store.objects:
+                        child("ingest_dir", directory, srv.url, args, tmp)
+                        requests.post(f"{srv.url}/_reset", json={"objects": False}).raise_for_status()
+                    path = single if case in ("ingest_file", "retrieve") else directory
+                    res = child(case, path, srv.url, args, tmp)
+                    stats = requests.get(f"{srv.url}/_stats").json()
+                    res.update({"requests": stats["requests"], "total_requests": stats["total_requests"],
+                                "bytes_sent": stats["bytes_in"], "objects": stats["objects"]})
+                    results.append({"case": case, "size": size, "bytes": n_bytes, **res})
+                    if not args.quiet:
+                        print(json.dumps(results[-1]), file=sys.stderr, flush=True)
+    finally:
+        srv.stop()
+    return {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0], "cpus": os.cpu_count(),
+            "standins": asdict(cfg), "batch_size": args.batch_size, "workers": args.workers, "results": results}
+
+def compare(current: dict, previous: dict):
+    """Ratios current/previous per case and size (>1 means more chunks/sec or higher latency)."""
+    before = {(r["case"], r["size"]): r for r in previous.get("results", [])}
+    out = []
+    for r in current["results"]:
+        old = before.get((r["case"], r["size"]))
+        if not old:
+            continue
+        row = {"case": r["case"], "size": r["size"]}
+        if r.get("chunks_per_sec") and old.get("chunks_per_sec"):
+            row["chunks_per_sec_ratio"] = round(r["chunks_per_sec"] / old["chunks_per_sec"], 3)
+        if (r.get("latency_s") or {}).get("p50") and (old.get("latency_s") or {}).get("p50"):
+            row["latency_p50_ratio"] = round(r["latency_s"]["p50"] / old["latency_s"]["p50"], 3)
+        if r.get("peak_rss_mb") and old.get("peak_rss_mb"):
+            row["peak_rss_ratio"] = round(r["peak_rss_mb"] / old["peak_rss_mb"], 3)
+        row["requests_delta"] = r.get("total_requests", 0) - old.get("total_requests", 0)
+        out.append(row)
+    return out
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(description="Benchmark ingest, estimate and retrieval against local stand-in servers")
+    ap.add_argument("--sizes", default="256KB,1MB,4MB", help="Comma-separated corpus sizes (default: 256KB,1MB,4MB)")
+    ap.add_argument("--cases", default=",".join(CASES), help=f"Comma-separated subset of {','.join(CASES)}")
+    ap.add_argument("--files", type=int, default=8, help="Files the ingest_dir corpus is split into (default: 8)")
+    ap.add_argument("--queries", type=int, default=50, help="Questions for the retrieve case (default: 50)")
+    ap.add_argument("--batch-size", type=int, default=32)
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--dim", type=int, default=768, help="Stand-in embedding dimension (default: 768)")
+    ap.add_argument("--embed-ms", type=float, default=2.0, help="Stand-in latency per embed call")
+    ap.add_argument("--embed-item-ms", type=float, default=0.5, help="Stand-in latency per embedded text")
+    ap.add_argument("--batch-ms", type=float, default=2.0, help="Stand-in latency per batch write")
+    ap.add_argument("--search-ms", type=float, default=2.0, help="Stand-in latency per vector search")
+    ap.add_argument("--out", help="Results JSON (default: data/bench/bench-<timestamp>.json)")
+    ap.add_argument("--compare", help="Earlier results JSON to compare against")
+    ap.add_argument("--quiet", action="store_true", help="Don't print per-case results while running")
+    ap.add_argument("--run-case", choices=CASES, help=argparse.SUPPRESS)
+    ap.add_argument("--path", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args)))
+        return
+
+    report = run_suite(args)
+    out = Path(args.out) if args.out else BENCH_DIR / f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    if args.compare:
+        report["compare"] = {"against": args.compare, "results": compare(report, json.loads(Path(args.compare).read_text()))}
+    out.write_text(json.dumps(report, indent=2))
+    summary = [{k: r.get(k) for k in ("case", "size", "chunks_per_sec", "total_requests", "peak_rss_mb", "latency_s", "error")
+                if r.get(k) is not None} for r in report["results"]]
+    print(json.dumps({"out": str(out), "results": summary, **({"compare": report["compare"]["results"]} if args.compare else {})}))
+
+if __name__ == "__main__":
+    main()
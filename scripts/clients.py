@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+clients.py
+
+Shared client layer for the Ollama and Weaviate HTTP APIs, imported by every script.
+
+  clients.OLLAMA, clients.WEAVIATE            service URLs (OLLAMA_URL / WEAVIATE_URL, else Docker or localhost ports)
+  clients.session()                           the process's pooled requests.Session
+  clients.wait_ready(60)                      readiness polling with exponential backoff
+  clients.warm_up()                           load EMBED_MODEL and GEN_MODEL ahead of the first call
+  clients.embed(texts)                        one /api/embed call, to the least-busy embedding endpoint
+  clients.request("POST", url, "ollama", limiter=clients.limiter("embed"), json=...)
+
+Model residency: every Ollama call passes keep_alive=MODEL_KEEP_ALIVE (default 30m), so the
+models stay loaded between calls. warm_up() loads them up front and reports load time
+separately from request time; Ollama's load_duration on later calls is recorded as the
+"model_load" stage whenever a call had to (re)load its model.
+
+Every call gets a timeout (CLIENT_CONNECT_TIMEOUT / CLIENT_TIMEOUT unless the caller passes
+one) and is retried on transient failures (connection errors, timeouts, 429 and 5xx) with
+full-jitter exponential backoff, honouring Retry-After. Other 4xx responses are returned
+for the caller's raise_for_status(), as are the last response once retries run out.
+
+With a limiter the call first takes a slot from an AIMD (additive-increase,
+multiplicative-decrease) concurrency limit shared by all threads of the process: the
+limit grows by about one per round of successful calls and is cut by BACKOFF whenever a
+call is throttled, fails with 5xx/timeout, or takes more than LATENCY_TOLERANCE times the
+best recent per-item latency (requests queueing inside Ollama show up as latency long
+before errors). Ingest pipelines can therefore run enough threads to reach
+MAX_CONCURRENCY and let the limiter settle near the server's sustainable throughput.
+Set ADAPTIVE_CONCURRENCY=0 to bound concurrency by thread counts alone.
+
+Embedding endpoints: OLLAMA_EMBED_URLS (comma-separated, default OLLAMA) lists Ollama
+instances that serve EMBED_MODEL. Each embed call goes to the live endpoint with the fewest
+requests in flight, and a retry goes to a different one when it can. An endpoint that fails
+EJECT_FAILURES calls in a row (connection errors, timeouts, 5xx) is ejected for
+EMBED_EJECT_SECONDS, doubled on every repeat up to EJECT_MAX_S; once that passes, a single
+call probes it and success puts it back. The embed limiter's maximum scales with the
+number of endpoints. endpoint_stats() reports per-endpoint calls, errors, ejections and
+throughput; the same calls are recorded as "embed@<host>" stages so worker processes'
+numbers reach the parent through metrics.merge().
+"""
+import os, sys, json, time, random, threading
+from collections import deque
+from urllib.parse import urlparse
+
+import requests
+
+import metrics
+
+IN_DOCKER = os.path.exists("/.dockerenv") or os.environ.get("IN_DOCKER") == "1"
+OLLAMA    = os.getenv("OLLAMA_URL") or ("http://ollama:11434"  if IN_DOCKER else f"http://localhost:{os.getenv('OLLAMA_PORT','11434')}")
+WEAVIATE  = os.getenv("WEAVIATE_URL") or ("http://weaviate:8080" if IN_DOCKER else f"http://localhost:{os.getenv('WEAVIATE_PORT','8080')}")
+
+EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
+GEN_MODEL   = os.getenv("GEN_MODEL", "phi3:mini")
+KEEP_ALIVE  = os.getenv("MODEL_KEEP_ALIVE", "30m")   # how long Ollama keeps a model loaded after a call (-1 = forever)
+COLD_LOAD_S = 0.1                                    # load_duration above this means the call loaded the model
+
+RETRIES           = int(os.getenv("CLIENT_RETRIES", "5"))
+BACKOFF_BASE      = float(os.getenv("CLIENT_BACKOFF_BASE", "0.25"))   # seconds, doubled per attempt
+BACKOFF_MAX       = float(os.getenv("CLIENT_BACKOFF_MAX", "10"))
+CONNECT_TIMEOUT   = float(os.getenv("CLIENT_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT      = float(os.getenv("CLIENT_TIMEOUT", "120"))
+RETRY_STATUS      = {429, 500, 502, 503, 504}
+
+ADAPTIVE          = os.getenv("ADAPTIVE_CONCURRENCY", "1") != "0"
+MIN_CONCURRENCY   = int(os.getenv("CLIENT_MIN_CONCURRENCY", "1"))
+INITIAL_CONCURRENCY = int(os.getenv("CLIENT_INITIAL_CONCURRENCY", "2"))
+MAX_CONCURRENCY   = int(os.getenv("CLIENT_MAX_CONCURRENCY", "16"))
+LATENCY_TOLERANCE = float(os.getenv("CLIENT_LATENCY_TOLERANCE", "2.0"))
+BACKOFF           = 0.7    # multiplicative decrease
+
+EMBED_URLS     = [u.strip().rstrip("/") for u in os.getenv("OLLAMA_EMBED_URLS", "").split(",") if u.strip()] or [OLLAMA]
+EMBED_MAX_CONCURRENCY = MAX_CONCURRENCY * len(EMBED_URLS)
+EJECT_FAILURES = int(os.getenv("EMBED_EJECT_FAILURES", "3"))
+EJECT_SECONDS  = float(os.getenv("EMBED_EJECT_SECONDS", "5"))
+EJECT_MAX_S    = 120.0
+
+_session, _session_pid = None, None
+_session_lock = threading.Lock()
+
+def session() -> requests.Session:
+    """The process-wide pooled session; recreated after a fork so pool workers never share sockets."""
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            s = requests.Session()
+            s.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(32, 2 * MAX_CONCURRENCY)))
+            _session, _session_pid = s, os.getpid()
+        return _session
+
+_shared_session = session   # request() takes a `session` argument that shadows the function
+
+READY_CHECKS = {"weaviate": "/v1/.well-known/ready", "ollama": "/api/tags"}
+
+def wait_ready(timeout: float = 60, services=("weaviate", "ollama")) -> bool:
+    """Poll readiness endpoints, backing off from 0.25s to 5s between rounds, until all answer or timeout passes."""
+    base = {"weaviate": WEAVIATE, "ollama": OLLAMA}
+    pending, last_err = list(services), None
+    t0 = time.monotonic()
+    delay = 0.25
+    while True:
+        for name in list(pending):
+            try:
+                session().get(base[name] + READY_CHECKS[name], timeout=2).raise_for_status()
+                pending.remove(name)
+            except requests.RequestException as e:
+                last_err = f"{name}: {e}"
+        if not pending and ("ollama" not in services or len(EMBED_URLS) == 1 or endpoint_pool().check()):
+            metrics.observe("wait_ready", time.monotonic() - t0)
+            return True
+        if time.monotonic() - t0 + delay > timeout:
+            break
+        time.sleep(delay)
+        delay = min(5.0, delay * 2)
+    if not pending:
+        last_err = "no embedding endpoint answers: " + ", ".join(EMBED_URLS)
+    if last_err:
+        print(json.dumps({"last_ready_error": last_err}))
+    return False
+
+class AIMDLimiter:
+    """A concurrency limit that probes upwards until latency or errors say the server is saturated."""
+
+    def __init__(self, name: str, initial: int = INITIAL_CONCURRENCY, minimum: int = MIN_CONCURRENCY,
+                 maximum: int = MAX_CONCURRENCY, tolerance: float = LATENCY_TOLERANCE, window: int = 200):
+        self.name = name
+        self.minimum, self.maximum = max(1, minimum), max(1, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.tolerance = tolerance
+        self.inflight = 0
+        self.samples = deque(maxlen=window)   # recent per-item latencies; their minimum is the no-queueing baseline
+        self.last_decrease = 0.0
+        self.increases = self.decreases = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        t0 = time.perf_counter()
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+        waited = time.perf_counter() - t0
+        if waited > 0.001:
+            metrics.observe(f"wait_{self.name}_slot", waited)
+
+    def release(self, seconds: float, overloaded: bool = False, items: int = 1):
+        with self.cond:
+            self.inflight -= 1
+            per_item = seconds / max(1, items)
+            baseline = min(self.samples) if self.samples else per_item
+            if not overloaded:
+                self.samples.append(per_item)
+            now = time.monotonic()
+            if overloaded or per_item > self.tolerance * baseline:
+                # Calls already in flight saw the same overload; cut at most once per round trip
+                if now - self.last_decrease > seconds:
+                    self.limit = max(self.minimum, self.limit * BACKOFF)
+                    self.last_decrease = now
+                    self.decreases += 1
+            elif self.inflight + 1 >= int(self.limit):
+                # Only grow while the current limit is actually being used
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self.increases += 1
+            self.cond.notify_all()
+        metrics.gauge(f"{self.name}_concurrency_limit", round(self.limit, 2))
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {"limit": round(self.limit, 2), "inflight": self.inflight, "increases": self.increases,
+                    "decreases": self.decreases,
+                    "baseline_ms": round(min(self.samples) * 1000, 2) if self.samples else None}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def limiter(name: str):
+    """The process-wide limiter for one kind of call ("embed", "insert", ...), or None when disabled."""
+    if not ADAPTIVE:
+        return None
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AIMDLimiter(name, maximum=EMBED_MAX_CONCURRENCY if name == "embed" else MAX_CONCURRENCY)
+        return _limiters[name]
+
+def limiter_stats() -> dict:
+    with _limiters_lock:
+        return {name: lim.stats() for name, lim in _limiters.items()}
+
+class Endpoint:
+    def __init__(self, url: str):
+        self.url, self.host = url, urlparse(url).netloc
+        self.inflight = self.calls = self.items = self.errors = self.ejections = 0
+        self.seconds = 0.0
+        self.failures = 0          # consecutive failed calls
+        self.streak = 0            # consecutive ejections (failed probes double the time out)
+        self.ejected_until = 0.0   # monotonic; non-zero until a probe succeeds
+        self.probing = False
+        self.first = self.last = None
+
+    def live(self, now: float) -> bool:
+        return self.ejected_until <= now and not self.probing
+
+class EndpointPool:
+    """Least-outstanding-requests balancing over equivalent endpoints, with passive health ejection."""
+
+    def __init__(self, urls, eject_failures: int = EJECT_FAILURES, eject_seconds: float = EJECT_SECONDS):
+        self.endpoints = [Endpoint(u) for u in urls]
+        self.eject_failures, self.eject_seconds = max(1, eject_failures), eject_seconds
+        self.lock = threading.Lock()
+
+    def acquire(self, avoid: Endpoint = None) -> Endpoint:
+        now = time.monotonic()
+        with self.lock:
+            live = [e for e in self.endpoints if e.live(now)]
+            if avoid is not None and len(live) > 1:
+                live = [e for e in live if e is not avoid]
+            # With everything ejected, try the endpoint due back first rather than fail outright
+            e = min(live, key=lambda e: (e.inflight, e.calls)) if live else min(self.endpoints, key=lambda e: e.ejected_until)
+            if e.ejected_until:
+                e.probing = True
+            e.inflight += 1
+            if e.first is None:
+                e.first = now
+            return e
+
+    def release(self, e: Endpoint, seconds: float, failed: bool, items: int = 1):
+        now = time.monotonic()
+        with self.lock:
+            e.inflight -= 1
+            e.calls += 1
+            e.seconds += seconds
+            e.last = now
+            ejected = False
+            if not failed:
+                e.items += items
+                e.failures, e.streak, e.ejected_until, e.probing = 0, 0, 0.0, False
+            else:
+                e.errors += 1
+                e.failures += 1
+                if e.probing or e.failures >= self.eject_failures:
+                    self._eject(e, now)
+                    ejected = True
+        metrics.observe(f"embed@{e.host}", seconds, 0 if failed else items)
+        if ejected:
+            metrics.count(f"endpoint_ejections:{e.host}")
+
+    def _eject(self, e: Endpoint, now: float):
+        e.ejected_until = now + min(EJECT_MAX_S, self.eject_seconds * 2 ** min(e.streak, 10))
+        e.streak += 1
+        e.ejections += 1
+        e.probing = False
+
+    def alternative(self, e: Endpoint) -> bool:
+        """Whether a retry could go to an endpoint other than e right away."""
+        now = time.monotonic()
+        with self.lock:
+            return any(o is not e and o.live(now) for o in self.endpoints)
+
+    def check(self, timeout: float = 2) -> int:
+        """Probe every endpoint's /api/tags, ejecting the ones that don't answer; returns how many are live."""
+        for e in self.endpoints:
+            try:
+                ok = session().get(e.url + "/api/tags", timeout=timeout).ok
+            except requests.RequestException:
+                ok = False
+            with self.lock:
+                if ok:
+                    e.failures, e.streak, e.ejected_until, e.probing = 0, 0, 0.0, False
+                elif e.live(time.monotonic()):
+                    self._eject(e, time.monotonic())
+        now = time.monotonic()
+        with self.lock:
+            return sum(e.live(now) for e in self.endpoints)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            out = {}
+            for e in self.endpoints:
+                span = (e.last - e.first) if e.first is not None and e.last is not None else 0.0
+                out[e.url] = {"live": e.live(now), "inflight": e.inflight, "calls": e.calls, "items": e.items,
+                              "errors": e.errors, "ejections": e.ejections,
+                              "mean_ms": round(e.seconds / e.calls * 1000, 2) if e.calls else None,
+                              "items_per_sec": round(e.items / span, 2) if span > 0 else None}
+            return out
+
+_pool, _pool_pid = None, None
+
+def endpoint_pool() -> EndpointPool:
+    """The process's pool over EMBED_URLS; recreated after a fork, like session()."""
+    global _pool, _pool_pid
+    with _session_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool, _pool_pid = EndpointPool(EMBED_URLS), os.getpid()
+        return _pool
+
+def endpoint_stats() -> dict:
+    """Per-endpoint embedding stats, or {} with a single endpoint or before this process's first call."""
+    if _pool is None or _pool_pid != os.getpid() or len(EMBED_URLS) == 1:
+        return {}
+    stats = _pool.stats()
+    return stats if any(e["calls"] for e in stats.values()) else {}
+
+def backoff_delay(attempt: int, response=None) -> float:
+    retry_after = (response.headers.get("Retry-After") if response is not None else None) or ""
+    if retry_after.isdigit():
+        return min(BACKOFF_MAX, float(retry_after))
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def request(method: str, url: str, service: str = "", limiter: AIMDLimiter = None, retries: int = None,
+            session=None, items: int = 1, pool: EndpointPool = None, **kw):
+    """metrics.http() with a timeout, jittered retries on transient failures and an optional concurrency slot.
+
+    With a pool, url is a path and each attempt goes to the pool's least-busy live endpoint
+    (a different one from the last attempt's, without a backoff sleep, when one is live).
+    """
+    retries = RETRIES if retries is None else retries
+    session = session or _shared_session()
+    kw.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    endpoint = urlparse(url).path
+    ep = None
+    for attempt in range(retries + 1):
+        r, error = None, None
+        if limiter:
+            limiter.acquire()
+        t0 = time.perf_counter()
+        try:
+            if pool:
+                ep = pool.acquire(avoid=ep)
+            r = metrics.http(method, ep.url + url if pool else url, service=service, session=session, **kw)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        finally:
+            seconds = time.perf_counter() - t0
+            if pool:
+                pool.release(ep, seconds, r is None or r.status_code >= 500, items)
+            if limiter:
+                limiter.release(seconds, r is None or r.status_code in RETRY_STATUS, items)
+        if error is None and r.status_code not in RETRY_STATUS:
+            return r
+        if attempt == retries:
+            if error is not None:
+                raise error
+            return r
+        if r is not None:
+            r.close()
+        metrics.retry(service or urlparse(url).netloc, endpoint, method)
+        if not (pool and pool.alternative(ep)):
+            time.sleep(backoff_delay(attempt, r))
+
+def note_load(model: str, data: dict) -> float:
+    """Record Ollama's load_duration for a call; returns it in seconds."""
+    load_s = (data.get("load_duration") or 0) / 1e9
+    if load_s >= COLD_LOAD_S:
+        metrics.observe("model_load", load_s)
+        metrics.count(f"model_loads:{model}")
+    return load_s
+
+def embed(texts, model: str = EMBED_MODEL, limiter: AIMDLimiter = None):
+    """Vectors for a list of texts from one /api/embed call (per text via /api/embeddings on older Ollama)."""
+    texts = list(texts)
+    pool = endpoint_pool()
+    r = request("POST", "/api/embed", "ollama", limiter=limiter, items=len(texts), pool=pool,
+                json={"model": model, "input": texts, "keep_alive": KEEP_ALIVE})
+    if r.status_code == 404 and "model" not in r.text.lower():
+        vecs = []
+        for text in texts:
+            r = request("POST", "/api/embeddings", "ollama", pool=pool, json={"model": model, "prompt": text, "keep_alive": KEEP_ALIVE})
+            r.raise_for_status()
+            vecs.append(r.json().get("embedding"))
+        return vecs
+    r.raise_for_status()
+    data = r.json()
+    note_load(model, data)
+    vecs = data.get("embeddings") or []
+    if len(vecs) != len(texts):
+        raise ValueError(f"Expected {len(texts)} embeddings, got {len(vecs)}")
+    return vecs
+
+def loaded_models(url: str = OLLAMA) -> dict:
+    """Models Ollama currently holds in memory ({name: expires_at}); empty if /api/ps is unavailable."""
+    try:
+        r = session().get(f"{url}/api/ps", timeout=5)
+        r.raise_for_status()
+    except requests.RequestException:
+        return {}
+    return {m.get("name") or m.get("model"): m.get("expires_at") for m in r.json().get("models") or []}
+
+def _is_loaded(model: str, loaded: dict) -> bool:
+    # /api/ps reports tagged names ("nomic-embed-text:latest")
+    return model in loaded or f"{model}:latest" in loaded
+
+def warm_up(models=None, keep_alive: str = KEEP_ALIVE) -> dict:
+    """Load models into Ollama before the first real call and keep them resident for keep_alive.
+
+    An embed call with empty input (embedding models) or a generate call with an empty
+    prompt (LLMs) loads a model without doing any work. Per model this reports whether it
+    was already loaded, Ollama's load time and the total request time. Embedding models
+    are loaded on every endpoint in OLLAMA_EMBED_URLS, reported as "model@host" when
+    there is more than one.
+    """
+    models = models or [("embed", EMBED_MODEL), ("generate", GEN_MODEL)]
+    targets = []
+    for kind, model in models:
+        for base in (EMBED_URLS if kind == "embed" else [OLLAMA]):
+            key = f"{model}@{urlparse(base).netloc}" if kind == "embed" and len(EMBED_URLS) > 1 else model
+            targets.append((kind, model, base, key))
+    before = {base: loaded_models(base) for base in {t[2] for t in targets}}
+    out = {}
+    for kind, model, base, key in targets:
+        if kind == "embed":
+            url, body = f"{base}/api/embed", {"model": model, "input": "", "keep_alive": keep_alive}
+        else:
+            url, body = f"{base}/api/generate", {"model": model, "prompt": "", "stream": False, "keep_alive": keep_alive}
+        t0 = time.perf_counter()
+        try:
+            r = request("POST", url, "ollama", json=body, timeout=(CONNECT_TIMEOUT, max(READ_TIMEOUT, 600)))
+        except requests.RequestException as e:
+            # One unreachable embedding replica shouldn't stop the others warming up
+            r = None
+            err = f"{type(e).__name__}: {e}"
+        wall = time.perf_counter() - t0
+        res = {"kind": kind, "was_loaded": _is_loaded(model, before[base]), "request_s": round(wall, 3), "keep_alive": keep_alive}
+        if r is None:
+            res["error"] = err
+        elif r.ok:
+            data = r.json()
+            # Older servers omit load_duration on a load-only call; then the whole call was the load
+            load_s = (data.get("load_duration") or 0) / 1e9 or (0.0 if res["was_loaded"] else wall)
+            res["load_s"] = round(load_s, 3)
+            if load_s >= COLD_LOAD_S:
+                metrics.observe("model_load", load_s)
+        else:
+            res["error"] = f"{r.status_code} {r.text[:200]}"
+        metrics.observe("warm_up", wall)
+        out[key] = res
+    return out
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(description="Check service readiness and preload Ollama models")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    rd = sub.add_parser("ready", help="Wait until Weaviate and Ollama answer")
+    rd.add_argument("--timeout", type=float, default=60)
+    wu = sub.add_parser("warm-up", help="Load EMBED_MODEL and GEN_MODEL and keep them resident")
+    wu.add_argument("--timeout", type=float, default=60, help="Readiness timeout before warming up (default: 60)")
+    wu.add_argument("--keep-alive", default=KEEP_ALIVE, help=f"How long Ollama keeps the models loaded (default: {KEEP_ALIVE}; -1 = forever)")
+    wu.add_argument("--embed-model", default=EMBED_MODEL)
+    wu.add_argument("--gen-model", default=GEN_MODEL)
+    args = ap.parse_args()
+    t0 = time.monotonic()
+    ok = wait_ready(args.timeout, ["ollama"] if args.cmd == "warm-up" else ["weaviate", "ollama"])
+    out = {"ready": ok, "ready_s": round(time.monotonic() - t0, 3)}
+    if ok and args.cmd == "warm-up":
+        out["models"] = warm_up([("embed", args.embed_model), ("generate", args.gen_model)], args.keep_alive)
+        out["loaded"] = loaded_models()
+    if len(EMBED_URLS) > 1:
+        out["embed_endpoints"] = {url: e["live"] for url, e in endpoint_pool().stats().items()}
+    print(json.dumps(out))
+    if not ok or any("error" in m for m in out.get("models", {}).values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
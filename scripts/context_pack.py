@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+context_pack.py
+
+Context assembly for rag_query. Retrieval fetches CONTEXT_CANDIDATES × top_k hits; this
+module then
+  1. merges hits of the same document whose text overlaps (the chunker repeats OVERLAP
+     characters between neighbours), or drops hits fully contained in another; hits that
+     carry their offset (see ingest_one.make_objects) are joined exactly by position,
+     older objects by matching the overlapping text,
+  2. ranks the resulting spans by their best (lowest) distance, and
+  3. packs spans in that order until they hold top_k chunks; a token budget derived from
+     num_ctx (room for the prompt template, the question and the answer) is only an upper
+     bound, so merging makes the prompt shorter than top_k separate chunks, never longer.
+
+Tokens are estimated as characters / CHARS_PER_TOKEN; Ollama's prompt_eval_count in
+the generation stats gives the real figure.
+"""
+import os, re, math
+
+from ingest_one import OVERLAP, STEP
+
+NUM_CTX         = int(os.getenv("NUM_CTX", "2048"))
+NUM_PREDICT     = int(os.getenv("NUM_PREDICT", "512"))           # tokens reserved for the answer
+CONTEXT_TOKENS  = int(os.getenv("CONTEXT_TOKENS", "0"))          # explicit context budget (0 = derive from num_ctx)
+CANDIDATES      = int(os.getenv("CONTEXT_CANDIDATES", "3"))      # candidates fetched per requested chunk
+CHARS_PER_TOKEN = float(os.getenv("CHARS_PER_TOKEN", "4"))
+ENABLED         = os.getenv("CONTEXT_PACK", "1") != "0"
+
+WORD = re.compile(r"[a-z0-9]{4,}")
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def candidate_k(top_k: int) -> int:
+    """How many hits to retrieve for a request of top_k chunks."""
+    return top_k * max(1, CANDIDATES) if ENABLED else top_k
+
+def budget(question: str, template_tokens: int = 40) -> int:
+    if CONTEXT_TOKENS:
+        return CONTEXT_TOKENS
+    return max(64, NUM_CTX - NUM_PREDICT - template_tokens - estimate_tokens(question))
+
+def merge_text(a: str, b: str, overlap: int = OVERLAP):
+    """a and b joined on their shared overlap (either order), a if b is inside it, else None."""
+    if b in a:
+        return a
+    if a in b:
+        return b
+    if overlap and len(a) >= overlap and len(b) >= overlap:
+        if a.endswith(b[:overlap]):
+            return a + b[overlap:]
+        if b.endswith(a[:overlap]):
+            return b + a[overlap:]
+    return None
+
+def merge_spans(a: dict, b: dict):
+    """(text, start) of two spans joined, or None; start is None unless both spans know their offset."""
+    same_doc = a["doc_id"] == b["doc_id"] and a["source_path"] == b["source_path"]
+    if same_doc and a["start"] is not None and b["start"] is not None:
+        first, second = sorted((a, b), key=lambda s: s["start"])
+        first_end = first["start"] + len(first["text"])
+        if second["start"] <= first_end:
+            return first["text"] + second["text"][first_end - second["start"]:], first["start"]
+        # Apart in the document; only identical text repeated elsewhere still collapses
+        same_doc = False
+    text = merge_text(a["text"], b["text"], OVERLAP if same_doc else 0)
+    return None if text is None else (text, None)
+
+def merge_hits(hits):
+    """Collapse overlapping hits into spans {doc_id, source_path, start, text, ids, distance, raw_chars}.
+
+    Neighbours are joined only within a document; a chunk whose text is contained in
+    another hit (e.g. the same file ingested twice) is dropped whatever its doc_id.
+    """
+    spans = []
+    for h in sorted(hits, key=lambda h: h.get("distance") if h.get("distance") is not None else math.inf):
+        span = {"doc_id": h.get("doc_id"), "source_path": h.get("source_path"), "start": h.get("offset"),
+                "text": h["chunk"], "ids": [h.get("id")], "distance": h.get("distance"), "raw_chars": len(h["chunk"])}
+        merged = True
+        while merged:
+            # A new or grown span can bridge two spans already collected, so re-scan after every merge
+            merged = False
+            for other in spans:
+                joined = merge_spans(other, span)
+                if joined is not None:
+                    spans.remove(other)
+                    dists = [d for d in (other["distance"], span["distance"]) if d is not None]
+                    span = {"doc_id": other["doc_id"], "source_path": other["source_path"], "start": joined[1],
+                            "text": joined[0], "ids": other["ids"] + span["ids"],
+                            "distance": min(dists) if dists else None,
+                            "raw_chars": other["raw_chars"] + span["raw_chars"]}
+                    merged = True
+                    break
+        spans.append(span)
+    return sorted(spans, key=lambda s: s["distance"] if s["distance"] is not None else math.inf)
+
+def pack(question: str, hits, top_k: int = None, limit: int = None):
+    """Select context for a prompt; returns (context strings, chunk ids used, report).
+
+    At most top_k chunks are packed (a merged span counts each chunk it joins); the token
+    budget, or limit (a session turn only has what its context left over), caps them further.
+    Without packing (CONTEXT_PACK=0) the first top_k hits are used verbatim.
+    """
+    if not ENABLED:
+        used = hits[:top_k] if top_k else hits
+        ctx = [h["chunk"] for h in used]
+        return ctx, [h.get("id") for h in used], {"enabled": False, "candidates": len(hits), "packed": len(used),
+                                                   "context_tokens_est": estimate_tokens("\n\n".join(ctx))}
+    limit = budget(question) if limit is None else limit
+    spans = merge_hits(hits)
+    ctx, ids, used_tokens, dropped, saved = [], [], 0, 0, 0
+    for span in spans:
+        if top_k and len(ids) >= top_k:
+            dropped += 1
+            continue
+        if top_k and len(ids) + len(span["ids"]) > top_k:
+            if ctx:
+                dropped += 1
+                continue
+            # The best span alone joins more than top_k chunks: keep as much text as top_k neighbours hold
+            span = {**span, "text": span["text"][:top_k * STEP + OVERLAP], "ids": span["ids"][:top_k],
+                    "raw_chars": span["raw_chars"] * top_k // len(span["ids"])}
+        need = estimate_tokens(span["text"]) + 1
+        overlap_saved = span["raw_chars"] - len(span["text"])
+        if used_tokens + need > limit:
+            if ctx:
+                dropped += 1
+                continue
+            # Never send an empty context: trim the best span to the budget
+            span = {**span, "text": span["text"][:int(limit * CHARS_PER_TOKEN)]}
+            need = limit
+        saved += overlap_saved
+        ctx.append(span["text"])
+        ids.extend(span["ids"])
+        used_tokens += need
+    return ctx, ids, {
+        "enabled": True, "candidates": len(hits), "spans": len(spans), "merged": len(hits) - len(spans),
+        "packed": len(ctx), "packed_chunks": len(ids), "dropped": dropped,
+        "context_tokens_est": used_tokens, "budget_tokens": limit, "chunk_limit": top_k,
+        "overlap_chars_saved": saved,
+    }
+
+def quality(question: str, answer: str, ctx):
+    """Crude lexical quality signals, comparable across runs of the same question set.
+
+    coverage:  share of question words (4+ chars) found in the packed context
+    grounding: share of answer words (4+ chars) found in the packed context
+    """
+    context_words = set(WORD.findall(" ".join(ctx).lower()))
+    def share(text):
+        words = set(WORD.findall((text or "").lower()))
+        return round(len(words & context_words) / len(words), 3) if words else None
+    return {"coverage": share(question), "grounding": share(answer)}
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+dedup.py
+
+Near-duplicate chunk detection between chunking and embedding. Each chunk gets a MinHash
+signature over its word 3-grams, and an LSH index (the signature cut into bands) finds
+earlier chunks likely to share at least DEDUP_THRESHOLD of those shingles (Jaccard
+similarity). Candidates are confirmed on the full signature. Chunks matching one already
+in the index are not embedded or written:
+
+  DEDUP=off    every chunk is ingested (default)
+  DEDUP=drop   near-duplicates are skipped
+  DEDUP=link   skipped as well, and recorded with the id of the chunk they duplicate
+               (`python dedup.py links --doc-id NAME` lists them)
+
+The index persists in SQLite under data/cache/ and is shared by threads and shard
+processes, so duplicates are found across files and runs. Deleting chunks (incremental
+re-ingestion) removes them from the index, and so does a failed write: chunks admitted
+for a batch that then fails to embed or insert are retracted, so nothing is skipped as a
+duplicate of a chunk that was never stored. If the index has entries while DocChunk is
+empty, e.g. after `make reset`, it is cleared before first use.
+"""
+import os, sys, json, sqlite3, hashlib, threading
+from pathlib import Path
+
+import numpy as np
+
+import metrics
+import schema
+
+DEFAULT_PATH = Path(__file__).resolve().parent.parent / "data" / "cache" / "dedup.sqlite"
+INDEX_PATH   = Path(os.getenv("DEDUP_INDEX_PATH", str(DEFAULT_PATH)))
+MODES        = ("off", "drop", "link")
+MODE         = os.getenv("DEDUP", "off")
+THRESHOLD    = float(os.getenv("DEDUP_THRESHOLD", "0.9"))   # estimated Jaccard similarity of word 3-grams
+
+NUM_PERM = 128
+SHINGLE  = 3
+PRIME    = (1 << 32) - 5   # (a*h + b) stays below 2**64 for 32-bit a, b, h
+_rng = np.random.default_rng(0x5EED)
+_A = _rng.integers(1, PRIME, NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, PRIME, NUM_PERM, dtype=np.uint64)
+
+def shingles(text: str):
+    words = text.split()
+    if len(words) <= SHINGLE:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + SHINGLE]) for i in range(len(words) - SHINGLE + 1)}
+
+def signature(text: str) -> np.ndarray:
+    """MinHash signature: per permutation, the minimum of (a*h + b) mod p over the shingle hashes."""
+    h = np.fromiter((int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little")
+                     for s in shingles(text)), dtype=np.uint64)
+    h %= PRIME
+    return ((np.outer(h, _A) + _B) % PRIME).min(axis=0).astype(np.uint32)
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Share of equal MinHash values, an estimate of the Jaccard similarity."""
+    return float(np.count_nonzero(a == b)) / len(a)
+
+def lsh_params(threshold: float, num_perm: int = NUM_PERM):
+    """(bands, rows): the most rows per band that still makes a pair at `threshold` a candidate with p >= 0.99."""
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows == 0 and 1 - (1 - threshold ** rows) ** (num_perm // rows) >= 0.99:
+            best = (num_perm // rows, rows)
+    return best
+
+def bucket_keys(sig: np.ndarray, rows: int):
+    """One signed 64-bit bucket key per band."""
+    raw = sig.tobytes()
+    width = rows * sig.itemsize
+    return [int.from_bytes(hashlib.blake2b(bytes([b]) + raw[b * width:(b + 1) * width], digest_size=8).digest(),
+                           "little", signed=True) for b in range(len(sig) // rows)]
+
+class DedupIndex:
+    def __init__(self, path: Path = None, threshold: float = None):
+        self.path = Path(path or INDEX_PATH)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.threshold = THRESHOLD if threshold is None else threshold
+        self.bands, self.rows = lsh_params(self.threshold)
+        self.lock = threading.Lock()
+        # Autocommit; admit() runs each batch in one BEGIN IMMEDIATE so shard processes don't interleave
+        self.db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, doc_id TEXT NOT NULL, sig BLOB NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS buckets (bucket INTEGER NOT NULL, id TEXT NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS buckets_bucket ON buckets(bucket)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS buckets_id ON buckets(id)")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS links (
+            id TEXT PRIMARY KEY, doc_id TEXT NOT NULL, offset INTEGER, dup_of TEXT NOT NULL, similarity REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS links_dup_of ON links(dup_of)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._check_layout()
+
+    def _check_layout(self):
+        """Bucket keys depend on rows per band (set by the threshold); rebuild them when it changed."""
+        row = self.db.execute("SELECT value FROM meta WHERE key='rows'").fetchone()
+        if row and int(row[0]) == self.rows:
+            return
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("DELETE FROM buckets")
+            for cid, blob in self.db.execute("SELECT id, sig FROM chunks").fetchall():
+                sig = np.frombuffer(blob, dtype=np.uint32)
+                self.db.executemany("INSERT INTO buckets(bucket, id) VALUES (?,?)", [(k, cid) for k in bucket_keys(sig, self.rows)])
+            self.db.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('rows', ?)", (str(self.rows),))
+            self.db.execute("COMMIT")
+
+    def entries(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def _best_match(self, cid: str, sig: np.ndarray, keys):
+        rows = self.db.execute(f"SELECT DISTINCT id FROM buckets WHERE bucket IN ({','.join('?' * len(keys))})", keys).fetchall()
+        cands = [r[0] for r in rows if r[0] != cid]
+        best = None
+        for i in range(0, len(cands), 500):
+            part = cands[i:i + 500]
+            for other, blob in self.db.execute(f"SELECT id, sig FROM chunks WHERE id IN ({','.join('?' * len(part))})", part):
+                sim = similarity(sig, np.frombuffer(blob, dtype=np.uint32))
+                if sim >= self.threshold and (best is None or sim > best[1]):
+                    best = (other, sim)
+        return best
+
+    def admit(self, did: str, items, link: bool = False):
+        """(keep flags, ids added to the index) for (id, offset, text) items of one document.
+
+        Kept chunks join the index; duplicates of indexed chunks (including earlier items
+        of the same batch) are flagged False and, with `link`, recorded against their match.
+        A chunk whose id is already indexed is a re-ingest of itself and is kept, but not
+        reported as added, so retracting a failed batch leaves its stored original indexed.
+        """
+        sigs = [signature(text) for _, _, text in items]
+        keep, added = [], []
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for (cid, off, _), sig in zip(items, sigs):
+                    keys = bucket_keys(sig, self.rows)
+                    match = self._best_match(cid, sig, keys)
+                    if match is None:
+                        before = self.db.total_changes
+                        self.db.execute("INSERT OR IGNORE INTO chunks(id, doc_id, sig) VALUES (?,?,?)", (cid, did, sig.tobytes()))
+                        if self.db.total_changes > before:
+                            self.db.executemany("INSERT INTO buckets(bucket, id) VALUES (?,?)", [(k, cid) for k in keys])
+                            added.append(cid)
+                        keep.append(True)
+                    else:
+                        if link:
+                            self.db.execute("INSERT OR REPLACE INTO links(id, doc_id, offset, dup_of, similarity) VALUES (?,?,?,?,?)",
+                                            (cid, did, off, match[0], round(match[1], 4)))
+                        keep.append(False)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return keep, added
+
+    def forget(self, ids) -> int:
+        """Remove chunks (and links to or from them) from the index.
+
+        Returns how many linked duplicates lost the chunk they pointed to; their text is
+        no longer stored anywhere until their documents are ingested again.
+        """
+        ids = list(ids)
+        orphaned = 0
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            for i in range(0, len(ids), 500):
+                part = ids[i:i + 500]
+                marks = ",".join("?" * len(part))
+                self.db.execute(f"DELETE FROM chunks WHERE id IN ({marks})", part)
+                self.db.execute(f"DELETE FROM buckets WHERE id IN ({marks})", part)
+                self.db.execute(f"DELETE FROM links WHERE id IN ({marks})", part)
+                orphaned += self.db.execute(f"DELETE FROM links WHERE dup_of IN ({marks})", part).rowcount
+            self.db.execute("COMMIT")
+        return orphaned
+
+    def links(self, doc_id: str = None, limit: int = 100):
+        sql = "SELECT l.id, l.doc_id, l.offset, l.dup_of, c.doc_id, l.similarity FROM links l LEFT JOIN chunks c ON c.id = l.dup_of"
+        args = []
+        if doc_id:
+            sql += " WHERE l.doc_id = ?"
+            args.append(doc_id)
+        with self.lock:
+            rows = self.db.execute(sql + " ORDER BY l.doc_id, l.offset LIMIT ?", (*args, limit)).fetchall()
+        return [{"id": r[0], "doc_id": r[1], "offset": r[2], "dup_of": r[3], "dup_of_doc_id": r[4], "similarity": r[5]} for r in rows]
+
+    def counts(self):
+        with self.lock:
+            return {"entries": self.db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0],
+                    "links": self.db.execute("SELECT COUNT(*) FROM links").fetchone()[0]}
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            for table in ("chunks", "buckets", "links"):
+                self.db.execute(f"DELETE FROM {table}")
+            self.db.execute("COMMIT")
+
+_index, _index_pid = None, None
+_index_lock = threading.Lock()
+
+def get_index():
+    """Process-wide index, or None when dedup is off or the store can't be opened."""
+    global _index, _index_pid, MODE
+    if MODE == "off":
+        return None
+    with _index_lock:
+        # Forked shard workers open their own connection
+        if _index is None or _index_pid != os.getpid():
+            try:
+                index = DedupIndex()
+            except (OSError, sqlite3.Error) as e:
+                print(json.dumps({"dedup_disabled": str(e)}), file=sys.stderr)
+                MODE = "off"
+                return None
+            if _index is None and index.entries():
+                _clear_if_store_empty(index)
+            _index, _index_pid = index, os.getpid()
+        return _index
+
+def _clear_if_store_empty(index: DedupIndex):
+    # Chunks skipped against a wiped class would never be written
+    try:
+        empty = schema.count_objects() == 0
+    except Exception:
+        return
+    if empty:
+        print(json.dumps({"dedup_index_cleared": "DocChunk is empty", "entries": index.entries()}), file=sys.stderr)
+        index.clear()
+
+def admit(did: str, items):
+    """(keep flags, ids added to the index) for (id, offset, text) items; all kept when dedup is off.
+
+    Pass the added ids to retract() if their batch is not stored after all.
+    """
+    index = get_index()
+    if index is None or not items:
+        return [True] * len(items), []
+    with metrics.stage("dedup", items=len(items)):
+        keep, added = index.admit(did, items, link=MODE == "link")
+    skipped = keep.count(False)
+    metrics.count("dedup_checked", len(items))
+    if skipped:
+        metrics.count("dedup_skipped", skipped)
+    return keep, added
+
+def retract(ids):
+    """Take admitted ids back out of the index after their embed or insert failed."""
+    index = get_index()
+    if index is None or not ids:
+        return
+    index.forget(ids)
+    metrics.count("dedup_retracted", len(ids))
+
+def forget(ids):
+    """Drop deleted chunk ids from the index (no-op when dedup is off)."""
+    index = get_index()
+    if index is None or not ids:
+        return 0
+    orphaned = index.forget(ids)
+    if orphaned:
+        metrics.count("dedup_orphaned", orphaned)
+    return orphaned
+
+def stats():
+    """Skip counts for a script's summary (summed over shard processes via metrics), or None when off."""
+    if MODE == "off":
+        return None
+    checked, skipped = metrics.get_counter("dedup_checked"), metrics.get_counter("dedup_skipped")
+    return {"mode": MODE, "threshold": THRESHOLD, "checked": checked, "skipped": skipped,
+            "skip_rate": round(skipped / checked, 4) if checked else None,
+            "orphaned": metrics.get_counter("dedup_orphaned"), **(_index.counts() if _index is not None else {})}
+
+def add_arguments(ap):
+    ap.add_argument("--dedup", choices=MODES, default=MODE,
+                    help=f"Skip near-duplicate chunks before embedding: drop, or link to the stored copy (default: {MODE})")
+    ap.add_argument("--dedup-threshold", type=float, default=THRESHOLD,
+                    help=f"Estimated Jaccard similarity of word 3-grams that counts as a duplicate (default: {THRESHOLD})")
+
+def configure(args):
+    global MODE, THRESHOLD
+    MODE, THRESHOLD = args.dedup, args.dedup_threshold
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(description="Inspect or clear the near-duplicate chunk index")
+    ap.add_argument("action", choices=["stats", "links", "clear"])
+    ap.add_argument("--doc-id", help="With links: only duplicates found in this document")
+    ap.add_argument("--limit", type=int, default=100)
+    args = ap.parse_args()
+    index = DedupIndex()
+    if args.action == "clear":
+        index.clear()
+    if args.action == "links":
+        for row in index.links(args.doc_id, args.limit):
+            print(json.dumps(row))
+        return
+    print(json.dumps({"path": str(index.path), "threshold": index.threshold, "bands": index.bands, "rows": index.rows,
+                      **index.counts(), "size_bytes": index.path.stat().st_size}))
+
+if __name__ == "__main__":
+    main()
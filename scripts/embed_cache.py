@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+embed_cache.py
+
+Persistent, content-addressed embedding cache shared by the ingest and query scripts.
+Entries are keyed by (model, sha256 of whitespace-normalized text) and stored as float32
+blobs in SQLite under data/cache/. The cache is capped by entry count with LRU eviction.
+Disable with EMBED_CACHE=0.
+"""
+import os, sys, json, time, sqlite3, hashlib, threading
+from array import array
+from pathlib import Path
+
+DEFAULT_PATH = Path(__file__).resolve().parent.parent / "data" / "cache" / "embeddings.sqlite"
+CACHE_PATH   = Path(os.getenv("EMBED_CACHE_PATH", str(DEFAULT_PATH)))
+MAX_ENTRIES  = int(os.getenv("EMBED_CACHE_MAX", "2000000"))
+ENABLED      = os.getenv("EMBED_CACHE", "1") != "0"
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(" ".join(text.split()).encode("utf-8")).hexdigest()
+
+class EmbedCache:
+    def __init__(self, path: Path = CACHE_PATH, max_entries: int = MAX_ENTRIES):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+            model TEXT NOT NULL, key TEXT NOT NULL, vec BLOB NOT NULL, last_used REAL NOT NULL,
+            PRIMARY KEY (model, key))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings(last_used)")
+        self.db.commit()
+        self.entries = self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self.hits = self.misses = self.evicted = 0
+
+    def get_many(self, model: str, texts):
+        """Return one vector (or None on miss) per text, refreshing LRU stamps of hits."""
+        keys = [text_key(t) for t in texts]
+        found = {}
+        with self.lock:
+            uniq = list(set(keys))
+            for i in range(0, len(uniq), 500):
+                part = uniq[i:i + 500]
+                rows = self.db.execute(
+                    f"SELECT key, vec FROM embeddings WHERE model=? AND key IN ({','.join('?' * len(part))})",
+                    [model, *part]).fetchall()
+                found.update((k, array("f", v).tolist()) for k, v in rows)
+            if found:
+                now = time.time()
+                self.db.executemany("UPDATE embeddings SET last_used=? WHERE model=? AND key=?",
+                                    [(now, model, k) for k in found])
+                self.db.commit()
+            out = [found.get(k) for k in keys]
+            hits = sum(v is not None for v in out)
+            self.hits += hits
+            self.misses += len(out) - hits
+        return out
+
+    def put_many(self, model: str, texts, vecs):
+        now = time.time()
+        rows = [(model, text_key(t), array("f", v).tobytes(), now) for t, v in zip(texts, vecs) if v is not None]
+        with self.lock:
+            before = self.db.total_changes
+            self.db.executemany("INSERT OR IGNORE INTO embeddings(model, key, vec, last_used) VALUES (?,?,?,?)", rows)
+            self.entries += self.db.total_changes - before
+            if self.entries > self.max_entries:
+                # Evict a little more than needed so we don't evict on every insert
+                n = self.entries - self.max_entries + max(1, self.max_entries // 100)
+                self.db.execute("DELETE FROM embeddings WHERE rowid IN "
+                                "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)", (n,))
+                self.evicted += n
+                self.entries = self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            self.db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else None,
+                "entries": self.entries, "evicted": self.evicted}
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM embeddings")
+            self.db.commit()
+            self.entries = 0
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """Process-wide cache instance, or None when disabled or the store can't be opened."""
+    global _cache, ENABLED
+    if not ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            try:
+                _cache = EmbedCache()
+            except (OSError, sqlite3.Error) as e:
+                print(json.dumps({"embed_cache_disabled": str(e)}), file=sys.stderr)
+                ENABLED = False
+        return _cache
+
+def cached_embed(model: str, texts, embed_fn):
+    """Embed `texts` with `embed_fn(list) -> list`, only sending cache misses to the model."""
+    texts = list(texts)
+    cache = get_cache()
+    if cache is None:
+        return embed_fn(texts)
+    vecs = cache.get_many(model, texts)
+    miss = [i for i, v in enumerate(vecs) if v is None]
+    if miss:
+        fresh = embed_fn([texts[i] for i in miss])
+        for i, v in zip(miss, fresh):
+            vecs[i] = v
+        cache.put_many(model, [texts[i] for i in miss], fresh)
+    return vecs
+
+def stats():
+    return _cache.stats() if _cache is not None else None
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(description="Inspect or clear the persistent embedding cache")
+    ap.add_argument("action", choices=["stats", "clear"])
+    args = ap.parse_args()
+    cache = EmbedCache()
+    if args.action == "clear":
+        cache.clear()
+    by_model = dict(cache.db.execute("SELECT model, COUNT(*) FROM embeddings GROUP BY model").fetchall())
+    print(json.dumps({"path": str(cache.path), "entries": cache.entries, "max_entries": cache.max_entries,
+                      "models": by_model, "size_bytes": cache.path.stat().st_size}))
+
+if __name__ == "__main__":
+    main()
@@ -1,61 +1,115 @@
 #!/usr/bin/env python3
 import os, sys, glob, json, math
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 MAX_LEN = 900
 OVERLAP = 150
 STEP = MAX_LEN - OVERLAP
+READ_BUFFER = 1 << 20  # characters per read
+RUN_STATS_PATH = Path(os.getenv("INGEST_STATS", str(Path(__file__).resolve().parent.parent / "data" / "cache" / "ingest_stats.json")))
+
+def chunks_for_length(L: int) -> int:
+    # The chunker starts a chunk at every multiple of STEP below L (the last one may be a pure overlap tail)
+    return math.ceil(L / STEP)
 
 def estimate_for_text(text: str):
-    norm = " ".join(text.split())
-    L = len(norm)
-    if L == 0:
-        return 0, 0
-    # chunks: 1 if L<=MAX_LEN else 1 + ceil((L - MAX_LEN)/STEP)
-    extra = max(0, L - MAX_LEN)
-    chunks = 1 + (math.ceil(extra / STEP) if extra > 0 else 0)
-    return L, chunks
+    L = len(" ".join(text.split()))
+    return L, chunks_for_length(L)
+
+def normalized_length(fp: Path, buf_size: int = READ_BUFFER) -> int:
+    """len(" ".join(text.split())) computed over fixed-size reads, without building the string."""
+    total, words, carry = 0, 0, ""
+    with open(fp, "r", errors="ignore") as f:
+        while True:
+            buf = f.read(buf_size)
+            if not buf:
+                break
+            buf = carry + buf
+            parts = buf.split()
+            # A word cut by the buffer boundary is finished by the next read
+            carry = parts.pop() if parts and not buf[-1].isspace() else ""
+            total += sum(map(len, parts))
+            words += len(parts)
+    if carry:
+        total += len(carry)
+        words += 1
+    return total + max(0, words - 1)
+
+def estimate_file(fp: str):
+    try:
+        bsize = os.path.getsize(fp)
+    except Exception:
+        bsize = 0
+    try:
+        chars = normalized_length(Path(fp))
+    except Exception:
+        chars = 0
+    return {"file": fp, "size_bytes": bsize, "chars": chars, "chunks": chunks_for_length(chars)}
+
+def project(total_chunks: int, total_chars: int, path: Path = RUN_STATS_PATH):
+    """Project ingest wall time and vector-store size from throughput measured by earlier ingest runs."""
+    try:
+        runs = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return {"error": f"No ingest runs recorded yet in {path}"}
+    runs = [r for r in runs if r.get("chunks") and r.get("seconds")]
+    if not runs:
+        return {"error": f"No ingest runs recorded yet in {path}"}
+    chunks = sum(r["chunks"] for r in runs)
+    rate = chunks / sum(r["seconds"] for r in runs)
+
+    def busy_rate(stage):
+        n = sum(r.get(f"{stage}_chunks") or 0 for r in runs)
+        t = sum(r.get(f"{stage}_seconds") or 0 for r in runs)
+        return n / t if n and t else None
+
+    embed_rate, insert_rate = busy_rate("embed"), busy_rate("insert")
+    dim = next((r["dim"] for r in reversed(runs) if r.get("dim")), 768)
+    avg_chars = total_chars / total_chunks if total_chunks else 0
+    # Rough Weaviate footprint: float32 vector + stored/indexed chunk text + HNSW links (2*maxConnections=64 x 8 bytes)
+    vector_bytes = total_chunks * dim * 4
+    object_bytes = int(total_chunks * (avg_chars * 2 + 200))
+    graph_bytes = total_chunks * 64 * 8
+    return {
+        "based_on_runs": len(runs),
+        "chunks_per_sec": round(rate, 2),
+        "ingest_seconds": round(total_chunks / rate, 1),
+        "embed_chunks_per_sec": round(embed_rate, 2) if embed_rate else None,
+        "embed_seconds_cold": round(total_chunks / embed_rate, 1) if embed_rate else None,
+        "insert_chunks_per_sec": round(insert_rate, 2) if insert_rate else None,
+        "insert_seconds": round(total_chunks / insert_rate, 1) if insert_rate else None,
+        "dim": dim,
+        "vector_store_bytes": vector_bytes + object_bytes + graph_bytes,
+        "vector_bytes": vector_bytes,
+    }
 
 def main():
     import argparse
     ap = argparse.ArgumentParser(description="Estimate chunk counts for a file or directory")
     ap.add_argument("path", nargs="?", default="data/raw", help="File or directory path")
     ap.add_argument("--summary-only", action="store_true", help="Print only totals, omit per-file details")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes used to scan files (default: CPU count)")
+    ap.add_argument("--project", action="store_true", help="Project ingest time and vector-store size from previous ingest runs")
     args = ap.parse_args()
     p = Path(args.path)
     files = []
     if p.is_dir():
-        files = [Path(fp) for fp in glob.glob(f"{p}/**/*", recursive=True) if os.path.isfile(fp)]
+        files = [fp for fp in glob.glob(f"{p}/**/*", recursive=True) if os.path.isfile(fp)]
     elif p.is_file():
-        files = [p]
+        files = [str(p)]
     else:
         print(json.dumps({"error": f"Path not found: {args.path}"}))
         sys.exit(1)
 
-    results = []
-    total_bytes = 0
-    total_chars = 0
-    total_chunks = 0
-
-    for fp in files:
-        try:
-            bsize = fp.stat().st_size
-        except Exception:
-            bsize = 0
-        try:
-            txt = fp.read_text(errors="ignore")
-        except Exception:
-            txt = ""
-        chars, chunks = estimate_for_text(txt)
-        results.append({
-            "file": str(fp),
-            "size_bytes": bsize,
-            "chars": chars,
-            "chunks": chunks,
-        })
-        total_bytes += bsize
-        total_chars += chars
-        total_chunks += chunks
+    if args.workers > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(estimate_file, files, chunksize=max(1, len(files) // (args.workers * 8))))
+    else:
+        results = [estimate_file(fp) for fp in files]
+    total_bytes = sum(r["size_bytes"] for r in results)
+    total_chars = sum(r["chars"] for r in results)
+    total_chunks = sum(r["chunks"] for r in results)
 
     out = {
         "path": str(p),
@@ -67,6 +121,8 @@ def main():
         "overlap": OVERLAP,
         "step": STEP,
     }
+    if args.project:
+        out["projection"] = project(total_chunks, total_chars)
     if not args.summary_only:
         out["details"] = results
     print(json.dumps(out))
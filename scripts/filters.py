@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+filters.py
+
+Scoped retrieval: restrict a query to some documents before the vector search runs.
+
+  s = filters.scope(doc_id=["notes.md"], path_prefix="data/raw/json2txt", since="2024-01-01", until="2024-06-30")
+  filters.where(s)        the Weaviate where filter (REST/JSON shape); None for an empty scope
+  filters.graphql(w)      the same filter as a GraphQL argument value
+  filters.mask(s, cols)   NumPy row mask over local-index columns (see local_index.LocalIndex)
+
+A scope matches chunks whose doc_id is one of `doc_id`, whose source_path starts with
+`path_prefix` (a plain string prefix, so "data/raw/a" also matches "data/raw/ab.txt"; it
+may not contain the wildcards * and ?, which Weaviate's Like cannot escape) and
+whose mtime lies in [since, until]. Dates are ISO 8601 and read as UTC without an offset;
+a date without a time makes `until` cover that whole day. Internally `until` becomes an
+exclusive `before` one second (or one day) later, since mtime has second resolution.
+
+All of these are indexed DocChunk properties (see schema.class_body), so Weaviate applies
+them as a pre-filter: the HNSW search only visits allowed objects, or scans them directly
+when the filter is selective enough.
+"""
+import os, json
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def parse_date(value: str, end: bool = False) -> str:
+    """ISO 8601 date or datetime → RFC 3339 UTC; with end=True, the first second after it."""
+    text = str(value).strip()
+    date_only = len(text) == 10
+    try:
+        dt = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"Not an ISO 8601 date: {value!r}") from None
+    dt = dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+    if end:
+        dt = dt.replace(microsecond=0) + (timedelta(days=1) if date_only else timedelta(seconds=1))
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+WILDCARDS = "*?"
+
+def normalize_prefix(prefix: str) -> str:
+    """A path prefix in the form ingest stores source_path: project-relative when under the project."""
+    p = str(prefix).strip()
+    # Weaviate reads them as Like wildcards and has no escape; the local index would match them literally
+    if any(c in p for c in WILDCARDS):
+        raise ValueError(f"path_prefix cannot contain wildcards ({' '.join(WILDCARDS)}): {prefix!r}")
+    if os.path.isabs(p):
+        # Keep a trailing slash: "data/raw/" must not match "data/raw2"
+        slash = "/" if p.endswith("/") else ""
+        try:
+            rel = Path(p).relative_to(ROOT).as_posix()
+        except ValueError:
+            return Path(p).as_posix() + slash
+        return "" if rel == "." else rel + slash
+    while p.startswith("./"):
+        p = p[2:]
+    return p
+
+def scope(doc_id=None, path_prefix: str = None, since: str = None, until: str = None):
+    """Normalized scope dict, or None when nothing restricts the query."""
+    ids = [doc_id] if isinstance(doc_id, str) else list(doc_id or [])
+    s = {}
+    if ids:
+        s["doc_id"] = sorted(set(ids))
+    if path_prefix:
+        s["path_prefix"] = normalize_prefix(path_prefix)
+    if since:
+        s["since"] = parse_date(since)
+    if until:
+        s["before"] = parse_date(until, end=True)
+    return s or None
+
+def from_dict(d: dict):
+    """Scope from a request body or question line: {"doc_id", "path_prefix", "since", "until"}.
+
+    An already normalized scope (with "before") passes through unchanged.
+    """
+    if not d:
+        return None
+    s = scope(d.get("doc_id"), d.get("path_prefix"), d.get("since"), d.get("until"))
+    if d.get("before"):
+        s = {**(s or {}), "before": parse_date(d["before"])}
+    return s
+
+def where(s: dict):
+    if not s:
+        return None
+    ops = []
+    ids = s.get("doc_id") or []
+    if len(ids) == 1:
+        ops.append({"path": ["doc_id"], "operator": "Equal", "valueText": ids[0]})
+    elif ids:
+        ops.append({"path": ["doc_id"], "operator": "ContainsAny", "valueTextArray": ids})
+    if s.get("path_prefix"):
+        ops.append({"path": ["source_path"], "operator": "Like", "valueText": s["path_prefix"] + "*"})
+    if s.get("since"):
+        ops.append({"path": ["mtime"], "operator": "GreaterThanEqual", "valueDate": s["since"]})
+    if s.get("before"):
+        ops.append({"path": ["mtime"], "operator": "LessThan", "valueDate": s["before"]})
+    if not ops:
+        return None
+    return ops[0] if len(ops) == 1 else {"operator": "And", "operands": ops}
+
+def graphql(value) -> str:
+    """A where filter as a GraphQL input value: unquoted keys, operator names as enums."""
+    if isinstance(value, dict):
+        return "{" + ", ".join(f"{k}: {v if k == 'operator' else graphql(v)}" for k, v in value.items()) + "}"
+    if isinstance(value, list):
+        return "[" + ", ".join(graphql(v) for v in value) + "]"
+    return json.dumps(value)
+
+def mask(s: dict, cols: dict):
+    """Boolean row mask for a scope over columns {"doc_id", "source_path", "mtime"} (NumPy string arrays)."""
+    import numpy as np
+    m = np.ones(len(cols["doc_id"]), dtype=bool)
+    if s.get("doc_id"):
+        m &= np.isin(cols["doc_id"], s["doc_id"])
+    if s.get("path_prefix"):
+        m &= np.char.startswith(cols["source_path"], s["path_prefix"])
+    # Stored mtimes use the same fixed RFC 3339 form, so string order is time order; "" (no mtime) never matches
+    if s.get("since"):
+        m &= (cols["mtime"] != "") & (cols["mtime"] >= s["since"])
+    if s.get("before"):
+        m &= (cols["mtime"] != "") & (cols["mtime"] < s["before"])
+    return m
+
+def add_arguments(ap):
+    g = ap.add_argument_group("scope", "Search only matching chunks (applied before the vector search)")
+    g.add_argument("--doc-id", action="append", default=[], help="Only this doc_id (file name); repeat for several")
+    g.add_argument("--path-prefix", help="Only chunks whose source path starts with this (e.g. data/raw/json2txt/)")
+    g.add_argument("--since", help="Only chunks whose source was modified on/after this ISO date or time (UTC)")
+    g.add_argument("--until", help="Only chunks whose source was modified on/before this ISO date or time (UTC)")
+
+def from_args(args):
+    return scope(args.doc_id, args.path_prefix, args.since, args.until)
@@ -1,56 +1,57 @@
 #!/usr/bin/env python3
-import os, glob, json, time, requests
+import os, glob, json, time
 from pathlib import Path
 
-IN_DOCKER = os.path.exists("/.dockerenv") or os.environ.get("IN_DOCKER") == "1"
-OLLAMA  = "http://ollama:11434"  if IN_DOCKER else f"http://localhost:{os.getenv('OLLAMA_PORT','11434')}"
-WEAVIATE= "http://weaviate:8080" if IN_DOCKER else f"http://localhost:{os.getenv('WEAVIATE_PORT','8080')}"
+import ingest_one as one
+import clients
+import dedup
+import metrics
 
-EMBED_MODEL = os.getenv("EMBED_MODEL","nomic-embed-text")
+OLLAMA, WEAVIATE = clients.OLLAMA, clients.WEAVIATE
+EMBED_MODEL = clients.EMBED_MODEL
 CLASS_NAME  = "DocChunk"  # literal, keep it simple/camel-case
 
 def embed(text):
-    # Only use /api/embed endpoint
-    r = requests.post(f"{OLLAMA}/api/embed", json={"model": EMBED_MODEL, "input": text})
-    if not r.ok:
-        print(f"[embed error] {r.status_code} {r.text}")
-        exit(1)
-    data = r.json()
-    return (data.get("embedding") 
-            or (data.get("embeddings") or [None])[0])
+    # Shared path: embedding cache, timeouts and retries (see clients.py); raises on a persistent error
+    return one.embed(text)
 
-def chunker(text, max_len=900, overlap=150):
-    text = " ".join(text.split())
-    i = 0
-    while i < len(text):
-        yield text[i:i+max_len]
-        i += max_len - overlap
+# The one chunker ingestion uses (ingest_one streams files through the same chunks)
+chunker = one.chunker
 
-def ingest_dir(path="data/raw"):
+def ingest_dir(path="data/raw", batch_size=one.BATCH_SIZE, incremental=False):
     files = [p for p in glob.glob(f"{path}/**/*", recursive=True) if os.path.isfile(p)]
     added = 0
+    errors = []
+    sync = {"unchanged": 0, "changed": 0, "new": 0, "rechecked": 0, "deleted_chunks": 0}
+    manifest = one.load_manifest() if incremental else None
+    t0 = time.perf_counter()
     for fp in files:
-        txt = Path(fp).read_text(errors="ignore")
-        did = Path(fp).name
-        for ch in chunker(txt):
-            vec = embed(ch)
-            obj = {
-                "class": CLASS_NAME,
-                "properties": {"doc_id": did, "chunk": ch, "meta": ""},
-                "vector": vec,
-            }
-            # With AUTOSCHEMA, this first insert will auto-create the class
-            requests.post(f"{WEAVIATE}/v1/objects", json=obj).raise_for_status()
-            added += 1
-    print(json.dumps({"ingested_chunks": added, "files": len(files)}))
+        # Batched embed + /v1/batch/objects; the first batch creates the class from SCHEMA_PROFILE
+        if incremental:
+            res = one.sync_file(Path(fp), manifest, batch_size, errors)
+            sync[res["status"]] += 1
+            sync["deleted_chunks"] += res["deleted"]
+            added += res["upserted"]
+        else:
+            added += one.ingest_file(Path(fp), batch_size, errors)
+    if incremental:
+        sync["deleted_chunks"] += one.prune_missing(manifest, Path(path))
+        one.save_manifest(manifest)
+    one.record_run("ingest", added, time.perf_counter() - t0)
+    print(json.dumps({"ingested_chunks": added, "files": len(files), **({"incremental": sync} if incremental else {}),
+                      "batch_size": batch_size, "errors": errors, **one.throughput(added, time.perf_counter() - t0),
+                      "embed_cache": one.embed_cache.stats(), "dedup": dedup.stats(), "concurrency": clients.limiter_stats() or None,
+                      "embed_endpoints": clients.endpoint_stats() or None,
+                      "metrics": metrics.summary()}))
 
 if __name__ == "__main__":
-    # wait for services
-    for _ in range(60):
-        try:
-            requests.get(f"{WEAVIATE}/v1/.well-known/ready").raise_for_status()
-            requests.get(f"{OLLAMA}/api/tags").raise_for_status()
-            break
-        except Exception:
-            time.sleep(1)
-    ingest_dir()
\ No newline at end of file
+    import argparse
+    ap = argparse.ArgumentParser(description="Ingest data/raw into Weaviate")
+    ap.add_argument("--incremental", action="store_true", help="Skip unchanged files; upsert changed chunks and delete stale ones")
+    dedup.add_arguments(ap)
+    metrics.add_arguments(ap)
+    args = ap.parse_args()
+    dedup.configure(args)
+    metrics.configure(args)
+    clients.wait_ready(60)
+    ingest_dir(incremental=args.incremental)
@@ -1,56 +1,201 @@
 #!/usr/bin/env python3
-import os, sys, json, time, glob
+import os, re, sys, json, time, glob, queue, threading
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 # Reuse single-file ingest and splitting utilities
 import ingest_one as one
+import clients
+import dedup
+import metrics
 from split_file import human_size_to_bytes, split_file
 
-def wait_ready(timeout=60):
-    import requests
-    IN_DOCKER = os.path.exists("/.dockerenv") or os.environ.get("IN_DOCKER") == "1"
-    OLLAMA  = "http://ollama:11434"  if IN_DOCKER else f"http://localhost:{os.getenv('OLLAMA_PORT','11434')}"
-    WEAVIATE= "http://weaviate:8080" if IN_DOCKER else f"http://localhost:{os.getenv('WEAVIATE_PORT','8080')}"
-    last_err = None
-    for _ in range(timeout):
+# Embedding threads; with adaptive concurrency (clients.py) enough of them for the limiter to ramp up to its maximum
+WORKERS    = int(os.getenv("INGEST_WORKERS", str(clients.EMBED_MAX_CONCURRENCY if clients.ADAPTIVE else 4 * len(clients.EMBED_URLS))))
+QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "8"))
+# Shard processes for --virtual: reading and chunking are CPU-bound, and each process has one embed call in flight
+PROCESSES  = int(os.getenv("INGEST_PROCESSES", str(os.cpu_count() or 1)))
+WHITESPACE = re.compile(rb"[ \t\n\r\f\v]")
+
+def run_pipeline(files, batch_size: int = one.BATCH_SIZE, workers: int = WORKERS, queue_size: int = QUEUE_SIZE,
+                 errors: list = None, on_file_done=None, manifest: dict = None, sync: dict = None):
+    """Read/chunk → embed → write, as bounded stages connected by queues.
+
+    One reader thread chunks files into batches, `workers` threads embed them and
+    about half as many writers push them to Weaviate. Bounded queues give
+    backpressure so a slow stage stalls the reader instead of buffering the corpus.
+    The threads bound concurrency from above; the adaptive limiters in clients.py decide
+    how many embed and insert calls are actually in flight.
+    Returns {file: ingested chunk count}; `on_file_done(fp, n)` fires as files finish.
+
+    With a `manifest` the reader diffs each file first (see ingest_one.plan_file):
+    unchanged files never reach the queues, stale chunks are deleted, and manifest
+    entries are only updated for files whose writes all succeeded. Per-status
+    counts are accumulated into `sync`. Unchanged files with dropped near-duplicates
+    are rechecked last, after this run has deleted the chunks they may have duplicated.
+    """
+    workers = max(1, workers)
+    writers = max(1, (workers + 1) // 2)
+    embed_q = queue.Queue(maxsize=max(1, queue_size))
+    write_q = queue.Queue(maxsize=max(1, queue_size))
+    lock = threading.Lock()
+    counts = {fp: 0 for fp in files}
+    pending = {fp: 0 for fp in files}   # batches in flight per file
+    chunked = set()                     # files fully read and queued
+    finished = set()
+    failed = set()
+    entries = {}                        # new manifest entries, committed after the run
+    dropped = {fp: [] for fp in files}  # ids dedup dropped per file
+
+    def fail(fp, e):
+        metrics.count("file_errors")
+        with lock:
+            failed.add(fp)
+            if errors is not None:
+                errors.append({"doc_id": fp.name, "error": str(e)})
+
+    def settle(fp, added=0, batches=0, read_done=False):
+        with lock:
+            counts[fp] += added
+            pending[fp] -= batches
+            if read_done:
+                chunked.add(fp)
+            done = fp in chunked and pending[fp] == 0 and fp not in finished
+            if done:
+                finished.add(fp)
+            n = counts[fp]
+        if done and on_file_done:
+            on_file_done(fp, n)
+
+    def read(fp, plan=None):
         try:
-            # Weaviate readiness
-            r1 = requests.get(f"{WEAVIATE}/v1/.well-known/ready", timeout=2)
-            r1.raise_for_status()
-            # Ollama tags (GET is sufficient for liveness)
-            r2 = requests.get(f"{OLLAMA}/api/tags", timeout=2)
-            r2.raise_for_status()
-            return True
+            items = one.iter_chunks(fp)
+            source = one.source_meta(fp)
+            if manifest is not None:
+                status = plan["status"] if plan else "unchanged"
+                with lock:
+                    sync[status] = sync.get(status, 0) + 1
+                items = plan["upsert"] if plan else []
+                if plan:
+                    entries[fp] = plan["entry"]
+                    if plan["stale"]:
+                        n = one.delete_objects(plan["stale"])
+                        with lock:
+                            sync["deleted_chunks"] = sync.get("deleted_chunks", 0) + n
+            for batch in one.batched(items, max(1, batch_size)):
+                # Single reader thread: near-duplicates are checked in file order before embedding
+                batch, admitted = one.dedup_items(fp.name, batch, dropped[fp])
+                if not batch:
+                    continue
+                with lock:
+                    pending[fp] += 1
+                # Time blocked on a full queue = embedding is the bottleneck
+                with metrics.stage("wait_embed_queue"):
+                    embed_q.put((fp, batch, source, admitted))
         except Exception as e:
-            last_err = str(e)
-            time.sleep(1)
-    if last_err:
-        print(json.dumps({"last_ready_error": last_err}))
-    return False
+            fail(fp, e)
+        settle(fp, read_done=True)
+
+    def reader():
+        if manifest is None:
+            for fp in files:
+                read(fp)
+            return
+        rechecks = []
+        for fp in files:
+            try:
+                plan = one.plan_file(fp, manifest)
+            except Exception as e:
+                fail(fp, e)
+                settle(fp, read_done=True)
+                continue
+            if plan and plan["status"] == "rechecked":
+                rechecks.append((fp, plan))
+            else:
+                read(fp, plan)
+        for fp, plan in rechecks:
+            read(fp, plan)
+
+    def embedder():
+        while (item := embed_q.get()) is not None:
+            fp, batch, source, admitted = item
+            try:
+                objs = one.embed_items(fp.name, batch, source)
+                # Time blocked on a full queue = Weaviate writes are the bottleneck
+                with metrics.stage("wait_write_queue"):
+                    write_q.put((fp, objs, admitted))
+            except Exception as e:
+                one.retract_failed(admitted)
+                fail(fp, e)
+                settle(fp, batches=1)
 
-def ingest_dir(dir_path: Path, pattern: str = "*", recursive: bool = True, quiet: bool = False):
+    def writer():
+        while (item := write_q.get()) is not None:
+            fp, objs, admitted = item
+            try:
+                ok, errs = one.insert_batch(objs)
+                if errs:
+                    one.retract_failed(admitted, errs)
+                    with lock:
+                        failed.add(fp)
+                        if errors is not None:
+                            errors.extend(errs)
+            except Exception as e:
+                ok = 0
+                one.retract_failed(admitted)
+                fail(fp, e)
+            settle(fp, added=ok, batches=1)
+
+    embed_threads = [threading.Thread(target=embedder, daemon=True) for _ in range(workers)]
+    write_threads = [threading.Thread(target=writer, daemon=True) for _ in range(writers)]
+    for t in embed_threads + write_threads:
+        t.start()
+    reader()
+    for _ in embed_threads:
+        embed_q.put(None)
+    for t in embed_threads:
+        t.join()
+    for _ in write_threads:
+        write_q.put(None)
+    for t in write_threads:
+        t.join()
+    if manifest is not None:
+        for fp, entry in entries.items():
+            if fp not in failed:
+                manifest[str(fp.resolve())] = one.manifest_entry(entry, dropped[fp])
+    return counts
+
+def ingest_dir(dir_path: Path, pattern: str = "*", recursive: bool = True, quiet: bool = False,
+               batch_size: int = one.BATCH_SIZE, errors: list = None,
+               workers: int = WORKERS, queue_size: int = QUEUE_SIZE, incremental: bool = False, sync: dict = None):
     files = []
     if recursive:
         files = [Path(p) for p in glob.glob(str(dir_path / "**" / pattern), recursive=True) if os.path.isfile(p)]
     else:
         files = [Path(p) for p in glob.glob(str(dir_path / pattern)) if os.path.isfile(p)]
-    ingested = 0
-    details = []
+    files = sorted(files)
     if not quiet:
         print(f"\n┌──────────────────────────────┐\n│ Ingesting directory (batch)  │\n└──────────────────────────────┘")
         print(f"Path: {dir_path}  Pattern: {pattern}  Recursive: {recursive}")
+        print(f"Workers: {workers}  Queue size: {queue_size}")
         print(f"Found {len(files)} file(s)\n")
-    for fp in sorted(files):
-        if not quiet:
-            print(f"→ Ingesting: {fp}")
-        n = one.ingest_file(fp)
-        ingested += n
-        if not quiet:
-            details.append({"file": str(fp), "chunks": n})
-            print(f"  ✓ Chunks ingested: {n}\n")
+
+    def file_done(fp, n):
+        print(f"✓ {fp}: {n} chunk(s) ingested", flush=True)
+
+    manifest = one.load_manifest() if incremental else None
+    sync = {} if sync is None else sync
+    counts = run_pipeline(files, batch_size, workers, queue_size, errors, None if quiet else file_done, manifest, sync)
+    if incremental:
+        # Files deleted from this directory since the last run lose their chunks too
+        sync["deleted_chunks"] = sync.get("deleted_chunks", 0) + one.prune_missing(manifest, dir_path)
+        one.save_manifest(manifest)
+    ingested = sum(counts.values())
+    details = [{"file": str(fp), "chunks": counts[fp]} for fp in files]
     return ingested, (details if not quiet else None), len(files)
 
-def ingest_split_file(src: Path, size_str: str, out_dir: Path = None, prefix: str = None, quiet: bool = False):
+def ingest_split_file(src: Path, size_str: str, out_dir: Path = None, prefix: str = None, quiet: bool = False,
+                      batch_size: int = one.BATCH_SIZE, errors: list = None, incremental: bool = False, sync: dict = None):
     part_size = human_size_to_bytes(size_str)
     if out_dir is None:
         out_dir = src.parent
@@ -70,34 +215,203 @@ def ingest_split_file(src: Path, size_str: str, out_dir: Path = None, prefix: st
     # Ingest
     ingested = 0
     details = []
+    manifest = one.load_manifest() if incremental else None
+    sync = {} if sync is None else sync
     if not quiet:
         print("Ingesting parts...\n")
     for fp in parts:
         if not quiet:
             print(f"→ Ingesting: {fp}")
-        n = one.ingest_file(fp)
+        if incremental:
+            res = one.sync_file(fp, manifest, batch_size, errors)
+            sync[res["status"]] = sync.get(res["status"], 0) + 1
+            sync["deleted_chunks"] = sync.get("deleted_chunks", 0) + res["deleted"]
+            n = res["upserted"]
+        else:
+            n = one.ingest_file(fp, batch_size, errors)
         ingested += n
         if not quiet:
             details.append({"file": str(fp), "chunks": n})
             print(f"  ✓ Chunks ingested: {n}\n")
+    if incremental:
+        one.save_manifest(manifest)
     return count, ingested, (details if not quiet else None)
 
+def shard_ranges(src: Path, shard_size: int):
+    """Split a file into ~shard_size byte ranges without copying it.
+
+    Each boundary is moved forward to the next ASCII whitespace byte, which can never
+    sit inside a UTF-8 sequence or a word, so shards normalize independently.
+    """
+    size = src.stat().st_size
+    ranges, start = [], 0
+    with src.open("rb") as f:
+        while start < size:
+            end = min(size, start + max(1, shard_size))
+            while end < size:
+                block = os.pread(f.fileno(), 1 << 16, end)
+                m = WHITESPACE.search(block)
+                if m:
+                    end += m.start()
+                    break
+                end += len(block)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def _read_normalized(fd: int, start: int, end: int) -> str:
+    return " ".join(os.pread(fd, end - start, start).decode("utf-8", errors="ignore").split())
+
+def _shard_length(job):
+    src, start, end = job
+    with open(src, "rb") as f:
+        return len(_read_normalized(f.fileno(), start, end))
+
+def _lookahead(fd: int, pos: int, size: int, n: int) -> str:
+    """First n normalized characters of the file from byte `pos` (a whitespace boundary)."""
+    want = n * 4
+    while True:
+        end = min(size, pos + want)
+        text = os.pread(fd, end - pos, pos).decode("utf-8", errors="ignore").split()
+        # A window cut mid-word or mid-character only damages its tail, so keep a margin
+        text = " ".join(text)
+        if end >= size or len(text) > n + 8:
+            return text[:n]
+        want *= 2
+
+def _ingest_shard(job):
+    """Chunk one shard exactly as the whole file would be chunked, then embed and insert it.
+
+    `offset` is where this shard starts in the file's normalized text and `limit` is where
+    the next shard's chunks begin. Chunks starting in [offset, limit) belong to this shard;
+    their tails are stitched from the bytes that follow, so shard edges lose no context.
+    """
+    src, start, end, offset, limit, batch_size = job
+    # Forked workers start with a copy of the parent's metrics; count only this shard's work
+    metrics.reset()
+    size = os.path.getsize(src)
+    with open(src, "rb") as f, metrics.stage("read", items=end - start):
+        text = _read_normalized(f.fileno(), start, end)
+        tail = _lookahead(f.fileno(), end, size, one.MAX_LEN) if end < size else ""
+    if tail and text:
+        text += " " + tail
+    s = -(-offset // one.STEP) * one.STEP
+    items = []
+    with metrics.stage("chunk") as rec:
+        while s < limit:
+            items.append((s, text[s - offset:s - offset + one.MAX_LEN]))
+            s += one.STEP
+        rec["items"] = len(items)
+    errors, dropped = [], []
+    before = one.embed_cache.stats() or {}
+    added = one.ingest_chunks(Path(src).name, items, batch_size, errors, one.source_meta(Path(src)), dropped)
+    after = one.embed_cache.stats()
+    # Pool processes are reused across shards, so report this shard's share of the counters
+    cache = {k: after[k] - before.get(k, 0) for k in ("hits", "misses", "evicted")} if after else None
+    return {"range": [start, end], "chunks": added, "ids": [one.chunk_id(Path(src).name, o, c) for o, c in items],
+            "dropped": dropped, "errors": errors, "embed_cache": cache, "metrics": metrics.snapshot()}
+
+def ingest_virtual_shards(src: Path, size_str: str, quiet: bool = False, batch_size: int = one.BATCH_SIZE,
+                          errors: list = None, processes: int = PROCESSES, incremental: bool = False, sync: dict = None,
+                          cache_stats: dict = None):
+    """Ingest one large file in parallel from byte ranges instead of physical part files.
+
+    A first parallel pass measures each shard's normalized length so every shard knows
+    its global offset; the second pass chunks, embeds and inserts shards in a process pool.
+    Chunk offsets and ids match a whole-file ingest of the same file. Embedding cache
+    counters from the worker processes are summed into `cache_stats`.
+    """
+    ranges = shard_ranges(src, human_size_to_bytes(size_str))
+    sync = {} if sync is None else sync
+    if not quiet:
+        print(f"\n┌──────────────────────────────┐\n│ Sharded ingest (no parts)    │\n└──────────────────────────────┘")
+        print(f"Source: {src}\nShard size: {size_str}\nShards: {len(ranges)}  Processes: {processes}\n")
+    manifest = one.load_manifest() if incremental else None
+    digest = one.file_sha256(src) if incremental else None
+    prev = (manifest or {}).get(str(src.resolve()))
+    if incremental and prev and prev.get("sha256") == digest:
+        if not prev.get("dropped"):
+            sync["unchanged"] = sync.get("unchanged", 0) + 1
+            return len(ranges), 0, ([] if not quiet else None)
+        # Only the near-duplicates dropped last time need another look, not every shard
+        res = one.sync_file(src, manifest, batch_size, errors)
+        sync[res["status"]] = sync.get(res["status"], 0) + 1
+        one.save_manifest(manifest)
+        return len(ranges), res["upserted"], ([] if not quiet else None)
+    if prev:
+        # Chunks of the previous version must not count as copies of the new one
+        dedup.forget(prev.get("ids") or [])
+    # Open the dedup index (and check it against Weaviate) once, before the shard workers fork
+    dedup.get_index()
+    with ProcessPoolExecutor(max_workers=max(1, processes)) as pool:
+        lengths = list(pool.map(_shard_length, [(str(src), a, b) for a, b in ranges]))
+        # Global offset of each shard in the normalized text (shards are joined by one space)
+        offsets, pos, first = [], 0, True
+        for n in lengths:
+            if n and not first:
+                pos += 1
+            offsets.append(pos)
+            if n:
+                pos += n
+                first = False
+        total = pos
+        jobs = []
+        for k, (a, b) in enumerate(ranges):
+            nxt = next((offsets[j] for j in range(k + 1, len(ranges)) if lengths[j]), total)
+            jobs.append((str(src), a, b, offsets[k], nxt if lengths[k] else offsets[k], batch_size))
+        ingested, details, ids, dropped, failed = 0, [], [], [], 0
+        for k, res in enumerate(pool.map(_ingest_shard, jobs)):
+            ingested += res["chunks"]
+            ids.extend(res["ids"])
+            dropped.extend(res["dropped"])
+            failed += len(res["errors"])
+            metrics.merge(res["metrics"])
+            if res["embed_cache"] and cache_stats is not None:
+                for key in ("hits", "misses", "evicted"):
+                    cache_stats[key] = cache_stats.get(key, 0) + res["embed_cache"][key]
+            if errors is not None:
+                errors.extend(res["errors"])
+            if not quiet:
+                details.append({"shard": k, "range": res["range"], "chunks": res["chunks"]})
+                print(f"✓ shard {k} bytes {res['range'][0]}-{res['range'][1]}: {res['chunks']} chunk(s) ingested", flush=True)
+    if incremental:
+        status = "changed" if prev else "new"
+        sync[status] = sync.get(status, 0) + 1
+        entry = one.manifest_entry({"sha256": digest, "doc_id": src.name, "ids": ids}, dropped)
+        # A chunk stored last time and dropped as a near-duplicate now is stale as well
+        stale = set((prev or {}).get("ids") or []) - set(entry["ids"])
+        sync["deleted_chunks"] = sync.get("deleted_chunks", 0) + (one.delete_objects(sorted(stale)) if stale else 0)
+        if not failed:
+            manifest[str(src.resolve())] = entry
+        one.save_manifest(manifest)
+    return len(ranges), ingested, (details if not quiet else None)
+
 def main():
     import argparse
     ap = argparse.ArgumentParser(description="Batch ingestion helper: split large files or ingest a directory.")
     g = ap.add_mutually_exclusive_group(required=True)
     g.add_argument("--file", help="Path to a large text file to split and ingest")
     g.add_argument("--dir", help="Directory to ingest all matching files")
-    ap.add_argument("--size", help="Part size for splitting (e.g., 5MB)")
+    ap.add_argument("--size", help="Part size for splitting, or shard size with --virtual (e.g., 5MB)")
+    ap.add_argument("--virtual", action="store_true", help="With --file: ingest byte-range shards in parallel instead of writing part files")
     ap.add_argument("--out", help="Output directory for parts (defaults to file's directory)")
     ap.add_argument("--prefix", help="Prefix for split parts (defaults to <stem>.part.)")
     ap.add_argument("--pattern", default="*", help="Glob pattern for --dir mode (default: *)")
     ap.add_argument("--no-recursive", action="store_true", help="Do not recurse in --dir mode")
+    ap.add_argument("--batch-size", type=int, default=one.BATCH_SIZE, help=f"Chunks per embed/insert request (default: {one.BATCH_SIZE})")
+    ap.add_argument("--workers", type=int, default=WORKERS, help=f"Embedding threads in --dir mode (default: {WORKERS})")
+    ap.add_argument("--processes", type=int, default=PROCESSES, help=f"Shard processes with --virtual (default: CPU count, {PROCESSES})")
+    ap.add_argument("--queue-size", type=int, default=QUEUE_SIZE, help=f"Max batches buffered between pipeline stages (default: {QUEUE_SIZE})")
+    ap.add_argument("--incremental", action="store_true", help="Skip unchanged files; upsert changed chunks and delete stale ones")
     ap.add_argument("--summary-only", action="store_true", help="Suppress per-file logs and omit detailed results from final JSON")
+    dedup.add_arguments(ap)
+    metrics.add_arguments(ap)
     args = ap.parse_args()
+    dedup.configure(args)
+    metrics.configure(args)
 
     print("Waiting for services (Weaviate & Ollama)...", flush=True)
-    ok = wait_ready(90)
+    ok = clients.wait_ready(90)
     if not ok:
         print("✗ Services not ready. See error above.")
         print(json.dumps({"error": "Services not ready"}))
@@ -105,30 +419,46 @@ def main():
     print("✓ Services ready.\n")
 
     summary = {}
+    errors = []
+    sync = {}
+    cache_stats = {}
+    t0 = time.perf_counter()
     if args.file:
         if not args.size:
             print(json.dumps({"error": "--size is required with --file"}))
             sys.exit(2)
         src = Path(args.file)
         out_dir = Path(args.out) if args.out else None
-        count, ingested, details = ingest_split_file(src, args.size, out_dir, args.prefix, quiet=args.summary_only)
+        if args.virtual:
+            count, ingested, details = ingest_virtual_shards(src, args.size, quiet=args.summary_only,
+                                                             batch_size=args.batch_size, errors=errors, processes=args.processes,
+                                                             incremental=args.incremental, sync=sync, cache_stats=cache_stats)
+        else:
+            count, ingested, details = ingest_split_file(src, args.size, out_dir, args.prefix, quiet=args.summary_only,
+                                                         batch_size=args.batch_size, errors=errors,
+                                                         incremental=args.incremental, sync=sync)
         summary = {
-            "mode": "split-file",
+            "mode": "virtual-shards" if args.virtual else "split-file",
             "file": str(src),
-            "parts": count,
+            ("shards" if args.virtual else "parts"): count,
+            **({"processes": args.processes} if args.virtual else {}),
             "ingested_chunks": ingested,
             **({} if args.summary_only else {"details": details}),
         }
         if not args.summary_only:
-            print(f"Batch completed: parts={count}, total_chunks={ingested}\n")
+            print(f"Batch completed: {'shards' if args.virtual else 'parts'}={count}, total_chunks={ingested}\n")
     else:
         dirp = Path(args.dir)
-        ingested, details, file_count = ingest_dir(dirp, args.pattern, recursive=not args.no_recursive, quiet=args.summary_only)
+        ingested, details, file_count = ingest_dir(dirp, args.pattern, recursive=not args.no_recursive, quiet=args.summary_only,
+                                                   batch_size=args.batch_size, errors=errors,
+                                                   workers=args.workers, queue_size=args.queue_size,
+                                                   incremental=args.incremental, sync=sync)
         summary = {
             "mode": "ingest-dir",
             "dir": str(dirp),
             "pattern": args.pattern,
             "recursive": not args.no_recursive,
+            "workers": args.workers,
             "ingested_chunks": ingested,
             "files": (len(details) if details is not None else file_count),
             **({} if args.summary_only else {"details": details}),
@@ -136,6 +466,16 @@ def main():
         if not args.summary_only and details is not None:
             print(f"Batch completed: files={len(details)}, total_chunks={ingested}\n")
 
+    one.record_run(summary["mode"], summary["ingested_chunks"], time.perf_counter() - t0)
+    if args.incremental:
+        summary["incremental"] = sync
+    summary.update({"batch_size": args.batch_size, "errors": len(errors),
+                    **one.throughput(summary["ingested_chunks"], time.perf_counter() - t0),
+                    "embed_cache": one.embed_cache.stats() or cache_stats or None, "dedup": dedup.stats(),
+                    "concurrency": clients.limiter_stats() or None,
+                    "embed_endpoints": clients.endpoint_stats() or None, "metrics": metrics.summary()})
+    if not args.summary_only:
+        summary["error_details"] = errors
     print(json.dumps(summary))
 
 if __name__ == "__main__":
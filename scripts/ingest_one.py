@@ -1,58 +1,405 @@
 #!/usr/bin/env python3
-import os, json, time, requests
+import os, json, time, uuid, hashlib
+from datetime import datetime, timezone
 from pathlib import Path
 
-IN_DOCKER = os.path.exists("/.dockerenv") or os.environ.get("IN_DOCKER") == "1"
-OLLAMA  = "http://ollama:11434"  if IN_DOCKER else f"http://localhost:{os.getenv('OLLAMA_PORT','11434')}"
-WEAVIATE= "http://weaviate:8080" if IN_DOCKER else f"http://localhost:{os.getenv('WEAVIATE_PORT','8080')}"
+import clients
+import dedup
+import embed_cache
+import metrics
+import schema
 
-EMBED_MODEL = os.getenv("EMBED_MODEL","nomic-embed-text")
+OLLAMA, WEAVIATE = clients.OLLAMA, clients.WEAVIATE
+EMBED_MODEL = clients.EMBED_MODEL
 CLASS_NAME  = "DocChunk"
+BATCH_SIZE  = int(os.getenv("INGEST_BATCH_SIZE", "32"))
+
+def run_stats():
+    """Busy time of the remote stages, saved with each run so estimate_chunks can project ingest time."""
+    out = {}
+    for stage in ("embed", "insert"):
+        out[f"{stage}_calls"], out[f"{stage}_chunks"], out[f"{stage}_seconds"] = metrics.stage_totals(stage)
+    out["dim"] = metrics.get_gauge("dim")
+    return out
 
 def embed(text):
-    r = requests.post(f"{OLLAMA}/api/embed", json={"model": EMBED_MODEL, "input": text})
-    r.raise_for_status()
-    data = r.json()
-    return (data.get("embedding") or (data.get("embeddings") or [None])[0])
+    return embed_batch([text])[0]
+
+def embed_batch(texts):
+    # Only cache misses reach Ollama
+    return embed_cache.cached_embed(EMBED_MODEL, texts, _embed_remote)
+
+def _embed_remote(texts):
+    # /api/embed accepts a list input and returns one vector per item, in order
+    with metrics.stage("embed", items=len(texts)):
+        vecs = clients.embed(texts, EMBED_MODEL, limiter=clients.limiter("embed"))
+    if vecs:
+        metrics.gauge("dim", len(vecs[0]))
+    return vecs
 
-def chunker(text, max_len=900, overlap=150):
+def insert_batch(objs):
+    """Write objects through /v1/batch/objects; return (ok_count, per-object errors)."""
+    schema.ensure_class()
+    with metrics.stage("insert", items=len(objs)):
+        r = clients.request("POST", f"{WEAVIATE}/v1/batch/objects", "weaviate", limiter=clients.limiter("insert"), items=len(objs),
+                            json={"objects": objs})
+        r.raise_for_status()
+    ok, errors = 0, []
+    for i, res in enumerate(r.json() or []):
+        errs = ((res.get("result") or {}).get("errors") or {}).get("error") or []
+        if errs:
+            props = res.get("properties") or objs[i].get("properties") or {}
+            errors.append({"doc_id": props.get("doc_id"), "id": res.get("id") or objs[i].get("id"),
+                           "error": "; ".join(e.get("message", "") for e in errs)})
+        else:
+            ok += 1
+    if errors:
+        metrics.count("insert_errors", len(errors))
+    return ok, errors
+
+MAX_LEN, OVERLAP = 900, 150
+STEP = MAX_LEN - OVERLAP
+
+def chunker(text, max_len=MAX_LEN, overlap=OVERLAP):
     text = " ".join(text.split())
     i = 0
     while i < len(text):
         yield text[i:i+max_len]
         i += max_len - overlap
 
-def ingest_file(fp: Path):
-    txt = fp.read_text(errors="ignore")
-    did = fp.name
+READ_BUFFER = int(os.getenv("INGEST_READ_BUFFER", str(1 << 20)))  # characters per read
+
+def normalized_pieces(fp: Path, buf_size: int = READ_BUFFER):
+    """Yield the file's text normalized like " ".join(text.split()), one buffer at a time.
+
+    A word cut by a buffer boundary is carried into the next read, so memory is
+    bounded by the buffer size (plus the longest single word).
+    """
+    carry, started = "", False
+    with fp.open("r", errors="ignore") as f:
+        while True:
+            with metrics.stage("read") as rec:
+                buf = f.read(buf_size)
+                rec["items"] = len(buf)
+            if not buf:
+                break
+            with metrics.stage("normalize", items=len(buf)):
+                buf = carry + buf
+                words = buf.split()
+                carry = words.pop() if words and not buf[-1].isspace() else ""
+                piece = (" " if started else "") + " ".join(words) if words else ""
+            if piece:
+                yield piece
+                started = True
+    if carry:
+        yield (" " if started else "") + carry
+
+def stream_chunker(fp: Path, max_len=MAX_LEN, overlap=OVERLAP, buf_size: int = READ_BUFFER):
+    """Same chunks as chunker(fp.read_text(errors="ignore")) without loading the file."""
+    step = max_len - overlap
+    window, base, i = "", 0, 0   # window holds normalized text starting at absolute offset `base`
+    for piece in normalized_pieces(fp, buf_size):
+        t0, chunks = time.perf_counter(), []
+        window += piece
+        while i + max_len <= base + len(window):
+            chunks.append(window[i - base:i - base + max_len])
+            i += step
+        # Everything before the next chunk start is never needed again
+        window, base = window[i - base:], i
+        metrics.observe("chunk", time.perf_counter() - t0, len(chunks))
+        yield from chunks
+    t0, chunks, end = time.perf_counter(), [], base + len(window)
+    while i < end:
+        chunks.append(window[i - base:i - base + max_len])
+        i += step
+    metrics.observe("chunk", time.perf_counter() - t0, len(chunks))
+    yield from chunks
+
+def iter_chunks(fp: Path):
+    """(offset, chunk) pairs for a file; offsets are positions in the normalized text."""
+    for i, ch in enumerate(stream_chunker(fp)):
+        yield i * STEP, ch
+
+def verify_stream_chunker(fp: Path, buf_sizes=(1, 7, 4096, READ_BUFFER)):
+    """Compare stream_chunker against the in-memory chunker on one file."""
+    expected = list(chunker(fp.read_text(errors="ignore")))
+    return {str(n): list(stream_chunker(fp, buf_size=n)) == expected for n in buf_sizes}
+
+def batched(items, n):
+    buf = []
+    for it in items:
+        buf.append(it)
+        if len(buf) >= n:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+# Deterministic chunk ids: re-ingesting the same text upserts instead of duplicating
+CHUNK_NS = uuid.UUID("6f1c3e0a-5d43-4b8e-9a57-2f0d8c1b7e21")
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def chunk_id(did: str, offset: int, text: str) -> str:
+    return str(uuid.uuid5(CHUNK_NS, f"{did}:{offset}:{content_hash(text)}"))
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def source_path(fp: Path) -> str:
+    """A file's path as stored on its chunks: relative to the project root when under it, so it
+    reads the same inside the Jupyter container (/home/jovyan/data/...) and on the host."""
+    p = Path(fp).resolve()
+    try:
+        return p.relative_to(ROOT).as_posix()
+    except ValueError:
+        return p.as_posix()
+
+def rfc3339(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def source_meta(fp: Path) -> dict:
+    """Document-level properties for a file's chunks (see make_objects)."""
+    return {"source_path": source_path(fp), "mtime": rfc3339(Path(fp).stat().st_mtime)}
+
+def make_objects(did: str, items, vecs, source: dict = None):
+    """Batch objects for (offset, chunk) items; `source` adds source_path and mtime (see source_meta).
+
+    Offsets are positions in the normalized text and always multiples of STEP, so
+    chunk_index = offset // STEP and a chunk's neighbours are chunk_index ± 1.
+    """
+    return [{
+        "class": CLASS_NAME,
+        "id": chunk_id(did, off, ch),
+        "properties": {"doc_id": did, "chunk": ch, "meta": "", **(source or {}),
+                       "chunk_index": off // STEP, "offset": off, "content_hash": content_hash(ch)},
+        "vector": vec,
+    } for (off, ch), vec in zip(items, vecs)]
+
+def embed_items(did: str, items, source: dict = None):
+    return make_objects(did, items, embed_batch([ch for _, ch in items]), source)
+
+def dedup_items(did: str, items, dropped: list = None):
+    """Drop (offset, chunk) items that near-duplicate an indexed chunk (see dedup.py); unchanged when DEDUP=off.
+
+    Returns (kept items, ids newly admitted to the index); see retract_failed. The ids of
+    dropped items are appended to `dropped`.
+    """
+    ids = [chunk_id(did, off, ch) for off, ch in items]
+    keep, admitted = dedup.admit(did, [(cid, off, ch) for cid, (off, ch) in zip(ids, items)])
+    if dropped is not None:
+        dropped.extend(cid for cid, ok in zip(ids, keep) if not ok)
+    return [it for it, ok in zip(items, keep) if ok], admitted
+
+def retract_failed(admitted, errs=None):
+    """Un-admit chunks that were not stored: all of `admitted`, or only those with an insert error in `errs`."""
+    if errs is not None:
+        failed = {e.get("id") for e in errs}
+        admitted = [cid for cid in admitted if cid in failed]
+    dedup.retract(admitted)
+
+def ingest_chunks(did: str, items, batch_size: int = BATCH_SIZE, errors: list = None, source: dict = None,
+                  dropped: list = None):
+    """Dedup, embed and insert (offset, chunk) items of one document in batches; failed objects go to `errors`.
+
+    Ids of near-duplicates that were not stored go to `dropped`.
+    """
     added = 0
-    for ch in chunker(txt):
-        vec = embed(ch)
-        obj = {
-            "class": CLASS_NAME,
-            "properties": {"doc_id": did, "chunk": ch, "meta": ""},
-            "vector": vec,
-        }
-        requests.post(f"{WEAVIATE}/v1/objects", json=obj).raise_for_status()
-        added += 1
+    for batch in batched(items, max(1, batch_size)):
+        batch, admitted = dedup_items(did, batch, dropped)
+        if not batch:
+            continue
+        try:
+            ok, errs = insert_batch(embed_items(did, batch, source))
+        except BaseException:
+            retract_failed(admitted)
+            raise
+        if errs:
+            retract_failed(admitted, errs)
+        added += ok
+        if errors is not None:
+            errors.extend(errs)
     return added
 
+def ingest_file(fp: Path, batch_size: int = BATCH_SIZE, errors: list = None):
+    return ingest_chunks(fp.name, iter_chunks(fp), batch_size, errors, source_meta(fp))
+
+def delete_objects(ids):
+    """Batch-delete DocChunk objects by id; returns the number deleted."""
+    ids = list(ids)
+    deleted = 0
+    for i in range(0, len(ids), 1000):
+        body = {"match": {"class": CLASS_NAME,
+                          "where": {"path": ["id"], "operator": "ContainsAny", "valueTextArray": ids[i:i + 1000]}}}
+        with metrics.stage("delete", items=len(body["match"]["where"]["valueTextArray"])):
+            r = clients.request("DELETE", f"{WEAVIATE}/v1/batch/objects", "weaviate", json=body)
+            r.raise_for_status()
+        deleted += ((r.json() or {}).get("results") or {}).get("successful", 0)
+    dedup.forget(ids)
+    return deleted
+
+# Incremental mode: a manifest of file content hashes and the chunk ids written for each file.
+# Near-duplicates dedup dropped are listed apart under "dropped": they are not stored, so
+# they are checked again on every run and stored once the chunk they duplicated is gone.
+MANIFEST_PATH = Path(os.getenv("INGEST_MANIFEST", str(Path(__file__).resolve().parent.parent / "data" / "cache" / "ingest_manifest.json")))
+
+def load_manifest(path: Path = MANIFEST_PATH) -> dict:
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(manifest: dict, path: Path = MANIFEST_PATH):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest))
+    os.replace(tmp, path)
+
+def file_sha256(fp: Path) -> str:
+    h = hashlib.sha256()
+    with fp.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def plan_file(fp: Path, manifest: dict):
+    """Diff a file against the manifest without touching the network.
+
+    Returns None when the content hash is unchanged and no chunk of the file was dropped as
+    a near-duplicate, else a dict with the new manifest entry (see manifest_entry), the
+    (offset, chunk) items to upsert and the stale ids to delete. Chunks are streamed and
+    only the ids are held; `upsert` is a generator that reads the file again and yields
+    just the chunks not stored yet (`upserts` counts them). An unchanged file with dropped
+    chunks is planned with status "rechecked": only those chunks go through dedup again.
+    """
+    digest = file_sha256(fp)
+    prev = manifest.get(str(fp.resolve()))
+    unchanged = bool(prev) and prev.get("sha256") == digest
+    if unchanged and not prev.get("dropped"):
+        return None
+    did = fp.name
+    old = set((prev or {}).get("ids") or [])
+    ids, wanted = [], {}                # wanted: offset → id of chunks not stored yet
+    for off, ch in iter_chunks(fp):
+        cid = chunk_id(did, off, ch)
+        ids.append(cid)
+        if cid not in old:
+            wanted[off] = cid
+    keep = set(ids)
+    return {
+        "status": "rechecked" if unchanged else "changed" if prev else "new",
+        "entry": {"sha256": digest, "doc_id": did, "ids": ids},
+        "upsert": upsert_items(fp, did, wanted) if wanted else iter(()),
+        "upserts": len(wanted),
+        "stale": sorted(old - keep),
+    }
+
+def upsert_items(fp: Path, did: str, wanted: dict):
+    """Second pass of plan_file: the (offset, chunk) items at the planned offsets.
+
+    Raises RuntimeError if the file changed since it was planned, so its manifest entry is not committed.
+    """
+    found = 0
+    for off, ch in iter_chunks(fp):
+        cid = wanted.get(off)
+        if cid is None:
+            continue
+        if chunk_id(did, off, ch) != cid:
+            raise RuntimeError(f"{fp} changed while it was being ingested")
+        found += 1
+        yield off, ch
+    if found != len(wanted):
+        raise RuntimeError(f"{fp} changed while it was being ingested")
+
+def manifest_entry(entry: dict, dropped) -> dict:
+    """A planned manifest entry once its chunks are written: `dropped` ids move out of "ids"."""
+    dropped = set(dropped)
+    if not dropped:
+        return entry
+    return {**entry, "ids": [cid for cid in entry["ids"] if cid not in dropped], "dropped": sorted(dropped)}
+
+def sync_file(fp: Path, manifest: dict, batch_size: int = BATCH_SIZE, errors: list = None):
+    """Incrementally ingest one file; the manifest entry is only updated if every write succeeded."""
+    plan = plan_file(fp, manifest)
+    if plan is None:
+        return {"status": "unchanged", "upserted": 0, "deleted": 0}
+    errs, dropped = [], []
+    # An edited chunk must not be skipped as a near-duplicate of the version it replaces
+    dedup.forget(plan["stale"])
+    added = ingest_chunks(fp.name, plan["upsert"], batch_size, errs, source_meta(fp), dropped)
+    deleted = delete_objects(plan["stale"]) if plan["stale"] else 0
+    if errors is not None:
+        errors.extend(errs)
+    if not errs:
+        manifest[str(fp.resolve())] = manifest_entry(plan["entry"], dropped)
+    return {"status": plan["status"], "upserted": added, "deleted": deleted}
+
+def prune_missing(manifest: dict, root: Path):
+    """Delete chunks of manifest files under `root` that no longer exist; returns chunks deleted."""
+    root = str(root.resolve())
+    deleted = 0
+    for path in [p for p in manifest if p.startswith(root + os.sep) and not os.path.exists(p)]:
+        deleted += delete_objects(manifest[path].get("ids") or [])
+        del manifest[path]
+    return deleted
+
+def throughput(chunks: int, seconds: float):
+    return {"seconds": round(seconds, 3), "chunks_per_sec": round(chunks / seconds, 2) if seconds > 0 else None}
+
+RUN_STATS_PATH = Path(os.getenv("INGEST_STATS", str(Path(__file__).resolve().parent.parent / "data" / "cache" / "ingest_stats.json")))
+
+def record_run(mode: str, chunks: int, seconds: float, stats: dict = None, path: Path = RUN_STATS_PATH, keep: int = 20):
+    """Append this run's measured throughput to the run log read by estimate_chunks --project."""
+    if chunks <= 0 or seconds <= 0:
+        return
+    stats = dict(run_stats() if stats is None else stats)
+    try:
+        runs = json.loads(path.read_text())
+    except (OSError, ValueError):
+        runs = []
+    runs.append({"ts": time.time(), "mode": mode, "embed_model": EMBED_MODEL, "chunks": chunks,
+                 "seconds": round(seconds, 3), **{k: (round(v, 3) if isinstance(v, float) else v) for k, v in stats.items()}})
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(runs[-keep:]))
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
 if __name__ == "__main__":
-    import sys
-    if len(sys.argv) < 2:
-        print("Usage: ingest_one.py <file_path>")
-        sys.exit(2)
-    target = Path(sys.argv[1])
+    import argparse
+    ap = argparse.ArgumentParser(description="Ingest a single file into Weaviate")
+    ap.add_argument("file", help="Path to the file to ingest")
+    ap.add_argument("--batch-size", type=int, default=BATCH_SIZE, help=f"Chunks per embed/insert request (default: {BATCH_SIZE})")
+    ap.add_argument("--incremental", action="store_true", help="Skip unchanged content; upsert changed chunks and delete stale ones")
+    ap.add_argument("--verify-chunker", action="store_true", help="Only check that streaming chunking matches in-memory chunking for this file")
+    dedup.add_arguments(ap)
+    metrics.add_arguments(ap)
+    args = ap.parse_args()
+    dedup.configure(args)
+    metrics.configure(args)
+    target = Path(args.file)
     if not target.exists() or not target.is_file():
         print(f"File not found: {target}")
-        sys.exit(1)
-    # wait for services
-    for _ in range(60):
-        try:
-            requests.get(f"{WEAVIATE}/v1/.well-known/ready").raise_for_status()
-            requests.get(f"{OLLAMA}/api/tags").raise_for_status()
-            break
-        except Exception:
-            time.sleep(1)
-    n = ingest_file(target)
-    print(json.dumps({"file": str(target), "ingested_chunks": n}))
+        raise SystemExit(1)
+    if args.verify_chunker:
+        res = verify_stream_chunker(target)
+        print(json.dumps({"file": str(target), "identical": all(res.values()), "by_buffer_size": res}))
+        raise SystemExit(0 if all(res.values()) else 1)
+    clients.wait_ready(60)
+    errors = []
+    t0 = time.perf_counter()
+    sync = {}
+    if args.incremental:
+        manifest = load_manifest()
+        sync = sync_file(target, manifest, args.batch_size, errors)
+        save_manifest(manifest)
+        n = sync.pop("upserted")
+    else:
+        n = ingest_file(target, args.batch_size, errors)
+    record_run("ingest-one", n, time.perf_counter() - t0)
+    print(json.dumps({"file": str(target), "ingested_chunks": n, **sync, "batch_size": args.batch_size,
+                      "errors": errors, **throughput(n, time.perf_counter() - t0),
+                      "embed_cache": embed_cache.stats(), "dedup": dedup.stats(),
+                      "embed_endpoints": clients.endpoint_stats() or None, "metrics": metrics.summary()}))
@@ -4,10 +4,18 @@ json_to_text.py
 
 Extract Q/A text from JSON exports (ChatGPT-like) into plain .md files for ingestion.
 Runs inside the Jupyter container; place inputs under ./data for container access.
+
+--stream parses the top-level array one conversation at a time, so exports larger
+than memory convert; --workers N converts conversations in a process pool; --ingest
+sends the Q/A text straight to the ingest chunker instead of writing .md files.
 """
-import os, sys, json, re
+import os, sys, json, re, time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Tuple, Iterator
+
+import metrics
 
 def sanitize_title(title: str, fallback: str) -> str:
     if not title:
@@ -22,23 +30,44 @@ def parts_to_text(msg: Dict[str, Any]) -> str:
     txt = "\n".join([p for p in parts if isinstance(p, str) and p.strip()])
     return txt.strip()
 
-def extract_messages_from_mapping(mapping: Dict[str, Any]) -> List[Dict[str, Any]]:
-    msgs: List[Dict[str, Any]] = []
-    for node in mapping.values():
-        m = node.get("message")
-        if not m:
-            continue
-        role = ((m.get("author") or {}).get("role") or "").lower()
-        if role in {"tool", "system"}:
-            continue
-        txt = parts_to_text(m)
-        if not txt:
+def node_message(node: Dict[str, Any]) -> Dict[str, Any]:
+    m = (node or {}).get("message")
+    if not m:
+        return None
+    role = ((m.get("author") or {}).get("role") or "").lower()
+    if role in {"tool", "system"}:
+        return None
+    txt = parts_to_text(m)
+    if not txt:
+        return None
+    return {"role": role, "text": txt, "create_time": m.get("create_time")}
+
+def walk_mapping(mapping: Dict[str, Any]) -> List[str]:
+    """Node ids depth-first from the root(s) along children links, in O(nodes).
+
+    Every branch (edited or regenerated turns) is kept and follows its fork point.
+    Nodes not reachable through children links keep their mapping order at the end.
+    """
+    roots = [k for k, n in mapping.items() if (n or {}).get("parent") not in mapping]
+    order, seen = [], set()
+    stack = roots[::-1]
+    while stack:
+        k = stack.pop()
+        if k in seen or k not in mapping:
             continue
-        ct = m.get("create_time")
-        msgs.append({
-            "role": role, "text": txt, "create_time": ct,
-        })
-    # sort by create_time if present; stable fallback is original order
+        seen.add(k)
+        order.append(k)
+        stack.extend(reversed((mapping[k] or {}).get("children") or []))
+    order.extend(k for k in mapping if k not in seen)
+    return order
+
+def extract_messages_from_mapping(mapping: Dict[str, Any]) -> List[Dict[str, Any]]:
+    linked = any(isinstance(n, dict) and ("parent" in n or "children" in n) for n in mapping.values())
+    if linked:
+        msgs = [node_message(mapping[k]) for k in walk_mapping(mapping)]
+        return [m for m in msgs if m]
+    msgs = [m for m in (node_message(n) for n in mapping.values()) if m]
+    # no tree links: sort by create_time if present; stable fallback is original order
     msgs.sort(key=lambda x: (x["create_time"] is None, x["create_time"]))
     return msgs
 
@@ -62,87 +91,247 @@ def pair_qa(messages: List[Dict[str, Any]]) -> List[Tuple[str, str]]:
         pairs.append((pending_q, ""))
     return pairs
 
-def process_conversation(conv: Dict[str, Any], out_dir: Path, index: int) -> Path:
+def render_conversation(conv: Dict[str, Any], index: int) -> Tuple[str, str]:
+    """(file name, markdown) for one conversation, or None when it has no Q/A pairs."""
     title = conv.get("title") or f"conversation_{index:04d}"
     mapping = conv.get("mapping") or {}
     msgs = extract_messages_from_mapping(mapping)
     qa = pair_qa(msgs)
     if not qa:
         return None
-    name = sanitize_title(title, f"conversation_{index:04d}") + ".md"
+    out = [f"# {title}\n\n"]
+    for i, (q, a) in enumerate(qa, 1):
+        out.append(f"## Q{i}\n{q}\n\n")
+        if a:
+            out.append(f"### A{i}\n{a}\n\n")
+    return sanitize_title(title, f"conversation_{index:04d}") + ".md", "".join(out)
+
+def process_conversation(conv: Dict[str, Any], out_dir: Path, index: int) -> Path:
+    rendered = render_conversation(conv, index)
+    if not rendered:
+        return None
+    name, text = rendered
     out_path = out_dir / name
     with out_path.open("w", encoding="utf-8") as w:
-        w.write(f"# {title}\n\n")
-        for i, (q, a) in enumerate(qa, 1):
-            w.write(f"## Q{i}\n{q}\n\n")
-            if a:
-                w.write(f"### A{i}\n{a}\n\n")
+        w.write(text)
     return out_path
 
+def ingest_conversation(conv: Dict[str, Any], index: int, batch_size: int = None, errors: list = None,
+                        source: Dict[str, Any] = None) -> int:
+    """Chunk, embed and insert one conversation's Q/A text without writing it to disk.
+
+    The doc_id is the .md name the conversion would write and chunks come from the same
+    chunker, so the object ids match a convert-then-ingest run of the same export.
+    source_path is the export file, and mtime is the conversation's last update when the
+    export records one, so date-range queries select conversations rather than exports.
+    """
+    import ingest_one as one
+    rendered = render_conversation(conv, index)
+    if not rendered:
+        return 0
+    name, text = rendered
+    items = [(i * one.STEP, ch) for i, ch in enumerate(one.chunker(text))]
+    stamp = conv.get("update_time") or conv.get("create_time")
+    if source is not None and isinstance(stamp, (int, float)):
+        source = {**source, "mtime": one.rfc3339(stamp)}
+    return one.ingest_chunks(name, items, batch_size or one.BATCH_SIZE, errors, source)
+
+def export_conversation(conv: Dict[str, Any], index: int, out_dir: Path = None, ingest: bool = False,
+                        batch_size: int = None, source: Dict[str, Any] = None) -> Dict[str, Any]:
+    """Write and/or ingest one conversation; returns {"written", "chunks", "errors"}."""
+    res = {"written": None, "chunks": 0, "errors": []}
+    if out_dir is not None:
+        p = process_conversation(conv, out_dir, index)
+        res["written"] = str(p) if p else None
+    if ingest:
+        res["chunks"] = ingest_conversation(conv, index, batch_size, res["errors"], source)
+    return res
+
+def _export_job(job) -> Dict[str, Any]:
+    # Pool processes are reused; report only this conversation's metrics
+    metrics.reset()
+    res = export_conversation(*job)
+    res["metrics"] = metrics.snapshot()
+    return res
+
 def load_json(path: Path) -> Any:
     with path.open("r", encoding="utf-8", errors="ignore") as r:
         return json.load(r)
 
+STREAM_BUFFER = int(os.getenv("JSON2TXT_BUFFER", str(1 << 20)))  # characters per read
+SEPARATORS = re.compile(r"[\s,]*")
+SCALAR_ENDS = ",] \t\r\n"
+
+def iter_json_items(path: Path, buf_size: int = STREAM_BUFFER) -> Iterator[Any]:
+    """Yield the elements of a top-level JSON array one at a time.
+
+    Only the current element and one read buffer are held in memory, so multi-GB
+    conversations.json exports convert in bounded memory. A top-level object is
+    yielded whole.
+    """
+    decoder = json.JSONDecoder()
+    with path.open("r", encoding="utf-8", errors="ignore") as r:
+        buf, pos, eof = "", 0, False
+        while not eof and not buf.strip():
+            chunk = r.read(buf_size)
+            buf, eof = buf + chunk, not chunk
+        buf = buf.lstrip()
+        if not buf.startswith("["):
+            yield json.loads(buf + r.read())
+            return
+        pos = 1
+        while True:
+            pos = SEPARATORS.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            obj, end = None, None
+            if pos < len(buf):
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+            # An element cut off by the buffer needs more text. A scalar is complete only once a
+            # delimiter follows it: "1.5e10" cut after "1.5" still decodes, as 1.5
+            if end is None or (not eof and not isinstance(obj, (dict, list))
+                               and (end == len(buf) or buf[end] not in SCALAR_ENDS)):
+                if eof:
+                    raise ValueError(f"{path}: unterminated JSON array")
+                # Grow the read with the pending text so a huge element is re-parsed only O(log n) times
+                chunk = r.read(max(buf_size, len(buf) - pos))
+                buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+                continue
+            yield obj
+            pos = end
+            if pos >= buf_size:
+                buf, pos = buf[pos:], 0
+
 def is_conv_obj(obj: Any) -> bool:
     return isinstance(obj, dict) and ("mapping" in obj or "title" in obj)
 
-def process_file(in_path: Path, out_dir: Path, start_index: int = 1) -> Dict[str, Any]:
-    obj = load_json(in_path)
+def iter_conversations(in_path: Path, stream: bool = False) -> Iterator[Dict[str, Any]]:
+    if stream:
+        items = iter_json_items(in_path)
+    else:
+        obj = load_json(in_path)
+        items = obj if isinstance(obj, list) else [obj]
+    # Unknown shapes are skipped
+    return (item for item in items if is_conv_obj(item))
+
+def bounded_map(pool, fn, jobs, window: int):
+    """pool.map() that keeps at most `window` jobs in flight, so a streamed input is never fully materialized."""
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.submit(fn, job))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+WORKERS = int(os.getenv("JSON2TXT_WORKERS", "1"))
+
+def process_file(in_path: Path, out_dir: Path, start_index: int = 1, stream: bool = False, workers: int = 1,
+                 ingest: bool = False, batch_size: int = None, errors: list = None) -> Dict[str, Any]:
+    """Convert every conversation in one export; with ingest=True the Q/A text goes straight to the chunker.
+
+    out_dir=None skips writing .md files. With workers > 1 conversations are converted
+    (and embedded) in a process pool while the parent keeps parsing.
+    """
     written: List[str] = []
+    chunks = 0
     idx = start_index
-    if isinstance(obj, list):
-        for item in obj:
-            if is_conv_obj(item):
-                p = process_conversation(item, out_dir, idx)
-                if p:
-                    written.append(str(p))
-                idx += 1
-    elif is_conv_obj(obj):
-        p = process_conversation(obj, out_dir, idx)
-        if p:
-            written.append(str(p))
+    source = None
+    if ingest:
+        import ingest_one as one
+        source = one.source_meta(in_path)
+    jobs = ((conv, i, out_dir, ingest, batch_size, source) for i, conv in enumerate(iter_conversations(in_path, stream), start_index))
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        results = bounded_map(pool, _export_job, jobs, workers * 4)
     else:
-        # Unknown shape; skip
-        pass
-    return {"input": str(in_path), "written": written, "next_index": idx}
+        pool, results = None, (export_conversation(*job) for job in jobs)
+    try:
+        for res in results:
+            if res["written"]:
+                written.append(res["written"])
+            chunks += res["chunks"]
+            if errors is not None:
+                errors.extend(res["errors"])
+            if "metrics" in res:
+                metrics.merge(res["metrics"])
+            idx += 1
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    return {"input": str(in_path), "written": written, "conversations": idx - start_index,
+            "chunks": chunks, "next_index": idx}
 
 def main():
     import argparse
+    import dedup
     ap = argparse.ArgumentParser(description="Convert JSON exports (ChatGPT-like) to Q/A markdown files.")
     ap.add_argument("--input", required=True, help="Input file or directory (must be under ./data for container access)")
     ap.add_argument("--out-dir", default="/home/jovyan/data/raw/json2txt", help="Output directory inside container")
     ap.add_argument("--pattern", default="*.json", help="Glob when input is a directory")
+    ap.add_argument("--stream", action="store_true", default=os.getenv("JSON2TXT_STREAM") == "1",
+                    help="Parse the top-level array incrementally instead of loading the whole export")
+    ap.add_argument("--workers", type=int, default=WORKERS, help=f"Conversion processes (default: {WORKERS})")
+    ap.add_argument("--ingest", action="store_true", help="Chunk, embed and insert the Q/A text directly; no .md files are written")
+    ap.add_argument("--batch-size", type=int, default=None, help="Chunks per embed/insert request with --ingest")
+    dedup.add_arguments(ap)
+    metrics.add_arguments(ap)
     args = ap.parse_args()
+    dedup.configure(args)
+    metrics.configure(args)
 
     in_path = Path(args.input)
-    out_dir = Path(args.out_dir)
-    out_dir.mkdir(parents=True, exist_ok=True)
+    out_dir = None if args.ingest else Path(args.out_dir)
+    if out_dir is not None:
+        out_dir.mkdir(parents=True, exist_ok=True)
 
     print("\n┌──────────────────────────────┐\n│ JSON → Text (Q/A extractor)  │\n└──────────────────────────────┘")
-    print(f"Input: {in_path}\nOutput dir: {out_dir}\n")
+    print(f"Input: {in_path}\n" + ("Output: ingest (no .md files)\n" if args.ingest else f"Output dir: {out_dir}\n"))
+
+    if args.ingest:
+        import ingest_one as one
+        import clients
+        if not clients.wait_ready(90):
+            print(json.dumps({"error": "Services not ready"}))
+            sys.exit(1)
+        # Re-asked questions across conversations are the usual duplicates; open the index before workers fork
+        dedup.get_index()
 
     summary = {"processed": [], "total_written": 0}
+    errors = []
     idx = 1
+    t0 = time.perf_counter()
+    files = sorted(in_path.glob(args.pattern)) if in_path.is_dir() else [in_path]
     if in_path.is_dir():
-        files = sorted(in_path.glob(args.pattern))
         print(f"Found {len(files)} json file(s)\n")
-        for fp in files:
-            print(f"→ Processing: {fp}")
-            res = process_file(fp, out_dir, idx)
-            idx = res["next_index"]
-            written = res["written"]
-            summary["processed"].append({"file": str(fp), "written": written})
-            summary["total_written"] += len(written)
-            print(f"  ✓ Wrote {len(written)} file(s)\n")
-    else:
-        print(f"→ Processing: {in_path}")
-        res = process_file(in_path, out_dir, idx)
+    for fp in files:
+        print(f"→ Processing: {fp}")
+        res = process_file(fp, out_dir, idx, stream=args.stream, workers=args.workers,
+                           ingest=args.ingest, batch_size=args.batch_size, errors=errors)
+        idx = res["next_index"]
         written = res["written"]
-        summary["processed"].append({"file": str(in_path), "written": written})
+        summary["processed"].append({"file": str(fp), "written": written, "conversations": res["conversations"],
+                                     **({"chunks": res["chunks"]} if args.ingest else {})})
         summary["total_written"] += len(written)
-        print(f"  ✓ Wrote {len(written)} file(s)\n")
+        if args.ingest:
+            print(f"  ✓ Ingested {res['chunks']} chunk(s) from {res['conversations']} conversation(s)\n")
+        else:
+            print(f"  ✓ Wrote {len(written)} file(s)\n")
 
-    print(f"Batch completed: total_written={summary['total_written']}\n")
+    if args.ingest:
+        summary["ingested_chunks"] = sum(p["chunks"] for p in summary["processed"])
+        seconds = time.perf_counter() - t0
+        one.record_run("json-ingest", summary["ingested_chunks"], seconds)
+        summary.update({"workers": args.workers, "errors": len(errors), "error_details": errors,
+                        **one.throughput(summary["ingested_chunks"], seconds), "dedup": dedup.stats(),
+                        "embed_endpoints": clients.endpoint_stats() or None, "metrics": metrics.summary()})
+        print(f"Batch completed: ingested_chunks={summary['ingested_chunks']}\n")
+    else:
+        print(f"Batch completed: total_written={summary['total_written']}\n")
     print(json.dumps(summary))
 
 if __name__ == "__main__":
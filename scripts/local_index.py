@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+local_index.py
+
+Offline, in-process vector index for retrieval without Weaviate.
+
+`export` pages through DocChunk with Weaviate's cursor API and writes a new version
+directory v<timestamp>/ holding:
+  vectors.f32   row-major float32 matrix of unit-normalized vectors (memory-mapped at query time)
+  meta.jsonl    one {"id", "doc_id", "chunk", "source_path", "chunk_index", "offset", "mtime"} line per row
+  meta.idx      int64 byte offsets of each meta.jsonl line, for random access
+and, with --ivf N, an IVF coarse quantizer (k-means centroids plus inverted lists).
+index.json (header: rows, dim, optional IVF settings, version) is replaced last, so a
+reader opens either the previous export or the complete new one, never a mix. The previous
+version is kept for readers that opened it just before the switch; older ones are removed.
+get_index() notices a replaced index.json, so a long-running server searches the new export
+from its next query on.
+
+Top-k is a vectorized NumPy dot product over the matrix, or over the `nprobe` closest
+IVF lists. rag_query uses it when RETRIEVE_BACKEND=local (or =auto while Weaviate is
+unavailable). `recall` measures agreement with Weaviate's nearVector results.
+
+A scoped search (see filters.py) masks rows on the doc_id, source_path and mtime columns,
+read once from meta.jsonl on first use, and scans only the allowed rows exactly.
+"""
+import os, sys, json, time, shutil, threading
+from pathlib import Path
+
+import numpy as np
+
+import clients
+import filters
+import metrics
+
+WEAVIATE  = clients.WEAVIATE
+CLASS_NAME = "DocChunk"
+INDEX_DIR  = Path(os.getenv("LOCAL_INDEX_DIR", str(Path(__file__).resolve().parent.parent / "data" / "index")))
+NPROBE     = int(os.getenv("LOCAL_INDEX_NPROBE", "8"))
+
+def iter_objects(page_size: int = 500, include_vector: bool = True, class_name: str = CLASS_NAME):
+    """Yield every object of a class using the cursor API (`after` = last seen id)."""
+    after = None
+    while True:
+        params = {"class": class_name, "limit": page_size}
+        if include_vector:
+            params["include"] = "vector"
+        if after:
+            params["after"] = after
+        r = clients.request("GET", f"{WEAVIATE}/v1/objects", "weaviate", params=params)
+        r.raise_for_status()
+        objs = r.json().get("objects") or []
+        if not objs:
+            return
+        yield from objs
+        after = objs[-1]["id"]
+
+def _unit_rows(m: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return m / norms
+
+def kmeans(x: np.ndarray, k: int, iters: int = 20, sample: int = 100_000, seed: int = 0):
+    """Spherical k-means on (a sample of) unit rows; returns unit centroids."""
+    rng = np.random.default_rng(seed)
+    if len(x) > sample:
+        x = x[rng.choice(len(x), sample, replace=False)]
+    x = np.asarray(x, dtype=np.float32)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        for c in range(k):
+            members = x[assign == c]
+            # Re-seed empty clusters with a random point
+            centroids[c] = members.sum(axis=0) if len(members) else x[rng.integers(len(x))]
+        centroids = _unit_rows(centroids)
+    return centroids
+
+def build_ivf(out_dir: Path, vectors: np.ndarray, nlist: int, batch: int = 65536):
+    nlist = max(1, min(nlist, len(vectors)))
+    centroids = kmeans(vectors, nlist)
+    assign = np.concatenate([np.argmax(vectors[i:i + batch] @ centroids.T, axis=1)
+                             for i in range(0, len(vectors), batch)]) if len(vectors) else np.zeros(0, dtype=np.int64)
+    order = np.argsort(assign, kind="stable").astype(np.int64)
+    offsets = np.searchsorted(assign[order], np.arange(nlist + 1)).astype(np.int64)
+    np.save(out_dir / "ivf_centroids.npy", centroids.astype(np.float32))
+    np.save(out_dir / "ivf_rows.npy", order)
+    np.save(out_dir / "ivf_offsets.npy", offsets)
+    return nlist
+
+META_KEYS = ("source_path", "chunk_index", "offset", "mtime")
+
+DATA_FILES = ("vectors.f32", "meta.jsonl", "meta.idx", "ivf_centroids.npy", "ivf_rows.npy", "ivf_offsets.npy")
+
+def read_header(out_dir: Path):
+    try:
+        return json.loads((out_dir / "index.json").read_text())
+    except (OSError, ValueError):
+        return None
+
+def prune_versions(out_dir: Path, keep):
+    """Remove export versions not in `keep` (None stands for a pre-versioning export at the top level)."""
+    for d in out_dir.glob("v[0-9]*"):
+        if d.is_dir() and d.name not in keep:
+            shutil.rmtree(d, ignore_errors=True)
+    if None not in keep:
+        for name in DATA_FILES:
+            (out_dir / name).unlink(missing_ok=True)
+
+def export(out_dir: Path = INDEX_DIR, page_size: int = 500, ivf: int = 0):
+    """Dump DocChunk vectors + metadata from Weaviate into a new version of a local index directory."""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    previous = read_header(out_dir)
+    version = f"v{time.time_ns()}"
+    data = out_dir / version
+    data.mkdir()
+    rows, dim = 0, None
+    with metrics.stage("export") as rec, (data / "vectors.f32").open("wb") as fv, \
+            (data / "meta.jsonl").open("wb") as fm, (data / "meta.idx").open("wb") as fi:
+        for obj in iter_objects(page_size):
+            vec = obj.get("vector")
+            if not vec:
+                continue
+            v = np.asarray(vec, dtype=np.float32)
+            if dim is None:
+                dim = len(v)
+            if len(v) != dim:
+                continue
+            n = float(np.linalg.norm(v))
+            fv.write((v / n if n else v).tobytes())
+            props = obj.get("properties") or {}
+            fi.write(np.int64(fm.tell()).tobytes())
+            meta = {"id": obj["id"], "doc_id": props.get("doc_id"), "chunk": props.get("chunk", "")}
+            meta.update({k: props[k] for k in META_KEYS if props.get(k) is not None})
+            if meta.get("mtime"):
+                meta["mtime"] = filters.parse_date(meta["mtime"])
+            fm.write((json.dumps(meta) + "\n").encode("utf-8"))
+            rows += 1
+        rec["items"] = rows
+    header = {"rows": rows, "dim": dim or 0, "class": CLASS_NAME, "created": time.time(), "ivf": None, "version": version}
+    if ivf and rows:
+        vectors = np.memmap(data / "vectors.f32", dtype=np.float32, mode="r", shape=(rows, dim))
+        with metrics.stage("ivf", items=rows):
+            header["ivf"] = {"nlist": build_ivf(data, vectors, ivf)}
+    # Switch readers over only once every data file is complete
+    tmp = out_dir / "index.json.tmp"
+    tmp.write_text(json.dumps(header))
+    os.replace(tmp, out_dir / "index.json")
+    prune_versions(out_dir, {version, (previous or {}).get("version")} if previous else {version})
+    return header
+
+class LocalIndex:
+    def __init__(self, path: Path = INDEX_DIR):
+        self.path = Path(path)
+        self.header = json.loads((self.path / "index.json").read_text())
+        # Exports from before versioning keep their files next to index.json
+        data = self.path / self.header["version"] if self.header.get("version") else self.path
+        self.rows, self.dim = self.header["rows"], self.header["dim"]
+        self.vectors = (np.memmap(data / "vectors.f32", dtype=np.float32, mode="r", shape=(self.rows, self.dim))
+                        if self.rows else np.zeros((0, self.dim), dtype=np.float32))
+        self.offsets = np.fromfile(data / "meta.idx", dtype=np.int64)
+        self.meta = (data / "meta.jsonl").open("rb")
+        self.lock = threading.Lock()  # guards the shared meta.jsonl handle (query server threads)
+        self._columns = None
+        self._masks = {}              # scope → allowed rows, for repeated scoped queries
+        self.ivf = None
+        if self.header.get("ivf"):
+            self.ivf = (np.load(data / "ivf_centroids.npy"), np.load(data / "ivf_rows.npy"),
+                        np.load(data / "ivf_offsets.npy"))
+
+    def _meta(self, row: int) -> dict:
+        with self.lock:
+            self.meta.seek(int(self.offsets[row]))
+            line = self.meta.readline()
+        return json.loads(line)
+
+    def columns(self) -> dict:
+        """doc_id, source_path and mtime of every row as NumPy string arrays ("" when missing)."""
+        with self.lock:
+            if self._columns is None:
+                cols = {"doc_id": [], "source_path": [], "mtime": []}
+                self.meta.seek(0)
+                for line in self.meta:
+                    m = json.loads(line)
+                    for k, v in cols.items():
+                        v.append(m.get(k) or "")
+                self._columns = {k: np.array(v, dtype=str) for k, v in cols.items()}
+            return self._columns
+
+    def scope_rows(self, scope: dict) -> np.ndarray:
+        key = json.dumps(scope, sort_keys=True)
+        rows = self._masks.get(key)
+        if rows is None:
+            with metrics.stage("scope_mask", items=self.rows):
+                rows = np.flatnonzero(filters.mask(scope, self.columns()))
+            if len(self._masks) >= 64:
+                self._masks.clear()
+            self._masks[key] = rows
+        return rows
+
+    def search_rows(self, vec, top_k: int = 5, nprobe: int = NPROBE, scope: dict = None):
+        """(row indices, cosine similarities) of the top_k rows, best first."""
+        q = np.asarray(vec, dtype=np.float32)
+        n = float(np.linalg.norm(q))
+        q = q / n if n else q
+        if scope:
+            # Pre-filter: an exact scan of the allowed rows (IVF lists could hold too few of them)
+            rows = self.scope_rows(scope)
+            scores = self.vectors[rows] @ q if len(rows) else np.zeros(0, dtype=np.float32)
+        elif self.ivf is not None and nprobe < len(self.ivf[0]):
+            centroids, order, offsets = self.ivf
+            lists = np.argpartition(-(centroids @ q), nprobe - 1)[:nprobe]
+            rows = np.concatenate([order[offsets[c]:offsets[c + 1]] for c in lists])
+            rows.sort()  # sequential access into the memmap
+            scores = self.vectors[rows] @ q
+        else:
+            rows, scores = None, self.vectors @ q
+        k = min(top_k, len(scores))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return (rows[best] if rows is not None else best), scores[best]
+
+    def search(self, vec, top_k: int = 5, nprobe: int = NPROBE, scope: dict = None):
+        """Hits shaped like rag_query.search_hits (distance = 1 - cosine, as in Weaviate)."""
+        rows, sims = self.search_rows(vec, top_k, nprobe, scope)
+        return [{**self._meta(r), "distance": round(1.0 - float(s), 6)} for r, s in zip(rows, sims)]
+
+_index, _index_stamp = None, None
+_index_lock = threading.Lock()
+
+def _stamp(path: Path):
+    # export() replaces index.json with os.replace, so a new export is a new inode
+    st = path.stat()
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+def get_index():
+    """Process-wide index, reloaded when an export replaces index.json; raises if no export exists yet.
+
+    A search already running on the previous LocalIndex finishes on it: its memmap and meta
+    handle stay readable after prune_versions removes the files.
+    """
+    global _index, _index_stamp
+    with _index_lock:
+        try:
+            stamp = _stamp(INDEX_DIR / "index.json")
+        except FileNotFoundError:
+            if _index is None:
+                raise FileNotFoundError(f"No local index at {INDEX_DIR}; run: python scripts/local_index.py export")
+            return _index
+        if stamp != _index_stamp:
+            try:
+                index = LocalIndex(INDEX_DIR)
+            except (OSError, ValueError) as e:
+                # Pruned by a newer export between the stat and the load; keep serving the open one
+                if _index is None:
+                    raise
+                print(json.dumps({"local_index_reload_failed": str(e)}), file=sys.stderr)
+                return _index
+            _index, _index_stamp = index, stamp
+        return _index
+
+def weaviate_ids(vec, top_k: int):
+    gql = {"query": f"""{{ Get {{ {CLASS_NAME}(nearVector: {{vector: [{",".join(map(str, vec))}]}}, limit: {top_k}) {{ _additional {{ id }} }} }} }}"""}
+    r = clients.request("POST", f"{WEAVIATE}/v1/graphql", "weaviate", json=gql)
+    r.raise_for_status()
+    hits = ((r.json().get("data") or {}).get("Get") or {}).get(CLASS_NAME) or []
+    return [h["_additional"]["id"] for h in hits]
+
+def recall(index: LocalIndex, queries: int = 100, top_k: int = 5, nprobe: int = NPROBE, seed: int = 0):
+    """recall@k of the local index against Weaviate, using stored vectors as queries."""
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(index.rows, min(queries, index.rows), replace=False)
+    hits, local_s, remote_s = 0, [], []
+    for row in sample:
+        q = np.array(index.vectors[row])
+        t0 = time.perf_counter()
+        mine = {index._meta(r)["id"] for r in index.search_rows(q, top_k, nprobe)[0]}
+        local_s.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        theirs = weaviate_ids(q.tolist(), top_k)
+        remote_s.append(time.perf_counter() - t0)
+        hits += len(mine & set(theirs)) / max(1, len(theirs))
+    return {"queries": len(sample), "top_k": top_k, "nprobe": nprobe if index.ivf is not None else None,
+            "recall": round(hits / max(1, len(sample)), 4),
+            "local_ms_p50": round(float(np.median(local_s)) * 1000, 3),
+            "weaviate_ms_p50": round(float(np.median(remote_s)) * 1000, 3)}
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(description="Export DocChunk into a local NumPy index, or measure its recall")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    ex = sub.add_parser("export", help="Export DocChunk vectors from Weaviate")
+    ex.add_argument("--out", default=str(INDEX_DIR), help=f"Index directory (default: {INDEX_DIR})")
+    ex.add_argument("--page-size", type=int, default=500, help="Objects per cursor page (default: 500)")
+    ex.add_argument("--ivf", type=int, default=0, help="Build an IVF quantizer with this many lists (0 = exact search)")
+    rc = sub.add_parser("recall", help="Compare local top-k against Weaviate")
+    rc.add_argument("--queries", type=int, default=100)
+    rc.add_argument("--top-k", type=int, default=5)
+    rc.add_argument("--nprobe", type=int, default=NPROBE)
+    args = ap.parse_args()
+
+    if args.cmd == "export":
+        t0 = time.perf_counter()
+        header = export(Path(args.out), args.page_size, args.ivf)
+        print(json.dumps({**header, "path": args.out, "seconds": round(time.perf_counter() - t0, 3),
+                          "metrics": metrics.summary()}))
+    else:
+        index = get_index()
+        if not index.rows:
+            print(json.dumps({"error": "Local index is empty"}))
+            sys.exit(1)
+        print(json.dumps(recall(index, args.queries, args.top_k, args.nprobe)))
+
+if __name__ == "__main__":
+    main()
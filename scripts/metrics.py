@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+metrics.py
+
+Shared instrumentation for the ingest and query scripts.
+
+  with metrics.stage("embed", items=len(texts)): ...     busy time per pipeline stage
+  metrics.observe("chunk", seconds, items)                the same, for code that times itself
+  metrics.http("POST", url, service="ollama", json=...)   a timed request: status, bytes, errors
+  metrics.retry("ollama", "/api/embed")                   count a retried request
+  metrics.count("insert_errors", n)                       free-form counters
+
+Stage seconds are busy time summed over threads, so with parallel workers they can exceed
+wall time. summary() is what the scripts put in their final JSON. With --metrics-prom PATH
+(or METRICS_PROM) a Prometheus text file is written when the process exits; with
+--trace PATH (or METRICS_TRACE) every request and stage event is appended to a JSONL file.
+Worker processes report through snapshot() and the parent folds them in with merge().
+"""
+import os, json, time, atexit, threading, multiprocessing, requests
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+PROM_PATH  = os.getenv("METRICS_PROM", "")
+TRACE_PATH = os.getenv("METRICS_TRACE", "")
+
+_lock = threading.Lock()
+_stages = {}     # name → [calls, items, seconds, max_seconds]
+_requests = {}   # (service, method, endpoint) → [count, errors, retries, seconds, bytes_sent, bytes_received]
+_counters = {}   # name → value
+_gauges = {}     # name → value
+_trace = None
+
+def _emit(event: dict):
+    global _trace
+    if not TRACE_PATH:
+        return
+    line = json.dumps({"ts": round(time.time(), 6), "thread": threading.current_thread().name, **event}) + "\n"
+    with _lock:
+        if _trace is None:
+            os.makedirs(os.path.dirname(os.path.abspath(TRACE_PATH)), exist_ok=True)
+            _trace = open(TRACE_PATH, "a", buffering=1, encoding="utf-8")
+        _trace.write(line)
+
+def observe(name: str, seconds: float, items: int = 0):
+    with _lock:
+        s = _stages.setdefault(name, [0, 0, 0.0, 0.0])
+        s[0] += 1
+        s[1] += items
+        s[2] += seconds
+        s[3] = max(s[3], seconds)
+    _emit({"kind": "stage", "stage": name, "seconds": round(seconds, 6), "items": items})
+
+@contextmanager
+def stage(name: str, items: int = 0):
+    """Time a block; set rec["items"] inside it when the count is only known afterwards."""
+    rec = {"items": items}
+    t0 = time.perf_counter()
+    try:
+        yield rec
+    finally:
+        observe(name, time.perf_counter() - t0, rec["items"])
+
+def _request_slot(service: str, method: str, endpoint: str):
+    return _requests.setdefault((service, method, endpoint), [0, 0, 0, 0.0, 0, 0])
+
+def http(method: str, url: str, service: str = "", session=None, **kw):
+    """requests.request() with timing, byte counts and errors recorded per service and endpoint.
+
+    A `json=` body is encoded here so the bytes sent are known. For stream=True responses
+    the received bytes come from Content-Length (0 for chunked bodies).
+    """
+    if "json" in kw:
+        kw["data"] = json.dumps(kw.pop("json")).encode("utf-8")
+        kw["headers"] = {"Content-Type": "application/json", **(kw.get("headers") or {})}
+    data = kw.get("data")
+    sent = len(data) if isinstance(data, (bytes, str)) else 0
+    endpoint = urlparse(url).path
+    service = service or urlparse(url).netloc
+    t0 = time.perf_counter()
+    r, error = None, None
+    try:
+        r = (session or requests).request(method, url, **kw)
+        return r
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - t0
+        received = 0
+        if r is not None:
+            received = int(r.headers.get("Content-Length") or 0) if kw.get("stream") else len(r.content)
+        failed = error is not None or (r is not None and r.status_code >= 400)
+        with _lock:
+            slot = _request_slot(service, method, endpoint)
+            slot[0] += 1
+            slot[1] += failed
+            slot[3] += seconds
+            slot[4] += sent
+            slot[5] += received
+        _emit({"kind": "request", "service": service, "method": method, "endpoint": endpoint,
+               "status": r.status_code if r is not None else None, "error": error,
+               "seconds": round(seconds, 6), "bytes_sent": sent, "bytes_received": received})
+
+def retry(service: str, endpoint: str, method: str = "POST"):
+    with _lock:
+        _request_slot(service, method, endpoint)[2] += 1
+    _emit({"kind": "retry", "service": service, "method": method, "endpoint": endpoint})
+
+def count(name: str, n: int = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def gauge(name: str, value):
+    with _lock:
+        _gauges[name] = value
+
+def get_gauge(name: str, default=None):
+    return _gauges.get(name, default)
+
+def get_counter(name: str, default=0):
+    return _counters.get(name, default)
+
+def stage_totals(name: str):
+    """(calls, items, seconds) recorded so far for one stage."""
+    with _lock:
+        s = _stages.get(name) or [0, 0, 0.0, 0.0]
+        return s[0], s[1], s[2]
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _requests.clear()
+        _counters.clear()
+        _gauges.clear()
+
+def snapshot():
+    """Picklable raw state, for worker processes to hand back to the parent."""
+    with _lock:
+        return {"stages": {k: list(v) for k, v in _stages.items()},
+                "requests": {k: list(v) for k, v in _requests.items()},
+                "counters": dict(_counters), "gauges": dict(_gauges)}
+
+def merge(snap: dict):
+    with _lock:
+        for k, v in snap.get("stages", {}).items():
+            s = _stages.setdefault(k, [0, 0, 0.0, 0.0])
+            s[0] += v[0]; s[1] += v[1]; s[2] += v[2]; s[3] = max(s[3], v[3])
+        for k, v in snap.get("requests", {}).items():
+            slot = _request_slot(*k)
+            for i in range(len(slot)):
+                slot[i] += v[i]
+        for k, v in snap.get("counters", {}).items():
+            _counters[k] = _counters.get(k, 0) + v
+        for k, v in snap.get("gauges", {}).items():
+            if v is not None:
+                _gauges[k] = v
+
+def summary():
+    """Aggregates for a script's final JSON."""
+    with _lock:
+        stages = {name: {"calls": c, "items": n, "seconds": round(t, 3),
+                         "mean_ms": round(t / c * 1000, 2) if c else None, "max_ms": round(m * 1000, 2),
+                         "items_per_sec": round(n / t, 2) if n and t > 0 else None}
+                  for name, (c, n, t, m) in sorted(_stages.items())}
+        reqs = {f"{svc} {method} {ep}": {"count": c, "errors": e, "retries": r, "seconds": round(t, 3),
+                                         "mean_ms": round(t / c * 1000, 2) if c else None,
+                                         "bytes_sent": bs, "bytes_received": br}
+                for (svc, method, ep), (c, e, r, t, bs, br) in sorted(_requests.items())}
+        return {"stages": stages, "requests": reqs, "counters": dict(_counters), **({"gauges": dict(_gauges)} if _gauges else {})}
+
+def _label(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"')
+
+def prometheus_text(prefix: str = "rag") -> str:
+    lines = []
+    def family(name, kind, rows):
+        if rows:
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            lines.extend(f"{prefix}_{name}{{{labels}}} {value}" for labels, value in rows)
+    with _lock:
+        st = sorted(_stages.items())
+        rq = sorted(_requests.items())
+        ct = sorted(_counters.items())
+        gg = sorted((k, v) for k, v in _gauges.items() if isinstance(v, (int, float)))
+    for i, name in enumerate(("stage_calls_total", "stage_items_total", "stage_seconds_total")):
+        family(name, "counter", [(f'stage="{_label(k)}"', v[i]) for k, v in st])
+    for i, name in enumerate(("requests_total", "request_errors_total", "request_retries_total",
+                              "request_seconds_total", "request_bytes_sent_total", "request_bytes_received_total")):
+        family(name, "counter", [(f'service="{_label(s)}",method="{m}",endpoint="{_label(e)}"', v[i]) for (s, m, e), v in rq])
+    family("events_total", "counter", [(f'name="{_label(k)}"', v) for k, v in ct])
+    family("gauge", "gauge", [(f'name="{_label(k)}"', v) for k, v in gg])
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(path: str):
+    """Atomically (re)write a textfile-collector compatible metrics file."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as w:
+        w.write(prometheus_text())
+    os.replace(tmp, path)
+
+def add_arguments(ap):
+    ap.add_argument("--metrics-prom", default=PROM_PATH or None, help="Write Prometheus text metrics here on exit (env METRICS_PROM)")
+    ap.add_argument("--trace", default=TRACE_PATH or None, help="Append per-request/stage trace events as JSONL (env METRICS_TRACE)")
+
+def configure(args=None, prom: str = None, trace: str = None):
+    """Apply --metrics-prom / --trace (or explicit paths) for this process."""
+    global PROM_PATH, TRACE_PATH
+    PROM_PATH = prom or getattr(args, "metrics_prom", None) or PROM_PATH
+    TRACE_PATH = trace or getattr(args, "trace", None) or TRACE_PATH
+    # Worker processes inherit the paths through the environment
+    if PROM_PATH:
+        os.environ["METRICS_PROM"] = PROM_PATH
+    if TRACE_PATH:
+        os.environ["METRICS_TRACE"] = TRACE_PATH
+
+@atexit.register
+def _flush():
+    # Pool workers report through snapshot(); only the main process writes the Prometheus file
+    if PROM_PATH and multiprocessing.parent_process() is None:
+        try:
+            write_prometheus(PROM_PATH)
+        except OSError:
+            pass
+    if _trace is not None:
+        _trace.close()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+rag_batch.py
+
+Answer many questions in one process: questions are read from a JSONL file
+({"q": ...} or {"question": ...}, optional "id" and "scope"), embedded in batches through
+/api/embed, retrieved concurrently from Weaviate and generated with configurable
+concurrency. Answers go to a JSONL file; the final JSON summary reports
+p50/p95/p99 latency per stage. Models are loaded before the clock starts
+(clients.warm_up), so the first questions' latencies don't include the model load.
+"""
+import os, sys, json, time, math
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import rag_query as rq
+import clients
+import filters
+import metrics
+
+def load_questions(path: Path):
+    """Questions of a JSONL file; raises ValueError naming the line of a malformed entry."""
+    out = []
+    with path.open("r", encoding="utf-8") as r:
+        for n, line in enumerate(r, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                obj = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{n}: {e}") from None
+            if isinstance(obj, str):
+                obj = {"q": obj}
+            if not isinstance(obj, dict):
+                raise ValueError(f"{path}:{n}: expected an object or a string")
+            q = " ".join(str(obj.get("q") or obj.get("question") or "").split())
+            if q:
+                if not isinstance(obj.get("scope") or {}, dict):
+                    raise ValueError(f"{path}:{n}: scope must be an object")
+                try:
+                    scope = filters.from_dict(obj.get("scope"))
+                except ValueError as e:
+                    raise ValueError(f"{path}:{n}: {e}") from None
+                out.append({**obj, "id": obj.get("id", n), "q": q, "scope": scope})
+    return out
+
+def percentiles(values, ps=(50, 95, 99)):
+    if not values:
+        return None
+    xs = sorted(values)
+    # nearest-rank percentiles
+    return {f"p{p}": round(xs[max(0, math.ceil(p / 100 * len(xs)) - 1)], 4) for p in ps} | {"n": len(xs)}
+
+def mean(values):
+    values = [v for v in values if v is not None]
+    return round(sum(values) / len(values), 4) if values else None
+
+def context_summary(results):
+    """Prompt size, prefill time and quality across answered questions."""
+    ok = [r for r in results if "error" not in r]
+    stats = [r["stats"] for r in ok if r.get("stats")]
+    return {
+        "prompt_tokens_mean": mean([s.get("prompt_tokens") for s in stats]),
+        "prefill_s": percentiles([s["prefill_s"] for s in stats if s.get("prefill_s") is not None]),
+        "chunks_merged_mean": mean([(r.get("pack") or {}).get("merged") for r in ok]),
+        "coverage_mean": mean([(r.get("quality") or {}).get("coverage") for r in ok]),
+        "grounding_mean": mean([(r.get("quality") or {}).get("grounding") for r in ok]),
+    }
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - t0
+
+def run_batch(questions, top_k: int = rq.TOP_K, embed_batch: int = 32, retrieve_concurrency: int = 8,
+              generate_concurrency: int = 1, on_answer=None, scope: dict = None):
+    """Run embed → retrieve → generate as whole-batch stages; returns (results, stage latencies).
+
+    A question's own "scope" takes precedence over the batch-wide `scope`.
+    """
+    lat = {"embed": [], "retrieve": [], "generate": [], "total": []}
+    vecs = []
+    for i in range(0, len(questions), embed_batch):
+        batch = [x["q"] for x in questions[i:i + embed_batch]]
+        out, dt = timed(rq.embed_many, batch)
+        vecs.extend(out)
+        # Amortize the batch call over its questions for per-question latency
+        lat["embed"].extend([dt / len(batch)] * len(batch))
+
+    def retrieve(i):
+        try:
+            return timed(rq.search_hits, vecs[i], rq.context_pack.candidate_k(top_k), questions[i].get("scope") or scope)
+        except Exception as e:
+            return e, 0.0
+
+    def generate(i):
+        ctx, _ = hits[i]
+        if isinstance(ctx, Exception):
+            return ctx, 0.0
+        try:
+            return timed(rq.answer_from_hits, questions[i]["q"], vecs[i], ctx, None, top_k)
+        except Exception as e:
+            return e, 0.0
+
+    with ThreadPoolExecutor(max_workers=max(1, retrieve_concurrency)) as pool:
+        hits = list(pool.map(retrieve, range(len(questions))))
+    results = [None] * len(questions)
+    with ThreadPoolExecutor(max_workers=max(1, generate_concurrency)) as pool:
+        for i, (answer, gen_s) in zip(range(len(questions)), pool.map(generate, range(len(questions)))):
+            _, ret_s = hits[i]
+            res = {"id": questions[i]["id"], "q": questions[i]["q"]}
+            if isinstance(answer, Exception):
+                res["error"] = str(answer)
+            else:
+                res.update(answer)
+                lat["retrieve"].append(ret_s)
+                lat["generate"].append(gen_s)
+                lat["total"].append(lat["embed"][i] + ret_s + gen_s)
+            res["timings"] = {"embed_s": round(lat["embed"][i], 4), "retrieve_s": round(ret_s, 4), "generate_s": round(gen_s, 4)}
+            results[i] = res
+            if on_answer:
+                on_answer(res)
+    return results, {k: percentiles(v) for k, v in lat.items()}
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(description="Answer a JSONL file of questions with batched embedding and concurrent retrieval/generation")
+    ap.add_argument("input", help="JSONL file with one {\"q\": ...} per line")
+    ap.add_argument("--out", help="Answers JSONL (default: <input>.answers.jsonl)")
+    ap.add_argument("--top-k", type=int, default=rq.TOP_K, help=f"Chunks retrieved per question (default: {rq.TOP_K})")
+    ap.add_argument("--embed-batch", type=int, default=32, help="Questions per /api/embed call (default: 32)")
+    ap.add_argument("--retrieve-concurrency", type=int, default=8, help="Concurrent Weaviate searches (default: 8)")
+    ap.add_argument("--concurrency", type=int, default=int(os.getenv("OLLAMA_NUM_PARALLEL", "1")),
+                    help="Concurrent generate calls; match Ollama's OLLAMA_NUM_PARALLEL (default: 1)")
+    ap.add_argument("--no-warm-up", action="store_true", help="Don't preload the models before timing the batch")
+    filters.add_arguments(ap)
+    metrics.add_arguments(ap)
+    args = ap.parse_args()
+    metrics.configure(args)
+
+    src = Path(args.input)
+    if not src.is_file():
+        print(json.dumps({"error": f"Input not found: {src}"}))
+        sys.exit(1)
+    try:
+        scope = filters.from_args(args)
+        questions = load_questions(src)
+    except ValueError as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(2)
+    if not questions:
+        print(json.dumps({"error": "No questions in input"}))
+        sys.exit(2)
+    out_path = Path(args.out) if args.out else src.with_suffix(".answers.jsonl")
+    if not rq.wait_ready(60):
+        print(json.dumps({"error": "Services not ready"}))
+        sys.exit(1)
+    warm = {} if args.no_warm_up else clients.warm_up()
+
+    t0 = time.perf_counter()
+    with out_path.open("w", encoding="utf-8") as w:
+        results, latency = run_batch(questions, args.top_k, args.embed_batch, args.retrieve_concurrency, args.concurrency,
+                                     on_answer=lambda res: w.write(json.dumps(res) + "\n"), scope=scope)
+    wall = time.perf_counter() - t0
+    errors = sum(1 for r in results if "error" in r)
+    print(json.dumps({
+        "input": str(src), "out": str(out_path), "questions": len(questions), "errors": errors,
+        "seconds": round(wall, 3), "questions_per_sec": round(len(questions) / wall, 3) if wall > 0 else None,
+        "concurrency": args.concurrency, "latency_s": latency, "warm_up": warm or None,
+        "cached_answers": sum(1 for r in results if r.get("cached")),
+        "context": context_summary(results),
+        "embed_cache": rq.embed_cache.stats(),
+        "answer_cache": rq.answer_cache.get_cache().stats() if rq.answer_cache.get_cache() else None,
+        "metrics": metrics.summary(),
+    }))
+
+if __name__ == "__main__":
+    main()
@@ -1,89 +1,198 @@
 #!/usr/bin/env python3
 import os, sys, time, requests, textwrap, json
 
-IN_DOCKER = os.path.exists("/.dockerenv") or os.environ.get("IN_DOCKER") == "1"
-OLLAMA   = "http://ollama:11434"   if IN_DOCKER else f"http://localhost:{os.getenv('OLLAMA_PORT','11434')}"
-WEAVIATE = "http://weaviate:8080"  if IN_DOCKER else f"http://localhost:{os.getenv('WEAVIATE_PORT','8080')}"
+import embed_cache
+import answer_cache
+import local_index
+import context_pack
+import sessions
+import clients
+import filters
+import metrics
 
-EMBED_MODEL = os.getenv("EMBED_MODEL","nomic-embed-text")
-GEN_MODEL   = os.getenv("GEN_MODEL","phi3:mini")
+OLLAMA, WEAVIATE = clients.OLLAMA, clients.WEAVIATE
+EMBED_MODEL = clients.EMBED_MODEL
+GEN_MODEL   = clients.GEN_MODEL
 CLASS_NAME  = "DocChunk"
+TOP_K       = 3
+RAG_SERVER  = os.getenv("RAG_SERVER", "")  # e.g. http://localhost:8765 → act as a thin client
+# weaviate | local (data/index export, see local_index.py) | auto (Weaviate, local index when it's unreachable)
+RETRIEVE_BACKEND = os.getenv("RETRIEVE_BACKEND", "weaviate")
+GENERATE_TIMEOUT = float(os.getenv("GENERATE_TIMEOUT", "600"))  # seconds for a whole non-streamed answer
 
 def wait_ready(timeout=60):
-  last_err = None
-  for _ in range(timeout):
-    try:
-      # Weaviate readiness
-      r1 = requests.get(f"{WEAVIATE}/v1/.well-known/ready", timeout=2)
-      r1.raise_for_status()
-      # Ollama tags for liveness
-      r2 = requests.get(f"{OLLAMA}/api/tags", timeout=2)
-      r2.raise_for_status()
-      return True
-    except Exception as e:
-      last_err = str(e)
-      time.sleep(1)
-  if last_err:
-    print(json.dumps({"last_ready_error": last_err}))
-  return False
+  # Weaviate is not needed for the local index, nor for auto once an export exists to fall back on
+  services = ["ollama"]
+  if RETRIEVE_BACKEND == "weaviate" or (RETRIEVE_BACKEND == "auto" and not (local_index.INDEX_DIR / "index.json").exists()):
+    services.insert(0, "weaviate")
+  return clients.wait_ready(timeout, services)
 
 def embed(text):
-    # Preferred modern endpoint
-    r = requests.post(f"{OLLAMA}/api/embed", json={"model": EMBED_MODEL, "input": text})
-    if r.status_code == 404:
-        # Fallback for older images
-        r = requests.post(f"{OLLAMA}/api/embeddings", json={"model": EMBED_MODEL, "prompt": text})
-    r.raise_for_status()
-    # /api/embed returns {"embeddings":[...]} ; /api/embeddings returns {"embedding":[...]}
-    data = r.json()
-    vec = (data.get("embedding") or (data.get("embeddings") or [None])[0])
-    return vec
+    # Repeated questions are served from the shared on-disk cache
+    return embed_cache.cached_embed(EMBED_MODEL, [text], lambda texts: [_embed_remote(texts[0])])[0]
 
-def retrieve(q: str, top_k: int = 5):
-  vec = embed(q)
+def embed_many(texts):
+    """Embed several questions with one list-input /api/embed call (cache misses only)."""
+    def remote(batch):
+        with metrics.stage("embed", items=len(batch)):
+            return clients.embed(batch, EMBED_MODEL)
+    return embed_cache.cached_embed(EMBED_MODEL, texts, remote)
+
+def _embed_remote(text):
+    # /api/embed, or /api/embeddings on older images (see clients.embed)
+    with metrics.stage("embed", items=1):
+        return clients.embed([text], EMBED_MODEL)[0]
+
+def retrieve(q: str, top_k: int = 5, scope: dict = None):
+  return search(embed(q), top_k, scope)
+
+def search(vec, top_k: int = 5, scope: dict = None):
+  """nearVector search for an already-embedded question; returns chunk texts."""
+  return [h["chunk"] for h in search_hits(vec, top_k, scope)]
+
+def search_hits(vec, top_k: int = 5, scope: dict = None):
+  """nearVector search returning hits with object id, doc_id, chunk, distance and the chunk's
+  source metadata when stored. A scope (filters.scope) restricts the search beforehand."""
   if vec is None:
     raise ValueError("Embedding returned None (empty query or model error)")
+  with metrics.stage("retrieve") as rec:
+    if RETRIEVE_BACKEND == "local":
+      hits = local_index.get_index().search(vec, top_k, scope=scope)
+    else:
+      try:
+        hits = _weaviate_hits(vec, top_k, scope)
+      except requests.RequestException:
+        if RETRIEVE_BACKEND != "auto":
+          raise
+        metrics.count("retrieve_fallbacks")
+        hits = local_index.get_index().search(vec, top_k, scope=scope)
+    rec["items"] = len(hits)
+  if scope:
+    metrics.count("scoped_queries")
+  return hits
+
+SOURCE_FIELDS = ("source_path", "chunk_index", "offset", "mtime")
+_source_fields = None
+
+def source_fields():
+  """The SOURCE_FIELDS DocChunk has; a class from before they existed would fail the whole query."""
+  global _source_fields
+  if _source_fields is None:
+    r = clients.request("GET", f"{WEAVIATE}/v1/schema/{CLASS_NAME}", "weaviate", timeout=30,
+                        retries=0 if RETRIEVE_BACKEND == "auto" else None)
+    if r.status_code == 404:
+      return []  # no class yet: ask again next time
+    r.raise_for_status()
+    have = {p.get("name") for p in (r.json() or {}).get("properties") or []}
+    _source_fields = [f for f in SOURCE_FIELDS if f in have]
+  return _source_fields
+
+def _weaviate_hits(vec, top_k: int, scope: dict = None):
+  where = filters.where(scope)
+  args = f"nearVector: {{vector: [{','.join(map(str, vec))}]}}, limit: {top_k}"
+  if where:
+    args += f", where: {filters.graphql(where)}"
+  fields = " ".join(source_fields())
   gql = {
     "query": f"""
     {{
       Get {{
-        {CLASS_NAME}(nearVector: {{vector: [{",".join(map(str, vec))}]}}, limit: {top_k}) {{
+        {CLASS_NAME}({args}) {{
           doc_id
           chunk
+          {fields}
+          _additional {{ id distance }}
         }}
       }}
     }}
     """
   }
-  r = requests.post(f"{WEAVIATE}/v1/graphql", json=gql)
+  # With a local fallback available, fail over at once instead of retrying
+  r = clients.request("POST", f"{WEAVIATE}/v1/graphql", "weaviate", json=gql,
+                      retries=0 if RETRIEVE_BACKEND == "auto" else None)
   r.raise_for_status()
-  data = r.json().get("data", {})
+  body = r.json()
+  if body.get("errors") and scope:
+    # e.g. filtering on a property the class doesn't have yet; an empty result would hide it
+    raise RuntimeError("; ".join(e.get("message", "") for e in body["errors"]))
+  data = body.get("data") or {}
   hits = (data.get("Get", {}) or {}).get(CLASS_NAME, []) or []
-  return [h.get("chunk","") for h in hits if "chunk" in h]
+  return [{"id": (h.get("_additional") or {}).get("id"), "doc_id": h.get("doc_id"), "chunk": h.get("chunk", ""),
+           "distance": (h.get("_additional") or {}).get("distance"),
+           **{f: h[f] for f in SOURCE_FIELDS if h.get(f) is not None}} for h in hits if "chunk" in h]
 
 def generate(prompt: str):
-  r = requests.post(f"{OLLAMA}/api/generate", json={"model": GEN_MODEL, "prompt": prompt, "stream": False, "options": {"num_ctx": 2048}})
-  r.raise_for_status()
-  data = r.json()
-  return (data.get("response") or "").strip()
+  return generate_with_stats(prompt)[0]
 
-if __name__ == "__main__":
-  # Wait for services
-  wait_ready(60)
-  # Get question from arg or env Q, fallback to default
-  q = sys.argv[1] if len(sys.argv) > 1 else os.getenv("Q", "").strip()
-  q = " ".join(q.split())
-  if not q:
-    print(json.dumps({"error": "Empty question. Pass as: make query q='Your question'"}))
-    sys.exit(2)
-  try:
-    ctx = retrieve(q, top_k=3)
-  except Exception as e:
-    print(json.dumps({"error": str(e)}))
-    sys.exit(1)
+def generate_body(prompt: str, stream: bool, context=None):
+  body = {"model": GEN_MODEL, "prompt": prompt, "stream": stream, "keep_alive": clients.KEEP_ALIVE,
+          "options": {"num_ctx": context_pack.NUM_CTX}}
+  if context:
+    body["context"] = list(context)
+  return body
+
+def generate_with_stats(prompt: str, context=None):
+  """Non-streaming /api/generate; returns (answer, stats) like generate_stream."""
+  t0 = time.perf_counter()
+  with metrics.stage("generate"):
+    r = clients.request("POST", f"{OLLAMA}/api/generate", "ollama", timeout=(clients.CONNECT_TIMEOUT, GENERATE_TIMEOUT),
+                        json=generate_body(prompt, False, context))
+    r.raise_for_status()
+    data = r.json()
+  clients.note_load(GEN_MODEL, data)
+  return (data.get("response") or "").strip(), stream_stats(data, None, time.perf_counter() - t0, context)
+
+def generate_stream(prompt: str, on_token=None, context=None):
+  """Stream /api/generate, calling on_token(str) per token; returns (answer, stats).
+
+  stats holds client-measured time-to-first-token and total latency, plus Ollama's own
+  eval counters (durations in ns) turned into prompt and generation tokens/sec.
+  With context (a session's token array, [] to start one) the prompt continues it, and
+  stats["context"] holds the array Ollama returned for the next turn.
+  """
+  t0 = time.perf_counter()
+  ttft, parts, final = None, [], {}
+  # Retries only cover failures before the first byte; the read timeout applies between streamed lines
+  with metrics.stage("generate"), clients.request("POST", f"{OLLAMA}/api/generate", "ollama", stream=True,
+                                                  json=generate_body(prompt, True, context)) as r:
+    r.raise_for_status()
+    for line in r.iter_lines():
+      if not line:
+        continue
+      data = json.loads(line)
+      if data.get("error"):
+        raise RuntimeError(data["error"])
+      tok = data.get("response") or ""
+      if tok:
+        if ttft is None:
+          ttft = time.perf_counter() - t0
+        parts.append(tok)
+        if on_token:
+          on_token(tok)
+      if data.get("done"):
+        final = data
+  clients.note_load(GEN_MODEL, final)
+  return "".join(parts).strip(), stream_stats(final, ttft, time.perf_counter() - t0, context)
+
+def stream_stats(final: dict, ttft, total, context=None):
+  def rate(count, ns):
+    return round(count / (ns / 1e9), 2) if count and ns else None
+  return {
+    "ttft_s": round(ttft, 3) if ttft is not None else None,
+    "total_s": round(total, 3),
+    "load_s": round(final.get("load_duration", 0) / 1e9, 3),
+    "prefill_s": round(final.get("prompt_eval_duration", 0) / 1e9, 3),
+    "prompt_tokens": final.get("prompt_eval_count"),
+    "prompt_tokens_per_sec": rate(final.get("prompt_eval_count"), final.get("prompt_eval_duration")),
+    "eval_tokens": final.get("eval_count"),
+    "eval_tokens_per_sec": rate(final.get("eval_count"), final.get("eval_duration")),
+    **({"context": final.get("context") or []} if context is not None else {}),
+  }
+
+def build_prompt(q: str, ctx):
   context_str = "\n\n".join(ctx)
   indented_context = textwrap.indent(context_str, "  ")
-  prompt = (
+  return (
     f"""Answer using only the context below. If missing, say you don't know.
 
 Context:
@@ -91,4 +200,232 @@ Context:
 
 Question: {q}"""
   )
-  print(generate(prompt))
+
+def build_followup(q: str, ctx):
+  """A session turn's prompt: the instruction and earlier context are already in the session."""
+  if not ctx:
+    return f"Question: {q}"
+  indented_context = textwrap.indent("\n\n".join(ctx), "  ")
+  return (
+    f"""More context:
+{indented_context}
+
+Question: {q}"""
+  )
+
+def answer(q: str, top_k: int = TOP_K, on_token=None, scope: dict = None):
+  """Embed, retrieve and answer a question; see answer_from_hits for the result shape."""
+  vec = embed(q)
+  return answer_from_hits(q, vec, search_hits(vec, context_pack.candidate_k(top_k), scope), on_token, top_k)
+
+def answer_from_hits(q: str, vec, hits, on_token=None, top_k: int = TOP_K):
+  """Generate (or reuse) an answer for retrieved hits.
+
+  Hits (ideally context_pack.candidate_k(top_k) of them) are merged and packed into the
+  num_ctx budget first. The semantic answer cache is then consulted: a near-identical
+  question over the same packed chunk ids returns the stored answer without calling
+  generate. With on_token the answer is streamed. Results carry the packing report,
+  generation stats (prompt size, prefill time) and lexical quality scores.
+  """
+  ctx, ids, pack = context_pack.pack(q, hits, top_k)
+  cache = answer_cache.get_cache() if all(ids) else None
+  hit = cache.lookup(GEN_MODEL, EMBED_MODEL, vec, ids) if cache and ids else None
+  if hit:
+    if on_token:
+      on_token(hit["answer"])
+    return {"answer": hit["answer"], "context": ctx, "cached": True, "similarity": hit["similarity"], "pack": pack,
+            "quality": context_pack.quality(q, hit["answer"], ctx)}
+  prompt = build_prompt(q, ctx)
+  if on_token:
+    text, stats = generate_stream(prompt, on_token=on_token)
+  else:
+    text, stats = generate_with_stats(prompt)
+  if cache and ids and text:
+    cache.store(GEN_MODEL, EMBED_MODEL, vec, ids, q, text)
+  return {"answer": text, "context": ctx, "cached": False, "stats": {**stats, "prompt_chars": len(prompt)}, "pack": pack,
+          "quality": context_pack.quality(q, text, ctx)}
+
+def answer_turn(session_id: str, q: str, top_k: int = TOP_K, on_token=None, scope: dict = None, reset: bool = False):
+  """Answer a question as the next turn of a conversation session (see sessions.py).
+
+  The request continues from the Ollama context stored for the session, so the instruction,
+  earlier context and earlier answers are not prefilled again. Only chunks the model has not
+  seen in this session are added, packed into what num_ctx leaves after the stored context
+  (a first turn keeps room for them); when that is too little the session restarts. The answer cache is not
+  consulted, since an answer depends on the conversation as well as the chunks. The result
+  has answer()'s shape plus a "session" block with this turn's prefill tokens evaluated and
+  saved, and the session's running totals.
+  """
+  store = sessions.get_store()
+  with store.locked(session_id):
+    if reset:
+      store.drop(session_id)
+    sess = store.get(session_id, GEN_MODEL)
+    prefix = sess["context"] if sess else []
+    seen = set(sess["seen"]) if sess else set()
+    vec = embed(q)
+    hits = search_hits(vec, context_pack.candidate_k(top_k), scope)
+    fresh = [h for h in hits if h.get("id") not in seen]
+    # Room for new chunks once the stored context, the question, the answer and the template are accounted for
+    room = context_pack.NUM_CTX - context_pack.NUM_PREDICT - len(prefix) - context_pack.estimate_tokens(q) - 16
+    restart = bool(prefix) and room < (sessions.MIN_CONTEXT if fresh else 0)
+    if prefix and not restart:
+      ctx, ids, pack = context_pack.pack(q, fresh, top_k, limit=room)
+      prompt = build_followup(q, ctx)
+    else:
+      prefix, seen = [], set()
+      ctx, ids, pack = context_pack.pack(q, hits, top_k, limit=int(context_pack.budget(q) * sessions.FIRST_SHARE))
+      prompt = build_prompt(q, ctx)
+    if on_token:
+      text, stats = generate_stream(prompt, on_token=on_token, context=prefix)
+    else:
+      text, stats = generate_with_stats(prompt, context=prefix)
+    context = stats.pop("context")
+    turn = sessions.turn_stats(prefix, context, stats)
+    totals = store.save(session_id, GEN_MODEL, context, seen | {i for i in ids if i}, turn, reset=restart)
+  metrics.count("session_prefill_tokens_saved", turn["prefill_tokens_saved"])
+  return {"answer": text, "context": ctx, "cached": False, "stats": {**stats, "prompt_chars": len(prompt)}, "pack": pack,
+          "quality": context_pack.quality(q, text, ctx) if ctx else None,
+          "session": {"id": session_id, "turn": totals["turns"], "restarted": restart, **turn, "totals": totals}}
+
+def query_rag(q: str, top_k: int = TOP_K, scope: dict = None):
+  """Retrieve context for a question and generate an answer."""
+  return answer(q, top_k, scope=scope)["answer"]
+
+def server_body(q: str, top_k: int, scope: dict = None, session: str = None, reset: bool = False):
+  body = {"q": q, "top_k": top_k}
+  if scope:
+    body["scope"] = scope
+  if session:
+    body["session"] = session
+    if reset:
+      body["reset"] = True
+  return body
+
+def ask_server_result(q: str, server: str = RAG_SERVER, top_k: int = TOP_K, scope: dict = None, session: str = None,
+                      reset: bool = False):
+  """Thin-client mode: send the question to a running rag_server.py; returns its full result."""
+  r = requests.post(f"{server.rstrip('/')}/query", json=server_body(q, top_k, scope, session, reset), timeout=600)
+  data = r.json()
+  if not r.ok:
+    raise RuntimeError(data.get("error") or f"HTTP {r.status_code}")
+  return data
+
+def ask_server(q: str, server: str = RAG_SERVER, top_k: int = TOP_K, scope: dict = None):
+  return ask_server_result(q, server, top_k, scope)["answer"]
+
+def ask_server_stream(q: str, server: str = RAG_SERVER, top_k: int = TOP_K, on_token=None, scope: dict = None,
+                      session: str = None, reset: bool = False):
+  """Thin-client streaming: the server relays tokens as NDJSON and ends with a stats line."""
+  stats = {}
+  body = {**server_body(q, top_k, scope, session, reset), "stream": True}
+  with requests.post(f"{server.rstrip('/')}/query", json=body, stream=True, timeout=600) as r:
+    if not r.ok:
+      raise RuntimeError(r.json().get("error") or f"HTTP {r.status_code}")
+    for line in r.iter_lines():
+      if not line:
+        continue
+      data = json.loads(line)
+      if data.get("error"):
+        raise RuntimeError(data["error"])
+      if "token" in data and on_token:
+        on_token(data["token"])
+      if data.get("done"):
+        stats = data.get("stats") or {}
+  return stats
+
+def print_token(tok: str):
+  sys.stdout.write(tok)
+  sys.stdout.flush()
+
+def print_turn(session_id: str, q: str, stream: bool = False, scope: dict = None, reset: bool = False):
+  """One CLI session turn: the answer, then a JSON line reporting the turn's prefill tokens evaluated and saved."""
+  if RAG_SERVER and stream:
+    stats = ask_server_stream(q, on_token=print_token, scope=scope, session=session_id, reset=reset)
+    print()
+    print(json.dumps(stats))
+    return
+  if RAG_SERVER:
+    res = ask_server_result(q, scope=scope, session=session_id, reset=reset)
+  else:
+    res = answer_turn(session_id, q, TOP_K, on_token=print_token if stream else None, scope=scope, reset=reset)
+  stats = res.get("stats") or {}
+  if stream:
+    print()
+    print(json.dumps({**stats, "pack": res["pack"], "quality": res["quality"], "session": res["session"],
+                      **({"scope": scope} if scope else {}), "metrics": metrics.summary()}))
+  else:
+    print(res["answer"])
+    print(json.dumps({"session": res["session"], "prefill_s": stats.get("prefill_s")}))
+
+def read_questions():
+  """Questions from stdin, one per line, for an interactive session."""
+  while True:
+    try:
+      line = input("> " if sys.stdin.isatty() else "")
+    except EOFError:
+      return
+    q = " ".join(line.split())
+    if q:
+      yield q
+
+if __name__ == "__main__":
+  import argparse
+  ap = argparse.ArgumentParser(description="Ask a question against the ingested corpus")
+  ap.add_argument("question", nargs="?", default=os.getenv("Q", ""), help="Question (defaults to env Q)")
+  ap.add_argument("--stream", action="store_true", default=os.getenv("STREAM") == "1",
+                  help="Print tokens as they arrive, then a JSON trailer with latency stats")
+  ap.add_argument("--session", default=os.getenv("RAG_SESSION", ""),
+                  help="Ask as the next turn of this conversation session, reusing Ollama's context "
+                       "(without a question, read one question per line from stdin)")
+  ap.add_argument("--reset", action="store_true", help="Start the session over")
+  filters.add_arguments(ap)
+  metrics.add_arguments(ap)
+  args = ap.parse_args()
+  metrics.configure(args)
+  try:
+    scope = filters.from_args(args)
+  except ValueError as e:
+    print(json.dumps({"error": str(e)}))
+    sys.exit(2)
+  q = " ".join(args.question.split())
+  if args.session:
+    if not RAG_SERVER:
+      wait_ready(60)
+    failed = False
+    for i, turn_q in enumerate([q] if q else read_questions()):
+      try:
+        print_turn(args.session, turn_q, args.stream, scope, reset=args.reset and i == 0)
+      except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        failed = True
+    sys.exit(1 if failed else 0)
+  if not q:
+    print(json.dumps({"error": "Empty question. Pass as: make query q='Your question'"}))
+    sys.exit(2)
+  if RAG_SERVER:
+    # The server keeps warm connections and models; skip readiness polling entirely
+    try:
+      if args.stream:
+        stats = ask_server_stream(q, on_token=print_token, scope=scope)
+        print()
+        print(json.dumps(stats))
+      else:
+        print(ask_server(q, scope=scope))
+    except Exception as e:
+      print(json.dumps({"error": str(e)}))
+      sys.exit(1)
+    sys.exit(0)
+  # Wait for services
+  wait_ready(60)
+  try:
+    res = answer(q, top_k=TOP_K, on_token=print_token if args.stream else None, scope=scope)
+  except Exception as e:
+    print(json.dumps({"error": str(e)}))
+    sys.exit(1)
+  if args.stream:
+    print()
+    print(json.dumps({**(res.get("stats") or {}), "cached": res["cached"], "pack": res["pack"], "quality": res["quality"],
+                      **({"scope": scope} if scope else {}), "metrics": metrics.summary()}))
+  else:
+    print(res["answer"])
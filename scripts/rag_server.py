@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+rag_server.py
+
+Long-running local query server. Reuses rag_query.retrieve()/generate() with pooled,
+warm connections to Ollama and Weaviate, so per-question latency is not dominated by
+process startup and connection setup.
+
+  POST /query   {"q": "...", "top_k": 3}  →  {"answer": "...", "context": [...], "seconds": ...}
+                with "stream": true      →  NDJSON {"token": ...} lines, then {"done": true, "stats": {...}}
+                with "scope": {"doc_id": [...], "path_prefix": "...", "since": "...", "until": "..."}
+                                         →  retrieval restricted to matching chunks (see filters.py)
+                with "session": "<id>"   →  the next turn of a conversation that reuses Ollama's context
+                                            (see sessions.py); "reset": true starts it over
+  GET  /healthz                           →  {"ok": true, "weaviate": true, "ollama": true}
+  GET  /stats                             →  answer/embedding cache hit rates, session prefill savings,
+                                             per-stage metrics, model warm-up
+  GET  /metrics                           →  the same metrics in Prometheus text format
+
+At startup the server loads EMBED_MODEL and GEN_MODEL into Ollama (clients.warm_up) with
+keep_alive=MODEL_KEEP_ALIVE, so the first question does not pay for the model load.
+
+rag_query.py acts as a thin client when RAG_SERVER (e.g. http://localhost:8765) is set.
+"""
+import os, sys, json, time, socket
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import rag_query as rq
+import clients
+import filters
+import metrics
+
+HOST = os.getenv("RAG_SERVER_HOST", "127.0.0.1")
+PORT = int(os.getenv("RAG_SERVER_PORT", "8765"))
+WARM_UP = {}   # per-model result of the startup warm-up
+
+def health():
+    out = {}
+    for name, path in clients.READY_CHECKS.items():
+        url = (clients.WEAVIATE if name == "weaviate" else clients.OLLAMA) + path
+        try:
+            out[name] = clients.session().get(url, timeout=2).ok
+        except Exception:
+            out[name] = False
+    ok = all(out.values())
+    if len(clients.EMBED_URLS) > 1:
+        # Ejected replicas are tolerated; embedding only needs one live endpoint
+        live = clients.endpoint_pool().check()
+        out["embed_endpoints"] = {url: e["live"] for url, e in clients.endpoint_pool().stats().items()}
+        ok = ok and live > 0
+    out["ok"] = ok
+    return out
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Headers, body and streamed tokens are separate small writes; don't let Nagle hold them back
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _send(self, code: int, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/healthz":
+            h = health()
+            return self._send(200 if h["ok"] else 503, h)
+        if self.path == "/stats":
+            cache = rq.answer_cache.get_cache()
+            return self._send(200, {"answer_cache": cache.stats() if cache else None, "embed_cache": rq.embed_cache.stats(),
+                                    "sessions": rq.sessions.get_store().stats(),
+                                    "warm_up": WARM_UP, "models_loaded": clients.loaded_models(),
+                                    "embed_endpoints": clients.endpoint_stats() or None,
+                                    "metrics": metrics.summary()})
+        if self.path == "/metrics":
+            body = metrics.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/query":
+            return self._send(404, {"error": "not found"})
+        try:
+            req = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        except ValueError:
+            return self._send(400, {"error": "invalid JSON body"})
+        q = " ".join(str(req.get("q") or "").split())
+        if not q:
+            return self._send(400, {"error": "Empty question"})
+        t0 = time.perf_counter()
+        top_k = int(req.get("top_k") or rq.TOP_K)
+        try:
+            scope = filters.from_dict(req.get("scope"))
+        except ValueError as e:
+            return self._send(400, {"error": str(e)})
+        session = str(req.get("session") or "")
+        try:
+            if req.get("stream") and session:
+                return self._stream(lambda on_token: rq.answer_turn(session, q, top_k, on_token, scope, bool(req.get("reset"))))
+            if req.get("stream"):
+                vec = rq.embed(q)
+                hits = rq.search_hits(vec, rq.context_pack.candidate_k(top_k), scope)
+                return self._stream(lambda on_token: rq.answer_from_hits(q, vec, hits, on_token=on_token, top_k=top_k))
+            if session:
+                res = rq.answer_turn(session, q, top_k, scope=scope, reset=bool(req.get("reset")))
+            else:
+                res = rq.answer(q, top_k, scope=scope)
+        except Exception as e:
+            return self._send(502, {"error": str(e)})
+        self._send(200, {**res, "seconds": round(time.perf_counter() - t0, 3)})
+
+    def _stream(self, produce):
+        """Relay the tokens produce(on_token) generates as chunked NDJSON; errors after the headers go in-band."""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def line(obj):
+            data = (json.dumps(obj) + "\n").encode("utf-8")
+            self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        try:
+            res = produce(lambda tok: line({"token": tok}))
+            line({"done": True, "stats": {**(res.get("stats") or {}), "cached": res["cached"], "pack": res["pack"],
+                                          "quality": res["quality"], **({"session": res["session"]} if "session" in res else {})}})
+        except Exception as e:
+            line({"error": str(e)})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, fmt, *args):
+        sys.stderr.write(f"[rag_server] {self.address_string()} {fmt % args}\n")
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(description="Serve RAG queries over HTTP with warm, pooled connections")
+    ap.add_argument("--host", default=HOST, help=f"Bind address (default: {HOST})")
+    ap.add_argument("--port", type=int, default=PORT, help=f"Port (default: {PORT})")
+    ap.add_argument("--no-warm-up", action="store_true", help="Don't preload the models at startup")
+    metrics.add_arguments(ap)
+    args = ap.parse_args()
+    metrics.configure(args)
+    if not rq.wait_ready(60):
+        print(json.dumps({"error": "Services not ready"}))
+        sys.exit(1)
+    if not args.no_warm_up:
+        WARM_UP.update(clients.warm_up())
+        print(json.dumps({"warm_up": WARM_UP}), flush=True)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(json.dumps({"listening": f"http://{args.host}:{args.port}"}), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
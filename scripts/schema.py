@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+schema.py
+
+Explicit DocChunk schema management. Without it Weaviate's autoschema creates the class
+on the first insert with default HNSW settings, uncompressed vectors and an inverted
+index (filterable and BM25-searchable) on every property, including the bulky chunk text.
+
+Profiles (see PROFILES):
+  balanced     Weaviate's HNSW defaults; only the filter properties are indexed (the default for ingest)
+  fast-ingest  cheaper graph construction (efConstruction 64, maxConnections 16)
+  low-memory   product quantization (PQ) of the vectors and a sparser graph
+  high-recall  denser graph, fixed ef 256 and BM25 on chunk for hybrid search
+
+  python schema.py show                       current class settings and the closest profile
+  python schema.py create --profile NAME      create DocChunk if it does not exist
+  python schema.py migrate --profile NAME     move an existing DocChunk to another profile
+
+A migration changes settings in place when Weaviate allows it (ef, enabling PQ, new
+properties). Anything else (efConstruction, maxConnections, BQ, index flags) needs a
+rebuild: every object is exported with its vector to a snapshot in data/cache/schema-migrate
+(see snapshot.py), the class is dropped and recreated, and the snapshot is imported back
+through the batch API. The snapshot is kept until the object count matches, so an
+interrupted migration resumes when re-run.
+"""
+import os, sys, json, time, threading
+from pathlib import Path
+
+import clients
+import metrics
+
+WEAVIATE  = clients.WEAVIATE
+CLASS_NAME = "DocChunk"
+PROFILE    = os.getenv("SCHEMA_PROFILE", "balanced")   # profile ingest creates DocChunk with ("none" = leave it to autoschema)
+SPOOL_DIR  = Path(os.getenv("SCHEMA_SPOOL", str(Path(__file__).resolve().parent.parent / "data" / "cache" / "schema-migrate")))
+
+PROFILES = {
+    "balanced":    {"efConstruction": 128, "maxConnections": 32, "ef": -1,  "compression": None, "chunk_searchable": False},
+    "fast-ingest": {"efConstruction": 64,  "maxConnections": 16, "ef": -1,  "compression": None, "chunk_searchable": False},
+    "low-memory":  {"efConstruction": 128, "maxConnections": 16, "ef": -1,  "compression": "pq", "chunk_searchable": False},
+    "high-recall": {"efConstruction": 512, "maxConnections": 64, "ef": 256, "compression": None, "chunk_searchable": True},
+}
+COMPRESSION = {
+    # segments 0 lets Weaviate pick dim/segment; encoding starts once trainingLimit objects exist
+    "pq": {"enabled": True, "segments": 0, "centroids": 256, "trainingLimit": 100000,
+           "encoder": {"type": "kmeans", "distribution": "log-normal"}},
+    "bq": {"enabled": True},
+}
+
+def profile_settings(name: str, **overrides) -> dict:
+    if name not in PROFILES:
+        raise ValueError(f"Unknown profile {name!r} (choose from {', '.join(PROFILES)})")
+    settings = dict(PROFILES[name])
+    settings.update({k: v for k, v in overrides.items() if v is not None})
+    if settings["compression"] == "none":
+        settings["compression"] = None
+    return settings
+
+def class_body(name: str = "balanced", **overrides) -> dict:
+    """Weaviate class definition for a profile; overrides: efConstruction, maxConnections, ef, compression."""
+    s = profile_settings(name, **overrides)
+    def text(prop, tokenization, filterable, searchable):
+        return {"name": prop, "dataType": ["text"], "tokenization": tokenization,
+                "indexFilterable": filterable, "indexSearchable": searchable}
+    def scalar(prop, data_type, indexed):
+        # Range filters (>=, <) get their own index; Equal uses the filterable one
+        return {"name": prop, "dataType": [data_type], "indexFilterable": indexed, "indexSearchable": False,
+                "indexRangeFilters": indexed}
+    return {
+        "class": CLASS_NAME,
+        "description": f"Document chunks (schema profile: {name})",
+        "vectorizer": "none",
+        "vectorIndexType": "hnsw",
+        "vectorIndexConfig": {
+            "distance": "cosine",
+            "efConstruction": s["efConstruction"],
+            "maxConnections": s["maxConnections"],
+            "ef": s["ef"],
+            "pq": COMPRESSION["pq"] if s["compression"] == "pq" else {"enabled": False},
+            "bq": COMPRESSION["bq"] if s["compression"] == "bq" else {"enabled": False},
+        },
+        "invertedIndexConfig": {"indexTimestamps": False, "indexNullState": False, "indexPropertyLength": False},
+        "properties": [
+            text("doc_id", "field", True, False),
+            text("chunk", "word", False, s["chunk_searchable"]),
+            text("meta", "field", False, False),
+            # Scoped retrieval (rag_query --doc-id/--path-prefix/--since/--until) and neighbour lookups
+            text("source_path", "field", True, False),
+            scalar("chunk_index", "int", True),
+            scalar("offset", "int", False),
+            scalar("mtime", "date", True),
+            text("content_hash", "field", False, False),
+        ],
+    }
+
+def get_class(name: str = CLASS_NAME):
+    r = clients.request("GET", f"{WEAVIATE}/v1/schema/{name}", "weaviate", timeout=30)
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    return r.json() or None
+
+def create_class(body: dict):
+    r = clients.request("POST", f"{WEAVIATE}/v1/schema", "weaviate", json=body, timeout=60)
+    if not r.ok:
+        raise RuntimeError(f"Creating {body['class']} failed: {r.status_code} {r.text}")
+
+def delete_class(name: str = CLASS_NAME):
+    r = clients.request("DELETE", f"{WEAVIATE}/v1/schema/{name}", "weaviate", timeout=300)
+    if r.status_code != 404:
+        r.raise_for_status()
+
+def count_objects(name: str = CLASS_NAME) -> int:
+    q = {"query": f"{{ Aggregate {{ {name} {{ meta {{ count }} }} }} }}"}
+    r = clients.request("POST", f"{WEAVIATE}/v1/graphql", "weaviate", json=q, timeout=120)
+    r.raise_for_status()
+    rows = ((r.json().get("data") or {}).get("Aggregate") or {}).get(name) or [{}]
+    return int(((rows[0] or {}).get("meta") or {}).get("count") or 0)
+
+_ensured = False
+_ensure_lock = threading.Lock()
+
+def ensure_class(profile: str = None):
+    """Create DocChunk from a profile unless it exists; runs once per process (ingest calls it before writing).
+
+    A class created before a property was added to the profiles gets the property here,
+    before autoschema can add it with guessed types (ints become "number").
+    """
+    global _ensured
+    profile = profile or PROFILE
+    if _ensured or profile == "none":
+        return
+    with _ensure_lock:
+        if _ensured:
+            return
+        current = get_class()
+        if current is None:
+            try:
+                create_class(class_body(profile))
+            except RuntimeError:
+                # Another process may have created it in the meantime
+                if get_class() is None:
+                    raise
+        else:
+            target = class_body(profile)
+            missing = [c for c in diff(current, target) if c["target"] == "add"]
+            if missing:
+                try:
+                    update_in_place(current, target, missing)
+                except RuntimeError:
+                    # Added concurrently by another process
+                    pass
+        _ensured = True
+
+def diff(current: dict, target: dict):
+    """Differences between a live class and a target definition.
+
+    Each entry says whether Weaviate can apply it to the existing class ("mutable")
+    or whether the class has to be rebuilt.
+    """
+    out = []
+    cv, tv = current.get("vectorIndexConfig") or {}, target["vectorIndexConfig"]
+    if (current.get("vectorIndexType") or "hnsw") != target["vectorIndexType"]:
+        out.append({"field": "vectorIndexType", "current": current.get("vectorIndexType"), "target": target["vectorIndexType"], "mutable": False})
+    for key in ("distance", "efConstruction", "maxConnections", "ef"):
+        if cv.get(key) != tv[key]:
+            out.append({"field": f"vectorIndexConfig.{key}", "current": cv.get(key), "target": tv[key], "mutable": key == "ef"})
+    for comp in ("pq", "bq"):
+        on, want = bool((cv.get(comp) or {}).get("enabled")), tv[comp]["enabled"]
+        if on != want:
+            # PQ can be switched on for a populated HNSW index; nothing can be switched off
+            out.append({"field": f"vectorIndexConfig.{comp}.enabled", "current": on, "target": want, "mutable": comp == "pq" and want})
+    ci, ti = current.get("invertedIndexConfig") or {}, target["invertedIndexConfig"]
+    for key, want in ti.items():
+        if bool(ci.get(key)) != want:
+            out.append({"field": f"invertedIndexConfig.{key}", "current": ci.get(key), "target": want, "mutable": False})
+    props = {p["name"]: p for p in current.get("properties") or []}
+    for p in target["properties"]:
+        have = props.get(p["name"])
+        if have is None:
+            out.append({"field": f"properties.{p['name']}", "current": None, "target": "add", "mutable": True})
+            continue
+        for key in ("dataType", "tokenization", "indexFilterable", "indexSearchable", "indexRangeFilters"):
+            if key in p and have.get(key) != p[key]:
+                out.append({"field": f"properties.{p['name']}.{key}", "current": have.get(key), "target": p[key], "mutable": False})
+    return out
+
+def match_profile(current: dict):
+    """Name of the profile a live class matches exactly, if any."""
+    return next((name for name in PROFILES if not diff(current, class_body(name))), None)
+
+def update_in_place(current: dict, target: dict, changes):
+    """Apply the mutable changes: PUT the updated class, then add missing properties."""
+    body = json.loads(json.dumps(current))
+    vic = body.setdefault("vectorIndexConfig", {})
+    for c in changes:
+        if c["field"] == "vectorIndexConfig.ef":
+            vic["ef"] = target["vectorIndexConfig"]["ef"]
+        elif c["field"] == "vectorIndexConfig.pq.enabled":
+            vic["pq"] = {**(vic.get("pq") or {}), **target["vectorIndexConfig"]["pq"]}
+    body["description"] = target["description"]
+    if any(not c["field"].startswith("properties.") for c in changes):
+        r = clients.request("PUT", f"{WEAVIATE}/v1/schema/{CLASS_NAME}", "weaviate", json=body, timeout=120)
+        if not r.ok:
+            raise RuntimeError(f"Updating {CLASS_NAME} failed: {r.status_code} {r.text}")
+    for p in target["properties"]:
+        if any(c["field"] == f"properties.{p['name']}" for c in changes):
+            r = clients.request("POST", f"{WEAVIATE}/v1/schema/{CLASS_NAME}/properties", "weaviate", json=p, timeout=60)
+            if not r.ok:
+                raise RuntimeError(f"Adding property {p['name']} failed: {r.status_code} {r.text}")
+
+def migrate(profile: str, spool: Path = SPOOL_DIR, batch_size: int = 256, page_size: int = 500,
+            dry_run: bool = False, **overrides) -> dict:
+    """Bring DocChunk to a profile, in place when possible, else by spool → drop → recreate → import."""
+    import snapshot
+    target = class_body(profile, **overrides)
+    state = snapshot.read_manifest(spool)
+    current = get_class()
+    if state is None:
+        if current is None:
+            if not dry_run:
+                create_class(target)
+            return {"action": "created", "profile": profile}
+        changes = diff(current, target)
+        if not changes:
+            return {"action": "unchanged", "profile": profile}
+        if all(c["mutable"] for c in changes):
+            if not dry_run:
+                update_in_place(current, target, changes)
+            return {"action": "updated", "profile": profile, "changes": changes, **({"dry_run": True} if dry_run else {})}
+        if dry_run:
+            return {"action": "rebuild", "profile": profile, "changes": changes, "objects": count_objects(), "dry_run": True}
+        t0 = time.perf_counter()
+        state = snapshot.export(spool, page_size)
+        print(json.dumps({"spooled": state["rows"], "seconds": round(time.perf_counter() - t0, 3)}), flush=True)
+    elif current is not None and diff(current, target):
+        # A previous migration stopped before dropping the class: the live class is still the
+        # source of truth and may have changed since, so spool it again
+        changes = diff(current, target)
+        if dry_run:
+            return {"action": "rebuild", "profile": profile, "changes": changes, "objects": count_objects(),
+                    "stale_spool": state["rows"], "dry_run": True}
+        t0 = time.perf_counter()
+        state = snapshot.export(spool, page_size)
+        print(json.dumps({"respooled": state["rows"], "seconds": round(time.perf_counter() - t0, 3)}), flush=True)
+    else:
+        # A previous migration stopped after dropping the class; its spool is the source of truth
+        changes = []
+        if dry_run:
+            return {"action": "resume", "profile": profile, "objects": state["rows"], "dry_run": True}
+    if current is not None and changes:
+        live = count_objects()
+        if live > state["rows"]:
+            # Objects were written while spooling; dropping the class now would lose them
+            return {"action": "aborted", "profile": profile, "objects": live, "spooled": state["rows"],
+                    "spool": str(spool), "hint": "stop ingestion and re-run migrate"}
+        delete_class()
+        current = None
+    if current is None:
+        create_class(target)
+    errors = []
+    written = snapshot.restore(spool, batch_size, errors=errors)
+    count = count_objects()
+    # Objects ingested into the new class meanwhile make the count differ; then check the spooled ids themselves
+    verified = not errors and (count == state["rows"] or (count > state["rows"] and snapshot.missing_ids(spool, page_size) == 0))
+    if verified:
+        snapshot.remove(spool)
+    return {"action": "rebuilt", "profile": profile, "changes": changes, "objects": state["rows"], "imported": written,
+            "count": count, "verified": verified, "errors": len(errors),
+            **({} if verified else {"spool": str(spool), "hint": "re-run migrate to resume from the spool"})}
+
+def summarize(current: dict) -> dict:
+    if current is None:
+        return {"class": CLASS_NAME, "exists": False}
+    vic = current.get("vectorIndexConfig") or {}
+    return {
+        "class": CLASS_NAME, "exists": True, "profile": match_profile(current),
+        "vectorIndexType": current.get("vectorIndexType"),
+        "hnsw": {k: vic.get(k) for k in ("distance", "efConstruction", "maxConnections", "ef")},
+        "compression": [c for c in ("pq", "bq") if (vic.get(c) or {}).get("enabled")] or None,
+        "properties": {p["name"]: {k: p.get(k) for k in ("dataType", "tokenization", "indexFilterable", "indexSearchable", "indexRangeFilters")
+                                   if k in p}
+                       for p in current.get("properties") or []},
+    }
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(description="Create or migrate the DocChunk class from named HNSW/compression profiles")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("show", help="Show the live class, its object count and the matching profile")
+    sub.add_parser("profiles", help="Print the class definition of every profile")
+    for name in ("create", "migrate"):
+        p = sub.add_parser(name, help="Create DocChunk if missing" if name == "create" else "Move DocChunk to another profile")
+        p.add_argument("--profile", default=PROFILE, choices=list(PROFILES), help=f"Schema profile (default: {PROFILE})")
+        p.add_argument("--ef", type=int, help="Override the query-time HNSW ef (-1 = dynamic)")
+        p.add_argument("--ef-construction", type=int, help="Override efConstruction")
+        p.add_argument("--max-connections", type=int, help="Override maxConnections")
+        p.add_argument("--compression", choices=["none", "pq", "bq"], help="Override vector compression")
+        if name == "migrate":
+            p.add_argument("--dry-run", action="store_true", help="Only report the changes and whether a rebuild is needed")
+            p.add_argument("--batch-size", type=int, default=256, help="Objects per batch write when rebuilding (default: 256)")
+            p.add_argument("--page-size", type=int, default=500, help="Objects per cursor page when spooling (default: 500)")
+            p.add_argument("--spool", default=str(SPOOL_DIR), help=f"Spool directory for rebuilds (default: {SPOOL_DIR})")
+    metrics.add_arguments(ap)
+    args = ap.parse_args()
+    metrics.configure(args)
+
+    if args.cmd == "profiles":
+        print(json.dumps({name: class_body(name) for name in PROFILES}, indent=2))
+        return
+    if args.cmd == "show":
+        current = get_class()
+        print(json.dumps({**summarize(current), **({"objects": count_objects()} if current else {})}, indent=2))
+        return
+    overrides = {"ef": args.ef, "efConstruction": args.ef_construction, "maxConnections": args.max_connections,
+                 "compression": args.compression}
+    if args.cmd == "create":
+        if get_class() is not None:
+            print(json.dumps({"error": f"{CLASS_NAME} already exists; use migrate to change its profile"}))
+            sys.exit(1)
+        create_class(class_body(args.profile, **overrides))
+        print(json.dumps({"action": "created", "profile": args.profile, **summarize(get_class())}))
+        return
+    res = migrate(args.profile, Path(args.spool), args.batch_size, args.page_size, args.dry_run, **overrides)
+    print(json.dumps({**res, "metrics": metrics.summary()}))
+    if res.get("verified") is False:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
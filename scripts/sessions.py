@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+sessions.py
+
+Conversation sessions for rag_query. Ollama's /api/generate returns a `context` array: the
+token ids of the exchange so far (instruction, retrieved context, question and answer).
+Sending it back with the next prompt lets the runner match it against the prefix still in
+its KV cache and prefill only the new tokens, so a follow-up question does not re-read the
+instruction and the context of earlier turns.
+
+Each session stores that array, the generation model it belongs to and the ids of the
+chunks the model has already seen, so a follow-up only adds chunks that are new to it.
+A first turn packs only FIRST_SHARE of the usual context budget, leaving room in num_ctx
+for later turns; once a follow-up would not fit, the session restarts with a full prompt.
+Sessions live in SQLite under data/cache/ and are evicted by idle time (RAG_SESSION_TTL
+seconds) and count (RAG_SESSION_MAX sessions, least recently used first).
+
+The saving is measured, not assumed: a turn's input is its new context length minus the
+answer tokens, and whatever Ollama did not have to evaluate (prompt_eval_count) was reused.
+After the model was unloaded, or another request took over its slot, the stored tokens are
+prefilled again and the turn reports no saving.
+"""
+import os, json, time, sqlite3, threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_PATH = Path(__file__).resolve().parent.parent / "data" / "cache" / "sessions.sqlite"
+SESSION_PATH = Path(os.getenv("RAG_SESSION_PATH", str(DEFAULT_PATH)))
+TTL          = float(os.getenv("RAG_SESSION_TTL", str(24 * 3600)))
+MAX_SESSIONS = int(os.getenv("RAG_SESSION_MAX", "100"))
+MIN_CONTEXT  = int(os.getenv("RAG_SESSION_MIN_CONTEXT", "256"))  # restart when fewer tokens are left for new chunks
+FIRST_SHARE  = float(os.getenv("RAG_SESSION_FIRST_SHARE", "0.5"))  # share of the context budget a first turn may use
+
+def turn_stats(prefix, context, stats: dict) -> dict:
+    """Prefill accounting for one turn from the context before and after it and Ollama's counters."""
+    prompt_tokens = stats.get("prompt_tokens") or 0
+    # The returned context is the whole input followed by the answer
+    input_tokens = max(0, len(context) - (stats.get("eval_tokens") or 0)) if context else None
+    return {
+        "prefix_tokens": len(prefix),
+        "input_tokens": input_tokens,
+        "prompt_tokens": prompt_tokens,
+        "prefill_tokens_saved": max(0, input_tokens - prompt_tokens) if input_tokens is not None else 0,
+        "context_tokens": len(context),
+    }
+
+class SessionStore:
+    def __init__(self, path: Path = SESSION_PATH, ttl: float = TTL, max_sessions: int = MAX_SESSIONS):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl, self.max_sessions = ttl, max_sessions
+        self.lock = threading.Lock()
+        self._locks = {}               # session id → lock serializing its turns in this process
+        self.db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY, model TEXT NOT NULL, context BLOB NOT NULL, seen TEXT NOT NULL,
+            turns INTEGER NOT NULL, resets INTEGER NOT NULL DEFAULT 0, prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            saved_tokens INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL, last_used REAL NOT NULL)""")
+        self.db.commit()
+
+    @contextmanager
+    def locked(self, session_id: str):
+        """Hold a session for one turn: each turn continues from the context the previous one returned."""
+        with self.lock:
+            lock = self._locks.setdefault(session_id, threading.Lock())
+        with lock:
+            yield
+
+    def get(self, session_id: str, model: str = None):
+        """Stored session, or None when it is unknown, expired or belongs to another model."""
+        with self.lock:
+            row = self.db.execute("SELECT model, context, seen, turns, resets, prompt_tokens, saved_tokens, created, last_used "
+                                  "FROM sessions WHERE id=?", (session_id,)).fetchone()
+        if not row or row[8] < time.time() - self.ttl or (model and row[0] != model):
+            return None
+        return {"id": session_id, "model": row[0], "context": np.frombuffer(row[1], dtype=np.int32).tolist(),
+                "seen": json.loads(row[2]), "turns": row[3], "resets": row[4], "prompt_tokens": row[5],
+                "saved_tokens": row[6], "created": row[7], "last_used": row[8]}
+
+    def save(self, session_id: str, model: str, context, seen, turn: dict, reset: bool = False):
+        """Store a session's state after a turn; returns its running totals."""
+        now = time.time()
+        blob = np.asarray(context, dtype=np.int32).tobytes()
+        with self.lock:
+            prev = self.db.execute("SELECT model, turns, resets, prompt_tokens, saved_tokens, created, last_used "
+                                   "FROM sessions WHERE id=?", (session_id,)).fetchone()
+            if prev and (prev[0] != model or prev[6] < now - self.ttl):
+                prev = None
+            turns, resets, prompt_tokens, saved, created = prev[1:6] if prev else (0, 0, 0, 0, now)
+            totals = (turns + 1, resets + int(reset), prompt_tokens + (turn.get("prompt_tokens") or 0),
+                      saved + turn.get("prefill_tokens_saved", 0))
+            self.db.execute("INSERT OR REPLACE INTO sessions(id, model, context, seen, turns, resets, prompt_tokens, "
+                            "saved_tokens, created, last_used) VALUES (?,?,?,?,?,?,?,?,?,?)",
+                            (session_id, model, blob, json.dumps(sorted(seen)), *totals, created, now))
+            self.db.execute("DELETE FROM sessions WHERE last_used < ?", (now - self.ttl,))
+            n = self.db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            if n > self.max_sessions:
+                self.db.execute("DELETE FROM sessions WHERE id IN (SELECT id FROM sessions ORDER BY last_used LIMIT ?)",
+                                (n - self.max_sessions,))
+            self.db.commit()
+        return {"turns": totals[0], "resets": totals[1], "prompt_tokens": totals[2], "prefill_tokens_saved": totals[3]}
+
+    def drop(self, session_id: str) -> bool:
+        with self.lock:
+            n = self.db.execute("DELETE FROM sessions WHERE id=?", (session_id,)).rowcount
+            self.db.commit()
+        return n > 0
+
+    def list(self):
+        with self.lock:
+            rows = self.db.execute("SELECT id, model, LENGTH(context) / 4, turns, resets, prompt_tokens, saved_tokens, last_used "
+                                   "FROM sessions WHERE last_used >= ? ORDER BY last_used DESC",
+                                   (time.time() - self.ttl,)).fetchall()
+        return [{"id": r[0], "model": r[1], "context_tokens": r[2], "turns": r[3], "resets": r[4],
+                 "prompt_tokens": r[5], "prefill_tokens_saved": r[6], "idle_s": round(time.time() - r[7], 1)}
+                for r in rows]
+
+    def stats(self):
+        with self.lock:
+            n, turns, prompt_tokens, saved = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(turns), 0), COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(saved_tokens), 0) "
+                "FROM sessions WHERE last_used >= ?", (time.time() - self.ttl,)).fetchone()
+        prefill = prompt_tokens + saved
+        return {"sessions": n, "turns": turns, "prompt_tokens": prompt_tokens, "prefill_tokens_saved": saved,
+                "saved_share": round(saved / prefill, 4) if prefill else None}
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM sessions")
+            self.db.commit()
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """Process-wide session store."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SessionStore()
+        return _store
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(description="Inspect or clear rag_query conversation sessions")
+    ap.add_argument("action", choices=["stats", "list", "drop", "clear"])
+    ap.add_argument("session", nargs="?", help="Session id (for drop)")
+    args = ap.parse_args()
+    store = SessionStore()
+    if args.action == "drop":
+        if not args.session:
+            ap.error("drop needs a session id")
+        print(json.dumps({"session": args.session, "dropped": store.drop(args.session)}))
+        return
+    if args.action == "list":
+        for s in store.list():
+            print(json.dumps(s))
+        return
+    if args.action == "clear":
+        store.clear()
+    print(json.dumps({"path": str(store.path), **store.stats(), "ttl_s": store.ttl, "max_sessions": store.max_sessions}))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+snapshot.py
+
+Export DocChunk to a local snapshot and load it back through the batch API. After
+`make reset` or on a new machine, restoring a snapshot replaces re-embedding the corpus.
+
+  python snapshot.py export [--out DIR] [--float16]   page every object out with the cursor API
+  python snapshot.py import DIR [--profile NAME]      bulk-load a snapshot into Weaviate
+  python snapshot.py info DIR
+
+A snapshot directory holds:
+  vectors.npy            (rows, dim) float32 matrix; float16 with --float16 (half the size,
+                         about three significant digits, enough to keep cosine rankings)
+  ids.npy                (rows, 16) uint8 object UUIDs
+  <prop>.bin, .off.npy   one column per property: JSON-encoded values back to back, int64 offsets
+  <prop>.dict.json, .codes.npy
+                         the same column dictionary-encoded, used when values repeat (doc_id)
+  manifest.json          rows, dim, dtype, column encodings and the class definition; written
+                         last, so a directory without it is an incomplete export
+
+Import creates DocChunk from the saved definition when it is missing (or from --profile),
+then writes batches from several threads under the adaptive insert limit in clients.py.
+Object ids are preserved, so re-running an interrupted import upserts.
+"""
+import os, sys, json, time, uuid, shutil
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import clients
+import metrics
+import schema
+
+CLASS_NAME   = schema.CLASS_NAME
+SNAPSHOT_DIR = Path(os.getenv("SNAPSHOT_DIR", str(Path(__file__).resolve().parent.parent / "data" / "snapshots")))
+WORKERS      = int(os.getenv("SNAPSHOT_WORKERS", str(clients.MAX_CONCURRENCY if clients.ADAPTIVE else 4)))
+DICT_MAX     = 65536   # distinct values a column may have and still be dictionary-encoded
+HEADER_LEN   = 128     # fixed-size .npy header, rewritten once the row count is known
+# Class settings a definition keeps on restore; sharding state belongs to the old cluster
+DEFINITION_KEYS = ("class", "description", "vectorizer", "vectorIndexType", "vectorIndexConfig",
+                   "invertedIndexConfig", "moduleConfig", "properties")
+
+def _npy_header(shape, dtype) -> bytes:
+    d = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.dtype(dtype).str, tuple(shape))
+    head = d.encode("latin1").ljust(HEADER_LEN - 11) + b"\n"
+    return b"\x93NUMPY\x01\x00" + len(head).to_bytes(2, "little") + head
+
+class _ColumnWriter:
+    """JSON-encoded values of one property, with dictionary codes kept while few values repeat."""
+
+    def __init__(self, path: Path, name: str, rows_before: int = 0):
+        self.path, self.name = path, name
+        self.blob = (path / f"{name}.bin").open("wb")
+        self.offsets = array("q", [0])
+        self.codes, self.values = array("i"), {}
+        for _ in range(rows_before):   # property first seen after some rows
+            self.add(None)
+
+    def add(self, value):
+        enc = json.dumps(value, ensure_ascii=False)
+        data = enc.encode("utf-8")
+        self.blob.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+        if self.values is not None:
+            code = self.values.setdefault(enc, len(self.values))
+            if len(self.values) > DICT_MAX:
+                self.values = self.codes = None
+            else:
+                self.codes.append(code)
+
+    def finish(self, rows: int) -> str:
+        self.blob.close()
+        if self.values is not None and len(self.values) * 4 <= rows:
+            (self.path / f"{self.name}.dict.json").write_text(json.dumps(list(self.values), ensure_ascii=False), encoding="utf-8")
+            np.save(self.path / f"{self.name}.codes.npy", np.frombuffer(self.codes, dtype=np.int32))
+            (self.path / f"{self.name}.bin").unlink()
+            return "dict"
+        np.save(self.path / f"{self.name}.off.npy", np.frombuffer(self.offsets, dtype=np.int64))
+        return "json"
+
+def export(out_dir: Path, page_size: int = 500, dtype: str = "float32") -> dict:
+    """Write every DocChunk object (id, properties, vector) to a snapshot directory."""
+    from local_index import iter_objects
+    out_dir.mkdir(parents=True, exist_ok=True)
+    (out_dir / "manifest.json").unlink(missing_ok=True)
+    definition = schema.get_class()
+    rows, dim, missing, columns = 0, None, [], {}
+    with (out_dir / "vectors.npy").open("wb") as fv, (out_dir / "ids.npy").open("wb") as fi, \
+            metrics.stage("export") as rec:
+        fv.write(bytes(HEADER_LEN))
+        fi.write(bytes(HEADER_LEN))
+        for obj in iter_objects(page_size, class_name=CLASS_NAME):
+            vec = obj.get("vector")
+            if vec and dim is None:
+                dim = len(vec)
+                # Rows exported before the first vector get zeros (they are listed in `missing`)
+                fv.write(np.zeros((len(missing), dim), dtype=dtype).tobytes())
+            if vec:
+                if len(vec) != dim:
+                    raise ValueError(f"Object {obj['id']} has a {len(vec)}-d vector, expected {dim}")
+                fv.write(np.asarray(vec, dtype=dtype).tobytes())
+            else:
+                missing.append(rows)
+                if dim is not None:
+                    fv.write(np.zeros(dim, dtype=dtype).tobytes())
+            fi.write(uuid.UUID(obj["id"]).bytes)
+            props = obj.get("properties") or {}
+            for name in props.keys() - columns.keys():
+                columns[name] = _ColumnWriter(out_dir, name, rows)
+            for name, col in columns.items():
+                col.add(props.get(name))
+            rows += 1
+        rec["items"] = rows
+        fv.seek(0)
+        fv.write(_npy_header((rows, dim or 0), dtype))
+        fi.seek(0)
+        fi.write(_npy_header((rows, 16), np.uint8))
+        for f in (fv, fi):
+            f.flush()
+            os.fsync(f.fileno())
+    manifest = {"class": CLASS_NAME, "rows": rows, "dim": dim or 0, "dtype": np.dtype(dtype).name,
+                "columns": {name: col.finish(rows) for name, col in sorted(columns.items())},
+                "missing_vectors": missing, "created": time.time(),
+                "definition": {k: v for k, v in (definition or {}).items() if k in DEFINITION_KEYS} or None}
+    tmp = out_dir / "manifest.tmp"
+    tmp.write_text(json.dumps(manifest))
+    os.replace(tmp, out_dir / "manifest.json")
+    return manifest
+
+def read_manifest(path: Path):
+    """The manifest of a complete snapshot, else None."""
+    try:
+        return json.loads((Path(path) / "manifest.json").read_text())
+    except (OSError, ValueError):
+        return None
+
+def remove(path: Path):
+    shutil.rmtree(path, ignore_errors=True)
+
+class Snapshot:
+    """Read side of a snapshot: memory-mapped vectors, ids and columns."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.manifest = read_manifest(self.path)
+        if self.manifest is None:
+            raise FileNotFoundError(f"No complete snapshot in {self.path} (manifest.json missing)")
+        self.rows, self.dim = self.manifest["rows"], self.manifest["dim"]
+        self.vectors = np.load(self.path / "vectors.npy", mmap_mode="r") if self.rows and self.dim else None
+        self.ids = np.load(self.path / "ids.npy", mmap_mode="r") if self.rows else None
+        self.missing = set(self.manifest.get("missing_vectors") or [])
+        self.columns = {name: self._column(name, enc) for name, enc in self.manifest["columns"].items()}
+
+    def _column(self, name: str, encoding: str):
+        if encoding == "dict":
+            values = [json.loads(v) for v in json.loads((self.path / f"{name}.dict.json").read_text(encoding="utf-8"))]
+            codes = np.load(self.path / f"{name}.codes.npy", mmap_mode="r")
+            return lambda a, b: [values[c] for c in codes[a:b].tolist()]
+        offsets = np.load(self.path / f"{name}.off.npy", mmap_mode="r")
+        blob_path = self.path / f"{name}.bin"
+        blob = np.memmap(blob_path, dtype=np.uint8, mode="r") if blob_path.stat().st_size else np.zeros(0, np.uint8)
+        def read(a, b):
+            start, end = int(offsets[a]), int(offsets[b])
+            data, offs = blob[start:end].tobytes(), (offsets[a:b + 1] - start).tolist()
+            return [json.loads(data[offs[i]:offs[i + 1]]) for i in range(b - a)]
+        return read
+
+    def objects(self, start: int, stop: int):
+        """Batch-API objects for rows [start, stop)."""
+        vecs = self.vectors[start:stop].astype(np.float32).tolist() if self.vectors is not None else [None] * (stop - start)
+        cols = {name: read(start, stop) for name, read in self.columns.items()}
+        out = []
+        for i in range(stop - start):
+            obj = {"class": CLASS_NAME, "id": str(uuid.UUID(bytes=self.ids[start + i].tobytes())),
+                   "properties": {name: vals[i] for name, vals in cols.items() if vals[i] is not None}}
+            if start + i not in self.missing and vecs[i] is not None:
+                obj["vector"] = vecs[i]
+            out.append(obj)
+        return out
+
+def restore(path: Path, batch_size: int = 500, workers: int = WORKERS, profile: str = None, errors: list = None) -> int:
+    """Load a snapshot through /v1/batch/objects; returns objects written."""
+    import ingest_one as one
+    snap = Snapshot(path)
+    if schema.get_class() is None:
+        schema.create_class(schema.class_body(profile) if profile else
+                            snap.manifest.get("definition") or schema.class_body(schema.PROFILE))
+    def write(rng):
+        return one.insert_batch(snap.objects(*rng))
+    ranges = [(a, min(a + batch_size, snap.rows)) for a in range(0, snap.rows, max(1, batch_size))]
+    written = 0
+    with metrics.stage("import") as rec, ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for ok, errs in pool.map(write, ranges):
+            written += ok
+            if errors is not None:
+                errors.extend(errs)
+        rec["items"] = written
+    return written
+
+def missing_ids(path: Path, page_size: int = 500) -> int:
+    """How many of a snapshot's objects are not (or no longer) in the live class."""
+    from local_index import iter_objects
+    snap = Snapshot(path)
+    if not snap.rows:
+        return 0
+    live = {uuid.UUID(o["id"]).bytes for o in iter_objects(page_size, include_vector=False, class_name=CLASS_NAME)}
+    return sum(1 for row in snap.ids if row.tobytes() not in live)
+
+def info(path: Path) -> dict:
+    snap = Snapshot(path)
+    size = sum(f.stat().st_size for f in snap.path.iterdir() if f.is_file())
+    m = snap.manifest
+    return {"path": str(snap.path), "class": m["class"], "rows": m["rows"], "dim": m["dim"], "dtype": m["dtype"],
+            "columns": m["columns"], "missing_vectors": len(m.get("missing_vectors") or []),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(m["created"])), "size_bytes": size,
+            "profile": schema.match_profile(m["definition"]) if m.get("definition") else None}
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(description="Export DocChunk to a local snapshot or restore one without re-embedding")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    ex = sub.add_parser("export", help="Page DocChunk out of Weaviate into a snapshot directory")
+    ex.add_argument("--out", help=f"Snapshot directory (default: {SNAPSHOT_DIR}/docchunk-<timestamp>)")
+    ex.add_argument("--float16", action="store_true", help="Store vectors as float16 (half the size, slightly lossy)")
+    ex.add_argument("--page-size", type=int, default=500, help="Objects per cursor page (default: 500)")
+    im = sub.add_parser("import", help="Bulk-load a snapshot through the batch API")
+    im.add_argument("path", help="Snapshot directory")
+    im.add_argument("--batch-size", type=int, default=500, help="Objects per batch write (default: 500)")
+    im.add_argument("--workers", type=int, default=WORKERS, help=f"Concurrent batch writers (default: {WORKERS})")
+    im.add_argument("--profile", choices=list(schema.PROFILES),
+                    help="Create DocChunk from this profile instead of the snapshot's saved definition")
+    inf = sub.add_parser("info", help="Describe a snapshot")
+    inf.add_argument("path", help="Snapshot directory")
+    metrics.add_arguments(ap)
+    args = ap.parse_args()
+    metrics.configure(args)
+
+    if args.cmd == "info":
+        print(json.dumps(info(Path(args.path))))
+        return
+    if not clients.wait_ready(90, ["weaviate"]):
+        print(json.dumps({"error": "Weaviate not ready"}))
+        sys.exit(1)
+    t0 = time.perf_counter()
+    if args.cmd == "export":
+        out = Path(args.out) if args.out else SNAPSHOT_DIR / f"docchunk-{time.strftime('%Y%m%d-%H%M%S')}"
+        m = export(out, args.page_size, "float16" if args.float16 else "float32")
+        seconds = time.perf_counter() - t0
+        print(json.dumps({"path": str(out), "rows": m["rows"], "dim": m["dim"], "dtype": m["dtype"], "columns": m["columns"],
+                          "size_bytes": sum(f.stat().st_size for f in out.iterdir() if f.is_file()),
+                          "seconds": round(seconds, 3), "objects_per_sec": round(m["rows"] / seconds, 2) if seconds > 0 else None,
+                          "metrics": metrics.summary()}))
+        return
+    errors = []
+    written = restore(Path(args.path), args.batch_size, args.workers, args.profile, errors)
+    seconds = time.perf_counter() - t0
+    count = schema.count_objects()
+    rows = read_manifest(Path(args.path))["rows"]
+    print(json.dumps({"path": args.path, "rows": rows, "imported": written, "count": count, "errors": len(errors),
+                      "error_details": errors[:20], "seconds": round(seconds, 3),
+                      "objects_per_sec": round(written / seconds, 2) if seconds > 0 else None,
+                      "concurrency": clients.limiter_stats() or None, "metrics": metrics.summary()}))
+    if errors or count < rows:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+"""
+standins.py
+
+Lightweight in-process stand-ins for the Ollama and Weaviate HTTP APIs used by the
+scripts, so ingest and query performance can be measured without Docker or models.
+
+  Ollama:   GET /api/tags, GET /api/ps, POST /api/embed, POST /api/embeddings, POST /api/generate (stream or not;
+            an empty prompt or input only loads the model, keep_alive 0 unloads it after the call; a
+            returned `context` passed back is only prefilled past the prefix the model's slot still holds)
+  Weaviate: GET /v1/.well-known/ready, POST|GET /v1/objects (cursor paging), POST|DELETE /v1/batch/objects,
+            POST /v1/graphql (nearVector, brute force, optional where filter; Aggregate meta count),
+            GET|POST|PUT|DELETE /v1/schema[/<class>[/properties]] (definitions are stored, not enforced)
+  Control:  GET /_stats (request counts, bytes, objects), POST /_reset {"objects": true}
+
+Vectors are deterministic: a unit vector drawn from a generator seeded with the text's
+sha256, so identical text always embeds identically across runs. Latency is simulated
+per call and per item (see StandInConfig). Point the scripts at a stand-in with
+OLLAMA_URL / WEAVIATE_URL.
+"""
+import sys, json, time, re, uuid, random, socket, hashlib, threading
+from dataclasses import dataclass, asdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+@dataclass
+class StandInConfig:
+    dim: int = 768
+    embed_ms: float = 2.0           # per /api/embed call
+    embed_item_ms: float = 0.5      # per embedded text
+    batch_ms: float = 2.0           # per /v1/batch/objects call
+    batch_item_ms: float = 0.05     # per written object
+    search_ms: float = 2.0          # per /v1/graphql query (on top of the real brute-force scan)
+    prefill_token_ms: float = 0.05  # simulated prompt evaluation per prompt token
+    token_ms: float = 5.0           # per generated token
+    answer_tokens: int = 16
+    embed_parallel: int = 0         # embed calls served at once, the rest queue (like OLLAMA_NUM_PARALLEL; 0 = unlimited)
+    error_rate: float = 0.0         # share of embed and batch calls answered with 503, for retry testing
+    load_ms: float = 0.0            # model load paid by the first call per model, reported as load_duration
+
+def vector_for(text: str, dim: int):
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    v = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return v / np.linalg.norm(v)
+
+class Store:
+    """Objects plus a lazily rebuilt vector matrix for nearVector scans."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, objects: bool = True):
+        with self.lock:
+            if objects:
+                self.objects, self.classes, self._matrix = {}, {}, None
+                self.loaded = {}   # model -> keep_alive of its last call
+                self.kv = {}       # model -> token context left in its (single) slot by the last generate
+            self.requests, self.bytes_in, self.bytes_out, self.embedded = {}, 0, 0, 0
+
+    def count(self, key: str, nbytes: int):
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.bytes_in += nbytes
+
+    def put(self, obj: dict):
+        with self.lock:
+            obj["id"] = obj.get("id") or str(uuid.uuid4())
+            self.objects[obj["id"]] = obj
+            self._matrix = None
+        return obj
+
+    def delete(self, ids):
+        with self.lock:
+            n = sum(self.objects.pop(i, None) is not None for i in ids)
+            if n:
+                self._matrix = None
+        return n
+
+    def drop_class(self, name: str):
+        with self.lock:
+            self.classes.pop(name, None)
+            self.objects = {k: o for k, o in self.objects.items() if o.get("class") != name}
+            self._matrix = None
+
+    def search(self, vec, limit: int, where: dict = None):
+        with self.lock:
+            if self._matrix is None:
+                objs = [o for o in self.objects.values() if o.get("vector")]
+                if not objs:
+                    return []
+                m = np.asarray([o["vector"] for o in objs], dtype=np.float32)
+                norms = np.linalg.norm(m, axis=1, keepdims=True)
+                self._matrix = (objs, m / np.where(norms == 0, 1, norms))
+            objs, m = self._matrix
+        if where:
+            # Pre-filter like Weaviate: only allowed objects compete for the top k
+            rows = [i for i, o in enumerate(objs) if matches(where, o.get("properties") or {})]
+            objs, m = [objs[i] for i in rows], m[rows]
+            if not objs:
+                return []
+        q = np.asarray(vec, dtype=np.float32)
+        sims = m @ (q / (np.linalg.norm(q) or 1))
+        k = min(limit, len(objs))
+        best = np.argpartition(-sims, k - 1)[:k]
+        return [(objs[i], 1.0 - float(sims[i])) for i in best[np.argsort(-sims[best])]]
+
+    def stats(self):
+        with self.lock:
+            return {"requests": dict(self.requests), "total_requests": sum(self.requests.values()),
+                    "bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                    "embedded_texts": self.embedded, "objects": len(self.objects)}
+
+def parse_where(query: str):
+    """The where: argument of a GraphQL Get as a dict (keys quoted, operator enums as strings)."""
+    at = re.search(r"\bwhere:\s*{", query)
+    if not at:
+        return None
+    depth, start, in_str, esc = 0, at.end() - 1, False, False
+    for i in range(start, len(query)):
+        c = query[i]
+        if in_str:
+            in_str, esc = (c != '"' or esc), (c == "\\" and not esc)
+        elif c == '"':
+            in_str = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                break
+    lit = query[start:i + 1]
+    # Quote bare keys and enum values outside of string literals
+    lit = re.sub(r'("(?:\\.|[^"\\])*")|(\w+)(\s*:)', lambda m: m.group(1) or f'"{m.group(2)}"{m.group(3)}', lit)
+    lit = re.sub(r'("operator":\s*)(\w+)', r'\1"\2"', lit)
+    return json.loads(lit)
+
+def matches(where: dict, props: dict) -> bool:
+    """Evaluate a Weaviate where filter (the operators the scripts use) against object properties."""
+    op = where.get("operator")
+    if op in ("And", "Or"):
+        results = (matches(w, props) for w in where.get("operands") or [])
+        return all(results) if op == "And" else any(results)
+    have = props.get((where.get("path") or [""])[-1])
+    if have is None:
+        return False
+    want = next((v for k, v in where.items() if k.startswith("value")), None)
+    if op == "Equal":
+        return have == want
+    if op == "NotEqual":
+        return have != want
+    if op == "ContainsAny":
+        return have in want
+    if op == "Like":
+        return re.fullmatch(re.escape(want).replace("\\*", ".*").replace("\\?", "."), str(have)) is not None
+    # Range operators; RFC 3339 dates in one fixed form compare correctly as strings
+    return {"GreaterThan": have > want, "GreaterThanEqual": have >= want,
+            "LessThan": have < want, "LessThanEqual": have <= want}.get(op, False)
+
+def make_handler(store: Store, cfg: StandInConfig):
+    embed_slots = threading.Semaphore(cfg.embed_parallel) if cfg.embed_parallel > 0 else None
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            # Headers and body are separate writes; without this, Nagle + delayed ACK adds ~40ms per response
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def log_message(self, *args):
+            pass
+
+        def _body(self):
+            raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            path = urlparse(self.path).path
+            if not path.startswith("/_"):
+                store.count(f"{self.command} {path}", len(raw))
+            return json.loads(raw or b"{}")
+
+        def _send(self, code: int, obj):
+            body = json.dumps(obj).encode("utf-8")
+            with store.lock:
+                store.bytes_out += len(body)
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._body()
+            url = urlparse(self.path)
+            if url.path == "/_stats":
+                return self._send(200, {**store.stats(), "config": asdict(cfg)})
+            if url.path in ("/v1/.well-known/ready", "/v1/.well-known/live"):
+                return self._send(200, {})
+            if url.path == "/api/tags":
+                return self._send(200, {"models": [{"name": "standin"}]})
+            if url.path == "/api/ps":
+                with store.lock:
+                    models = [{"name": m, "model": m, "keep_alive": k} for m, k in store.loaded.items()]
+                return self._send(200, {"models": models})
+            if url.path.startswith("/v1/schema"):
+                name = url.path[len("/v1/schema/"):]
+                with store.lock:
+                    if not name:
+                        return self._send(200, {"classes": list(store.classes.values())})
+                    cls = store.classes.get(name)
+                return self._send(200, cls) if cls else self._send(404, {"error": [{"message": f"class {name} not found"}]})
+            if url.path == "/v1/objects":
+                qs = parse_qs(url.query)
+                limit, after = int(qs.get("limit", ["25"])[0]), qs.get("after", [None])[0]
+                with_vec = "vector" in qs.get("include", [""])[0]
+                cls = qs.get("class", [None])[0]
+                with store.lock:
+                    ids = sorted(i for i, o in store.objects.items()
+                                 if (after is None or i > after) and (cls is None or o.get("class") in (None, cls)))[:limit]
+                    objs = [store.objects[i] for i in ids]
+                return self._send(200, {"objects": [
+                    {"id": o["id"], "class": o.get("class"), "properties": o.get("properties") or {},
+                     **({"vector": o.get("vector")} if with_vec else {})} for o in objs]})
+            self._send(404, {"error": "not found"})
+
+        def do_PUT(self):
+            body = self._body()
+            name = urlparse(self.path).path[len("/v1/schema/"):]
+            with store.lock:
+                known = name in store.classes
+                if known:
+                    store.classes[name] = body
+            self._send(200, body) if known else self._send(404, {"error": [{"message": f"class {name} not found"}]})
+
+        def do_DELETE(self):
+            body = self._body()
+            path = urlparse(self.path).path
+            if path.startswith("/v1/schema/"):
+                store.drop_class(path[len("/v1/schema/"):])
+                return self._send(200, {})
+            if path == "/v1/batch/objects":
+                ids = ((body.get("match") or {}).get("where") or {}).get("valueTextArray") or []
+                n = store.delete(ids)
+                return self._send(200, {"results": {"matches": n, "successful": n, "failed": 0}})
+            self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            body = self._body()
+            path = urlparse(self.path).path
+            if path == "/_reset":
+                store.reset(objects=body.get("objects", True))
+                return self._send(200, {"ok": True})
+            if path in ("/api/embed", "/v1/batch/objects") and cfg.error_rate and random.random() < cfg.error_rate:
+                return self._send(503, {"error": "stand-in injected failure"})
+            if path == "/api/embed":
+                load_ns = self._load(body)
+                texts = body.get("input") or []
+                texts = [texts] if isinstance(texts, str) else texts
+                if embed_slots:
+                    with embed_slots:
+                        time.sleep((cfg.embed_ms + cfg.embed_item_ms * len(texts)) / 1000)
+                else:
+                    time.sleep((cfg.embed_ms + cfg.embed_item_ms * len(texts)) / 1000)
+                with store.lock:
+                    store.embedded += len(texts)
+                return self._send(200, {"embeddings": [vector_for(t, cfg.dim).tolist() for t in texts], "load_duration": load_ns})
+            if path == "/api/embeddings":
+                time.sleep((cfg.embed_ms + cfg.embed_item_ms) / 1000)
+                with store.lock:
+                    store.embedded += 1
+                return self._send(200, {"embedding": vector_for(body.get("prompt") or "", cfg.dim).tolist()})
+            if path == "/api/generate":
+                return self._generate(body)
+            if path == "/v1/schema":
+                with store.lock:
+                    exists = body.get("class") in store.classes
+                    if not exists:
+                        store.classes[body["class"]] = body
+                if exists:
+                    return self._send(422, {"error": [{"message": f"class name {body['class']} already exists"}]})
+                return self._send(200, body)
+            if path.startswith("/v1/schema/") and path.endswith("/properties"):
+                with store.lock:
+                    cls = store.classes.get(path.split("/")[3])
+                    if cls is not None:
+                        cls.setdefault("properties", []).append(body)
+                return self._send(200, body) if cls is not None else self._send(404, {"error": [{"message": "class not found"}]})
+            if path == "/v1/objects":
+                return self._send(200, store.put(body))
+            if path == "/v1/batch/objects":
+                objs = body.get("objects") or []
+                time.sleep((cfg.batch_ms + cfg.batch_item_ms * len(objs)) / 1000)
+                return self._send(200, [{**store.put(o), "result": {}} for o in objs])
+            if path == "/v1/graphql":
+                return self._graphql(body.get("query") or "")
+            self._send(404, {"error": "not found"})
+
+        def _graphql(self, query: str):
+            agg = re.search(r"Aggregate\s*{\s*(\w+)", query)
+            if agg:
+                with store.lock:
+                    n = sum(1 for o in store.objects.values() if o.get("class") in (None, agg.group(1)))
+                return self._send(200, {"data": {"Aggregate": {agg.group(1): [{"meta": {"count": n}}]}}})
+            cls = re.search(r"Get\s*{\s*(\w+)", query)
+            vec = re.search(r"vector:\s*\[([^\]]*)\]", query)
+            limit = re.search(r"limit:\s*(\d+)", query)
+            time.sleep(cfg.search_ms / 1000)
+            hits = store.search([float(x) for x in vec.group(1).split(",")], int(limit.group(1)) if limit else 10,
+                                parse_where(query)) if vec else []
+            out = [{**(o.get("properties") or {}), "_additional": {"id": o["id"], "distance": round(d, 6)}} for o, d in hits]
+            self._send(200, {"data": {"Get": {cls.group(1) if cls else "DocChunk": out}}})
+
+        def _load(self, body: dict) -> int:
+            """Simulate loading the model on its first call; returns load_duration in ns."""
+            model, keep = body.get("model") or "standin", body.get("keep_alive", "5m")
+            with store.lock:
+                cold = model not in store.loaded
+                if keep in (0, "0", "0s"):
+                    store.loaded.pop(model, None)
+                else:
+                    store.loaded[model] = keep
+            if cold and cfg.load_ms:
+                time.sleep(cfg.load_ms / 1000)
+                return int(cfg.load_ms * 1e6)
+            return 0
+
+        def _generate(self, body: dict):
+            load_ns = self._load(body)
+            if not body.get("prompt"):
+                return self._send(200, {"done": True, "done_reason": "load", "response": "", "load_duration": load_ns})
+            model, prompt = body.get("model") or "standin", body.get("prompt") or ""
+            seed = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8], 16)
+            tokens = [f" tok{i}" for i in range(cfg.answer_tokens)]
+            # Token ids: the given context, then the prompt's and the answer's (derived from the prompt text)
+            given = [int(t) for t in body.get("context") or []]
+            context = given + [(seed + i) % 32000 for i in range(max(1, len(prompt) // 4) + len(tokens))]
+            answer_from = len(context) - len(tokens)
+            with store.lock:
+                # Like Ollama's runner, only tokens after the prefix still in the slot are evaluated
+                cached = store.kv.get(model) or []
+                reused = next((i for i, (a, b) in enumerate(zip(cached, context[:answer_from])) if a != b),
+                              min(len(cached), answer_from))
+                # A model unloaded after this call (keep_alive 0) keeps nothing
+                store.kv[model] = context if model in store.loaded else []
+            prompt_tokens = max(1, answer_from - reused)
+            prefill_s = prompt_tokens * cfg.prefill_token_ms / 1000
+            time.sleep(prefill_s)
+            final = {"done": True, "response": "", "context": context,
+                     "prompt_eval_count": prompt_tokens, "prompt_eval_duration": int(prefill_s * 1e9),
+                     "eval_count": len(tokens), "eval_duration": int(len(tokens) * cfg.token_ms * 1e6),
+                     "load_duration": load_ns}
+            if not body.get("stream", True):
+                time.sleep(len(tokens) * cfg.token_ms / 1000)
+                return self._send(200, {**final, "response": "".join(tokens).strip()})
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for tok in tokens:
+                time.sleep(cfg.token_ms / 1000)
+                self._chunk({"response": tok, "done": False})
+            self._chunk(final)
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _chunk(self, obj):
+            data = (json.dumps(obj) + "\n").encode("utf-8")
+            self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+class StandIn:
+    """One server answering both the Ollama and the Weaviate endpoints."""
+
+    def __init__(self, cfg: StandInConfig = None, host: str = "127.0.0.1", port: int = 0):
+        self.cfg = cfg or StandInConfig()
+        self.store = Store()
+        self.server = ThreadingHTTPServer((host, port), make_handler(self.store, self.cfg))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(description="Run Ollama/Weaviate stand-ins for benchmarks and offline testing")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=11500)
+    for name, value in asdict(StandInConfig()).items():
+        ap.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    args = ap.parse_args()
+    cfg = StandInConfig(**{k: getattr(args, k) for k in asdict(StandInConfig())})
+    srv = StandIn(cfg, args.host, args.port)
+    print(json.dumps({"url": srv.url, "config": asdict(cfg)}), flush=True)
+    try:
+        srv.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    sys.exit(main())
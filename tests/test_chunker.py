@@ -0,0 +1,66 @@
+"""stream_chunker must produce exactly the chunks of the in-memory chunker, whatever the read buffer size."""
+import random
+
+import pytest
+
+import ingest_one
+from ingest_one import chunker, stream_chunker, MAX_LEN, STEP
+
+# str.split() whitespace beyond ASCII: NBSP, em space, line separator, ideographic space, plus CRLF
+SPACES = [" ", "  ", "\t", "\n", "\r\n", " ", " ", " ", "　", " \n\t "]
+LETTERS = "abcxyz" + "éüß" + "中文字" + "ж" + "😀"
+BUF_SIZES = [1, 2, 3, 7, 13, 31, 97, 899, 900, 901, 4096]
+
+def generated_text(seed: int, words: int) -> str:
+    rng = random.Random(seed)
+    parts = [rng.choice(SPACES)] if seed % 2 else []
+    for _ in range(words):
+        parts.append("".join(rng.choice(LETTERS) for _ in range(rng.choice([1, 2, 5, 12, 40]))))
+        parts.append(rng.choice(SPACES))
+    return "".join(parts)
+
+def expected_chunks(fp, **kw):
+    return list(chunker(fp.read_text(errors="ignore"), **kw))
+
+def write(tmp_path, text: str, name: str = "doc.txt"):
+    fp = tmp_path / name
+    fp.write_text(text, encoding="utf-8")
+    return fp
+
+@pytest.mark.parametrize("seed,words", [(0, 0), (1, 3), (2, 250), (3, 900), (4, 2000)])
+@pytest.mark.parametrize("buf_size", BUF_SIZES + ["larger"])
+def test_matches_reference(tmp_path, seed, words, buf_size):
+    fp = write(tmp_path, generated_text(seed, words))
+    if buf_size == "larger":
+        buf_size = len(fp.read_text(errors="ignore")) + 1
+    assert list(stream_chunker(fp, buf_size=buf_size)) == expected_chunks(fp)
+
+@pytest.mark.parametrize("buf_size", [1, 3, 5, 11, 17, 64])
+def test_small_chunks(tmp_path, buf_size):
+    # Many chunk boundaries per buffer, and buffers shorter than the overlap
+    fp = write(tmp_path, generated_text(7, 400))
+    kw = {"max_len": 20, "overlap": 6}
+    assert list(stream_chunker(fp, buf_size=buf_size, **kw)) == expected_chunks(fp, **kw)
+
+@pytest.mark.parametrize("cut", [-3, -1, 0, 1, 4])
+def test_chunk_boundary_inside_refill(tmp_path, cut):
+    # Words of 9 letters plus one space: normalized offset MAX_LEN falls inside a word, and the
+    # buffer size puts a refill right around it, so the word straddling the boundary is carried over
+    text = " ".join("abcdéfghi" for _ in range(3 * MAX_LEN // 10))
+    fp = write(tmp_path, text)
+    chunks = list(stream_chunker(fp, buf_size=MAX_LEN + cut))
+    assert chunks == expected_chunks(fp)
+    assert all(len(c) == MAX_LEN for c in chunks[:-2])
+
+@pytest.mark.parametrize("text", ["", "   \n\t ", "　", "x", "w" * (3 * MAX_LEN + 5), "  lead and trail  "])
+def test_edge_inputs(tmp_path, text):
+    fp = write(tmp_path, text)
+    for buf_size in (1, 7, 1 << 20):
+        assert list(stream_chunker(fp, buf_size=buf_size)) == expected_chunks(fp)
+
+def test_offsets_are_normalized_positions(tmp_path):
+    fp = write(tmp_path, generated_text(5, 1500))
+    normalized = " ".join(fp.read_text(errors="ignore").split())
+    pairs = list(ingest_one.iter_chunks(fp))
+    assert [off for off, _ in pairs] == [i * STEP for i in range(len(pairs))]
+    assert all(normalized[off:off + MAX_LEN] == ch for off, ch in pairs)
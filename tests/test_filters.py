@@ -0,0 +1,47 @@
+"""A scope must select the same chunks from Weaviate (where filter) and from the local index (row mask)."""
+import numpy as np
+import pytest
+
+import filters
+from standins import matches
+
+ROWS = [
+    {"doc_id": "a.md", "source_path": "data/raw/a.md", "mtime": "2024-01-01T00:00:00Z"},
+    {"doc_id": "ab.txt", "source_path": "data/raw/ab.txt", "mtime": "2024-03-15T12:00:00Z"},
+    {"doc_id": "x.md", "source_path": "data/raw2/x.md", "mtime": "2024-06-30T23:59:59Z"},
+    {"doc_id": "notes [v1].md", "source_path": "data/raw/notes [v1].md", "mtime": "2024-07-01T00:00:00Z"},
+    {"doc_id": "100%_done.md", "source_path": "data/raw/100%_done.md", "mtime": ""},
+    {"doc_id": "c.md", "source_path": "/tmp/elsewhere/c.md", "mtime": "2023-12-31T23:59:59Z"},
+]
+
+def weaviate_rows(s):
+    w = filters.where(s)
+    return [i for i, row in enumerate(ROWS) if w is None or matches(w, {k: v for k, v in row.items() if v})]
+
+def local_rows(s):
+    cols = {k: np.array([row[k] for row in ROWS], dtype=str) for k in ("doc_id", "source_path", "mtime")}
+    return np.flatnonzero(filters.mask(s or {}, cols)).tolist()
+
+@pytest.mark.parametrize("kw", [
+    {"path_prefix": "data/raw/"},
+    {"path_prefix": "data/raw"},
+    {"path_prefix": "./data/raw/a"},
+    {"path_prefix": "data/raw/notes [v1]"},
+    {"path_prefix": "data/raw/100%_"},
+    {"path_prefix": "data/raw/100._"},
+    {"path_prefix": "/tmp/elsewhere/"},
+    {"doc_id": ["a.md", "x.md"], "path_prefix": "data/"},
+    {"since": "2024-01-01", "until": "2024-06-30"},
+    {"doc_id": "ab.txt", "since": "2024-03-15T12:00:00"},
+    {},
+])
+def test_backends_agree(kw):
+    s = filters.scope(**kw)
+    assert weaviate_rows(s) == local_rows(s)
+
+@pytest.mark.parametrize("prefix", ["data/*", "data/raw/a?.md", "*"])
+def test_wildcards_rejected(prefix):
+    with pytest.raises(ValueError, match="wildcards"):
+        filters.scope(path_prefix=prefix)
+    with pytest.raises(ValueError):
+        filters.from_dict({"path_prefix": prefix})
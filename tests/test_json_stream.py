@@ -0,0 +1,45 @@
+"""iter_json_items must yield exactly the elements json.load sees, wherever the read buffers end."""
+import json
+
+import pytest
+
+from json_to_text import iter_json_items
+
+DOCS = [
+    "[10000000000.0, 2]",
+    "[1.5e10]",
+    "[-0.25E-3,7,  -12 ,0]",
+    '["a", "with \\"quote\\" and , ] [ { }", "\\u00e9\\ud83d\\ude00", ""]',
+    '[true, false, null, 3]',
+    '[{"title": "x", "mapping": {"a": [1, 2.5, {"b": null}]}}, [[], {}], "s", 4e2]',
+    ' \n [ 1 ,\n\t{"k": [10, 20.0e-1]} , "x" ] \n',
+    "[]",
+    "[ ]",
+]
+
+@pytest.mark.parametrize("doc", DOCS)
+@pytest.mark.parametrize("buf_size", [1, 2, 3, 4, 5, 7, 11])
+def test_matches_json_load(tmp_path, doc, buf_size):
+    fp = tmp_path / "conv.json"
+    fp.write_text(doc, encoding="utf-8")
+    assert list(iter_json_items(fp, buf_size=buf_size)) == json.loads(doc)
+
+@pytest.mark.parametrize("doc", DOCS)
+def test_every_cut(tmp_path, doc):
+    # buf_size = cut puts the first refill exactly at position cut
+    fp = tmp_path / "conv.json"
+    fp.write_text(doc, encoding="utf-8")
+    for cut in range(1, len(doc) + 1):
+        assert list(iter_json_items(fp, buf_size=cut)) == json.loads(doc), cut
+
+def test_top_level_object(tmp_path):
+    fp = tmp_path / "conv.json"
+    fp.write_text('{"title": "t", "n": 1.5e3}', encoding="utf-8")
+    assert list(iter_json_items(fp, buf_size=2)) == [{"title": "t", "n": 1500.0}]
+
+@pytest.mark.parametrize("doc", ["[1, 2", "[1.5e", '["abc'])
+def test_truncated(tmp_path, doc):
+    fp = tmp_path / "conv.json"
+    fp.write_text(doc, encoding="utf-8")
+    with pytest.raises(ValueError):
+        list(iter_json_items(fp, buf_size=2))
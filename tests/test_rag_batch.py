@@ -0,0 +1,27 @@
+"""load_questions accepts objects and bare strings and names the line of anything else."""
+import re
+
+import pytest
+
+from rag_batch import load_questions
+
+def write(tmp_path, *lines):
+    fp = tmp_path / "questions.jsonl"
+    fp.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return fp
+
+def test_objects_and_strings(tmp_path):
+    fp = write(tmp_path, '{"q": "what  is\\tit?", "id": "a"}', "", '"bare question"', '{"question": "third", "scope": {"doc_id": "x.md"}}',
+               '{"q": "   "}')
+    qs = load_questions(fp)
+    assert [(q["id"], q["q"]) for q in qs] == [("a", "what is it?"), (3, "bare question"), (4, "third")]
+    assert qs[0]["scope"] is None and qs[2]["scope"]["doc_id"] == ["x.md"]
+
+@pytest.mark.parametrize("bad,message", [("42", "expected an object or a string"), ('["q"]', "expected an object or a string"),
+                                         ("null", "expected an object or a string"), ("{not json", ""),
+                                         ('{"q": "x", "scope": "docs/"}', "scope must be an object"),
+                                         ('{"q": "x", "scope": {"since": "yesterday"}}', "")])
+def test_bad_line_names_it(tmp_path, bad, message):
+    fp = write(tmp_path, '"fine"', bad)
+    with pytest.raises(ValueError, match="^" + re.escape(f"{fp}:2: {message}")):
+        load_questions(fp)